@@ -1,8 +1,9 @@
 from allauth.account.adapter import DefaultAccountAdapter
-from .tasks import send_async_mail
+
+from accounts import mail
 
 class AccountAdapter(DefaultAccountAdapter):
-    
+
     def send_mail(self, template_prefix, email, context):
         msg = self.render_mail(template_prefix, email, context)
-        send_async_mail(msg)
\ No newline at end of file
+        mail.enqueue([msg])
@@ -1,6 +1,18 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
-from .models import User
+from accounts import mail
+from .models import QueuedEmail, User
 
-admin.site.register(User, UserAdmin)
\ No newline at end of file
+admin.site.register(User, UserAdmin)
+
+@admin.register(QueuedEmail)
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ('domain', 'created', 'next_attempt', 'attempts', 'dead')
+    list_filter = ('dead',)
+    readonly_fields = ('payload', 'last_error')
+    actions = ('requeue',)
+
+    def requeue(self, request, queryset):
+        mail.requeue(queryset)
+    requeue.short_description = 'Requeue the selected emails'
@@ -0,0 +1,167 @@
+"""
+Batched transactional email.
+
+Messages are stored as compact JSON in QueuedEmail rows instead of being
+pickled into one task each. The send_queued_mail task drains the queue
+BATCH_SIZE messages at a time over a single mail server connection. Each
+recipient domain gets at most its EMAIL_DOMAIN_RATE_LIMITS (or
+EMAIL_DOMAIN_RATE_LIMIT) messages a minute, the rest wait for the next
+minute. Failed messages are retried with exponential backoff and
+dead-lettered after MAX_ATTEMPTS.
+"""
+import json
+from datetime import timedelta
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import QueuedEmail
+from main import metrics
+
+BATCH_SIZE = 500
+#claimed messages are not handed to another worker for this long
+LEASE = timedelta(minutes=5)
+MAX_ATTEMPTS = 6
+BACKOFF = timedelta(minutes=1)
+#delay before draining, so a burst of messages is sent as one batch
+DRAIN_DELAY = 1
+SCHEDULED_KEY = 'mail:scheduled'
+RATE_KEY = 'mail:rate:{}:{}'
+
+def to_payload(message):
+    payload = {
+        'subject': message.subject,
+        'body': message.body,
+        'from_email': message.from_email,
+        'to': message.to,
+    }
+    for key in ('cc', 'bcc', 'reply_to', 'extra_headers'):
+        if getattr(message, key):
+            payload[key] = getattr(message, key)
+    if message.content_subtype != 'plain':
+        payload['content_subtype'] = message.content_subtype
+    if getattr(message, 'alternatives', None):
+        payload['alternatives'] = message.alternatives
+    return payload
+
+def from_payload(payload, connection=None):
+    message = EmailMultiAlternatives(
+        payload['subject'], payload['body'], payload['from_email'], payload['to'],
+        bcc=payload.get('bcc'), connection=connection,
+        headers=payload.get('extra_headers'),
+        alternatives=[tuple(alternative) for alternative in payload.get('alternatives', ())],
+        cc=payload.get('cc'), reply_to=payload.get('reply_to'))
+    message.content_subtype = payload.get('content_subtype', 'plain')
+    return message
+
+def domain(address):
+    return parseaddr(address)[1].rpartition('@')[2].lower()
+
+def enqueue(messages):
+    """Queue EmailMessages for sending, returns the QueuedEmails"""
+    queued = QueuedEmail.objects.bulk_create(
+        QueuedEmail(payload=json.dumps(to_payload(message)),
+                    domain=domain(message.to[0]) if message.to else '')
+        for message in messages)
+    #one drain per burst, the task clears the flag when it starts
+    if cache.add(SCHEDULED_KEY, 1, timeout=60):
+        from accounts.tasks import send_queued_mail
+        send_queued_mail.apply_async(countdown=DRAIN_DELAY)
+    return queued
+
+def rate_limit(domain):
+    limits = settings.EMAIL_DOMAIN_RATE_LIMITS
+    return limits.get(domain, settings.EMAIL_DOMAIN_RATE_LIMIT)
+
+def _allow(domain, count, now):
+    """How many of count messages to domain may be sent this minute"""
+    key = RATE_KEY.format(domain, int(now.timestamp() // 60))
+    cache.add(key, 0, timeout=120)
+    used = cache.incr(key, count)
+    return max(0, min(count, rate_limit(domain) - (used - count)))
+
+def _claim(batch_size, now):
+    with transaction.atomic():
+        emails = list(QueuedEmail.objects
+                      .select_for_update(skip_locked=True)
+                      .filter(dead=False, next_attempt__lte=now)
+                      .order_by('next_attempt')[:batch_size])
+        QueuedEmail.objects.filter(pk__in=[email.pk for email in emails])\
+            .update(next_attempt=now + LEASE)
+    return emails
+
+def _deliver(emails):
+    """Send over one connection, returns {pk: error} of the failed ones"""
+    connection = get_connection()
+    errors = {}
+    opened = False
+    for email in emails:
+        try:
+            if not opened:
+                connection.open()
+                opened = True
+            connection.send_messages([from_payload(json.loads(email.payload), connection)])
+        except Exception as error:
+            errors[email.pk] = error
+            #carry on over a fresh connection
+            opened = False
+            try:
+                connection.close()
+            except Exception:
+                pass
+    if opened:
+        connection.close()
+    return errors
+
+def _retry(email, error, now):
+    attempts = email.attempts + 1
+    QueuedEmail.objects.filter(pk=email.pk).update(
+        attempts=attempts,
+        last_error='{}: {}'.format(type(error).__name__, error),
+        next_attempt=now + BACKOFF * 2 ** (attempts - 1),
+        dead=attempts >= MAX_ATTEMPTS)
+
+def send_batch(batch_size=BATCH_SIZE, now=None):
+    """Send one batch of due messages, returns (claimed, sent)"""
+    now = now or timezone.now()
+    emails = _claim(batch_size, now)
+    by_domain = {}
+    for email in emails:
+        by_domain.setdefault(email.domain, []).append(email)
+
+    sending, deferred = [], []
+    for name, queued in sorted(by_domain.items()):
+        allowed = _allow(name, len(queued), now)
+        sending += queued[:allowed]
+        deferred += queued[allowed:]
+    if deferred:
+        next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        QueuedEmail.objects.filter(pk__in=[email.pk for email in deferred])\
+            .update(next_attempt=next_minute)
+
+    errors = _deliver(sending)
+    sent = [email.pk for email in sending if email.pk not in errors]
+    QueuedEmail.objects.filter(pk__in=sent).delete()
+    for email in sending:
+        if email.pk in errors:
+            _retry(email, errors[email.pk], now)
+    metrics.EMAILS_SENT.inc(len(sent))
+    return len(emails), len(sent)
+
+def drain(batch_size=BATCH_SIZE):
+    """Send due messages until none is left, returns the number sent"""
+    cache.delete(SCHEDULED_KEY)
+    total = 0
+    while True:
+        claimed, sent = send_batch(batch_size)
+        total += sent
+        if claimed < batch_size:
+            return total
+
+def requeue(queryset):
+    """Give dead-lettered messages a fresh set of attempts"""
+    return queryset.update(dead=False, attempts=0, next_attempt=timezone.now())
@@ -1,5 +1,27 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
 
 class User(AbstractUser):
-    pass
\ No newline at end of file
+    pass
+
+class QueuedEmail(models.Model):
+    """An email waiting to be sent by accounts.mail.drain"""
+    #JSON of accounts.mail.to_payload
+    payload = models.TextField()
+    #of the first recipient, for the per-domain rate limits
+    domain = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    #given up on after MAX_ATTEMPTS, kept for inspection & requeueing
+    dead = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            models.Index(fields=['dead', 'next_attempt'], name='queued_email_due_idx'),
+        )
+
+    def __str__(self):
+        return '{} ({})'.format(self.domain, self.created)
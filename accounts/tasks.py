@@ -1,9 +1,12 @@
 from celery import task
 from celery.utils.log import get_task_logger
 
+from accounts import mail
+
 logger = get_task_logger(__name__)
 
-@task(name='send_async_mail')
-def send_async_mail(message):
-    logger.info('Sending email: Subject {}'.format(message.subject))
-    return message.send()
\ No newline at end of file
+@task(name='send_queued_mail', ignore_result=True)
+def send_queued_mail():
+    sent = mail.drain()
+    logger.info('Sent {} queued emails'.format(sent))
+    return sent
@@ -1,10 +1,19 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives
+from django.utils import timezone
+from unittest import mock
+import datetime
+import json
 from celery.contrib.testing.worker import start_worker
 from treehouse.celery import app
 
+from accounts import mail as accounts_mail
+from accounts.models import QueuedEmail
+
 class AuthenticationTestCase(TestCase):
     
     def test_signup_form_has_first_name_last_name(self):
@@ -25,7 +34,11 @@ class AuthenticationTestCase(TestCase):
         self.assertRedirects(resp, reverse('home'))
         
     def test_email_send_done_by_celery_worker(self):
-        
+        #the worker runs in process, whatever CELERY_TASK_ALWAYS_EAGER says
+        eager = app.conf.task_always_eager
+        app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+        self.addCleanup(app.conf.update, CELERY_TASK_ALWAYS_EAGER=eager)
+
         #create test user
         get_user_model().objects.create_user(
             username='testuser',
@@ -38,4 +51,68 @@ class AuthenticationTestCase(TestCase):
             'email': 'testuser@email.com'
         }
         resp = self.client.post(reverse('account_reset_password'), data)
-        self.assertGreaterEqual(len(mail.outbox), 1)
\ No newline at end of file
+        self.assertGreaterEqual(len(mail.outbox), 1)
+
+class MailQueueTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def message(self, to='reader@example.com', **kwargs):
+        message = EmailMultiAlternatives('Welcome', 'Hello', 'treehouse@example.com', [to],
+                                         **kwargs)
+        message.attach_alternative('<p>Hello</p>', 'text/html')
+        return message
+
+    def test_payload_round_trip(self):
+        message = self.message(cc=['cc@example.com'], headers={'X-Tag': 'signup'})
+        payload = json.loads(json.dumps(accounts_mail.to_payload(message)))
+        restored = accounts_mail.from_payload(payload)
+        for attribute in ('subject', 'body', 'from_email', 'to', 'cc', 'extra_headers',
+                          'alternatives'):
+            self.assertEqual(getattr(restored, attribute), getattr(message, attribute))
+
+    def test_batch_is_sent_over_one_connection(self):
+        with mock.patch('accounts.mail.cache.add', return_value=False):
+            accounts_mail.enqueue([self.message() for _ in range(5)])
+        with mock.patch('accounts.mail.get_connection',
+                        wraps=accounts_mail.get_connection) as get_connection:
+            self.assertEqual(accounts_mail.drain(), 5)
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(QueuedEmail.objects.exists())
+
+    @override_settings(EMAIL_DOMAIN_RATE_LIMIT=100,
+                       EMAIL_DOMAIN_RATE_LIMITS={'slow.example.com': 2})
+    def test_domains_are_rate_limited(self):
+        with mock.patch('accounts.mail.cache.add', return_value=False):
+            accounts_mail.enqueue([self.message('a{}@slow.example.com'.format(i))
+                                   for i in range(5)] + [self.message()])
+        self.assertEqual(accounts_mail.drain(), 3)
+        deferred = QueuedEmail.objects.all()
+        self.assertEqual(len(deferred), 3)
+        self.assertTrue(all(email.attempts == 0 and email.next_attempt > timezone.now()
+                            for email in deferred))
+
+    def test_failures_are_retried_then_dead_lettered(self):
+        with mock.patch('accounts.mail.cache.add', return_value=False):
+            accounts_mail.enqueue([self.message()])
+        now = timezone.now()
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=ConnectionRefusedError):
+            for attempt in range(1, accounts_mail.MAX_ATTEMPTS + 1):
+                now += datetime.timedelta(days=1)
+                self.assertEqual(accounts_mail.send_batch(now=now), (1, 0))
+                email = QueuedEmail.objects.get()
+                self.assertEqual(email.attempts, attempt)
+                self.assertEqual(email.next_attempt - now,
+                                 accounts_mail.BACKOFF * 2 ** (attempt - 1))
+        self.assertTrue(email.dead)
+        self.assertIn('ConnectionRefusedError', email.last_error)
+        self.assertEqual(accounts_mail.send_batch(now=now + datetime.timedelta(days=1)),
+                         (0, 0))
+
+        accounts_mail.requeue(QueuedEmail.objects.all())
+        self.assertEqual(accounts_mail.drain(), 1)
+        self.assertEqual(len(mail.outbox), 1)
@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.utils.html import format_html
 from sorl.thumbnail import get_thumbnail
 
-from main import models
+from main import images, models
 
 class BookDiscussionsInline(admin.TabularInline):
     model = models.BookDiscussion
@@ -15,7 +15,8 @@ class BookAdmin(admin.ModelAdmin):
     )
 
     def book_cover(self, obj):
-        cover = get_thumbnail(obj.cover, '152x131')
+        cover = images.rendition(obj, 'cover', '152x131') or \
+            get_thumbnail(obj.cover, '152x131')
         return format_html(
             "<img src='{}'>".format(cover.url)
         )
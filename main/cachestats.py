@@ -0,0 +1,39 @@
+"""
+Hit & miss reporting for CACHES['default'].
+
+Django keeps one cache instance per thread. install() wraps get & get_many
+of the current thread's instance once; every lookup is then reported to the
+functions in listeners as listener(hits, misses).
+"""
+from django.core.cache import caches
+
+listeners = []
+
+def install():
+    """Instrument this thread's default cache, a no-op when already done"""
+    cache = caches['default']
+    if '_counting' in vars(cache):
+        return
+    get, get_many = cache.get, cache.get_many
+    missing = object()
+
+    def report(hits, misses):
+        for listener in listeners:
+            listener(hits, misses)
+
+    def counting_get(key, default=None, version=None):
+        value = get(key, missing, version=version)
+        if value is missing:
+            report(0, 1)
+            return default
+        report(1, 0)
+        return value
+
+    def counting_get_many(keys, version=None):
+        keys = list(keys)
+        values = get_many(keys, version=version)
+        report(len(values), len(keys) - len(values))
+        return values
+
+    cache.get, cache.get_many = counting_get, counting_get_many
+    cache._counting = True
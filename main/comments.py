@@ -0,0 +1,74 @@
+"""
+Comment tree loading for the discussion detail pages.
+
+load() fetches one cursor page of a discussion's comments, oldest first,
+with their authors and reply counts, then the first few replies of every
+comment on the page with their authors, in two queries whatever the size of
+the discussion. The remaining replies are paged through the comment replies
+endpoints (views.BookCommentReplyList & views.ThreadCommentReplyList).
+"""
+from django.db.models import Count, OuterRef, Subquery
+from django.http import Http404
+
+from main import fragments, pagination
+
+PAGE_SIZE = 20
+REPLIES_PER_COMMENT = 3
+REPLIES_PAGE_SIZE = 20
+
+def load(comments, cursor=None, page_size=PAGE_SIZE, replies=REPLIES_PER_COMMENT):
+    """
+    Return the KeysetPage of the comments queryset, every comment getting
+    first_replies and more_replies_cursor (None when all replies are shown).
+    Raises ValueError on an invalid cursor.
+    """
+    page = pagination.paginate(
+        comments.select_related('commentor__user').annotate(reply_count=Count('replies')),
+        page_size, cursor, ascending=True)
+    if not page.object_list:
+        return page
+
+    reply_model = comments.model._meta.get_field('replies').related_model
+    first = reply_model.objects\
+        .filter(comment=OuterRef('comment'))\
+        .order_by('created', 'id')\
+        .values('id')[:replies]
+    by_comment = {}
+    for reply in reply_model.objects\
+            .filter(comment__in=[comment.pk for comment in page.object_list],
+                    id__in=Subquery(first))\
+            .select_related('replier__user')\
+            .order_by('created', 'id'):
+        by_comment.setdefault(reply.comment_id, []).append(reply)
+
+    for comment in page.object_list:
+        comment.first_replies = by_comment.get(comment.pk, [])
+        comment.more_replies_cursor = None
+        if comment.reply_count > len(comment.first_replies):
+            comment.more_replies_cursor = pagination.encode_cursor(
+                comment.first_replies[-1], pagination.NEXT)
+    return page
+
+class CommentTreeMixin:
+    """
+    DetailView mixin for discussions: pages the comments with ?cursor= into
+    ctx['comments'] and ctx['page_obj']
+    """
+    cursor_kwarg = 'cursor'
+    replies_url = None
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        try:
+            page = load(self.object.comments.all(),
+                        self.request.GET.get(self.cursor_kwarg))
+        except ValueError:
+            raise Http404('Invalid cursor')
+        ctx.update({
+            'comments': page.object_list,
+            'page_obj': page,
+            'is_paginated': page.has_other_pages(),
+            'replies_url': self.replies_url,
+            'fragments': fragments.prefetch(('comment', page.object_list)),
+        })
+        return ctx
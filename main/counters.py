@@ -0,0 +1,73 @@
+"""
+Write-buffered like counters for reviews.
+
+Likes and unlikes are not applied to Review.like_count straight away; they
+accumulate as two monotonic counters per review in CACHES['default'] (two
+counters rather than one signed delta, since memcached cannot go below zero)
+and every touched review id is appended to a journal (main.journal). The
+flush_review_likes task periodically drains the journal and applies the net
+deltas to the db in one UPDATE per review.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from main.journal import Journal
+
+LIKED_KEY = 'review-likes:{}:added'
+UNLIKED_KEY = 'review-likes:{}:removed'
+#of the review ids touched
+journal = Journal('review-likes')
+FLUSH_LOCK_KEY = 'review-likes:flush-lock'
+FLUSH_LOCK_TIMEOUT = 60 * 5
+BATCH_SIZE = 500
+
+def _incr(key, delta=1):
+    cache.add(key, 0, timeout=None)
+    return cache.incr(key, delta)
+
+def record_like(review_id, liked=True):
+    """Buffer a like (or unlike when liked=False) of a review"""
+    _incr((LIKED_KEY if liked else UNLIKED_KEY).format(review_id))
+    journal.append(str(review_id))
+
+def pending_likes(review_ids):
+    """Return {review_id: net buffered delta} in a single cache round-trip"""
+    keys = {}
+    for review_id in review_ids:
+        keys[LIKED_KEY.format(review_id)] = (review_id, 1)
+        keys[UNLIKED_KEY.format(review_id)] = (review_id, -1)
+    pending = dict.fromkeys(review_ids, 0)
+    for key, value in cache.get_many(keys).items():
+        review_id, sign = keys[key]
+        pending[review_id] += sign * value
+    return pending
+
+def flush_likes(now=None):
+    """Apply buffered like deltas to Review.like_count, returns reviews updated"""
+    from main.models import Review
+
+    if not cache.add(FLUSH_LOCK_KEY, 1, timeout=FLUSH_LOCK_TIMEOUT):
+        return 0
+    try:
+        updated = 0
+        for entries in journal.batches(BATCH_SIZE, now):
+            review_ids = sorted(set(entries))
+            counters = cache.get_many(
+                [key.format(review_id) for review_id in review_ids
+                 for key in (LIKED_KEY, UNLIKED_KEY)])
+            with transaction.atomic():
+                for review_id in review_ids:
+                    delta = counters.get(LIKED_KEY.format(review_id), 0) -\
+                            counters.get(UNLIKED_KEY.format(review_id), 0)
+                    if delta:
+                        Review.objects.filter(pk=review_id)\
+                            .update(like_count=F('like_count') + delta)
+                        updated += 1
+            #decrement by exactly what was applied so concurrent likes are kept
+            for key, value in counters.items():
+                if value:
+                    cache.decr(key, value)
+        return updated
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
@@ -0,0 +1,119 @@
+"""
+Read replicas.
+
+ReplicaRouter sends writes to the primary (the default database) and reads
+to one of the replica aliases of DATABASES, picked at random among the
+healthy ones. A replica is checked with one query at most every
+REPLICA_CHECK_INTERVAL seconds per process: it is skipped while unreachable
+or, on PostgreSQL, while it lags more than REPLICA_MAX_LAG seconds behind.
+Without a healthy replica reads go to the primary.
+
+Replicas are behind the primary, so reads stay on it:
+- inside a transaction on the primary,
+- for the rest of a request once it wrote,
+- in Celery tasks, mostly queued right after a write and reading the rows it
+  wrote, unless a read-only batch job calls unpin(),
+- for REPLICA_PIN_SECONDS after a client's write, through the cookie set by
+  PrimaryPinMiddleware, so users see their own changes.
+"""
+import random
+import threading
+import time
+
+from celery.signals import task_prerun
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+PRIMARY = DEFAULT_DB_ALIAS
+PIN_COOKIE = 'primary_until'
+#seconds behind the primary, NULL when not replicating
+LAG_SQL = {
+    'postgresql': 'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())',
+}
+
+#the request or task being handled by this thread
+_current = threading.local()
+#{alias: (healthy, checked at)} of this process
+_health = {}
+
+def pin():
+    """Read from the primary for the rest of the request or task"""
+    _current.pinned = True
+
+def unpin():
+    """Read from the replicas until the next write, for read-only batch jobs"""
+    _current.pinned = False
+
+def reset(pinned=False):
+    _current.pinned = pinned
+    _current.wrote = False
+
+@task_prerun.connect
+def _task_prerun(**kwargs):
+    reset(pinned=True)
+
+def _check(alias):
+    try:
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            cursor.execute(LAG_SQL.get(connection.vendor, 'SELECT NULL'))
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        return False
+    return lag is None or lag <= settings.REPLICA_MAX_LAG
+
+def healthy(alias, now=None):
+    now = now or time.monotonic()
+    state = _health.get(alias)
+    if state is None or now - state[1] >= settings.REPLICA_CHECK_INTERVAL:
+        state = _health[alias] = (_check(alias), now)
+    return state[0]
+
+class ReplicaRouter:
+
+    def __init__(self, replicas=None):
+        self.replicas = [alias for alias in settings.DATABASES if alias != PRIMARY] \
+            if replicas is None else list(replicas)
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or getattr(_current, 'pinned', False) or \
+                connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        replicas = [alias for alias in self.replicas if healthy(alias)]
+        return random.choice(replicas) if replicas else PRIMARY
+
+    def db_for_write(self, model, **hints):
+        _current.pinned = _current.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        #every alias holds the same rows
+        databases = [PRIMARY] + self.replicas
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in self.replicas
+
+class PrimaryPinMiddleware:
+    """Keeps a client's reads on the primary for a while after its writes"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            pinned = float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            pinned = False
+        reset(pinned)
+        try:
+            response = self.get_response(request)
+            if _current.wrote and settings.REPLICA_PIN_SECONDS:
+                response.set_cookie(
+                    PIN_COOKIE, str(int(time.time()) + settings.REPLICA_PIN_SECONDS),
+                    max_age=settings.REPLICA_PIN_SECONDS, httponly=True)
+        finally:
+            reset()
+        return response
@@ -0,0 +1,72 @@
+"""
+Russian-doll caching of template fragments.
+
+{% fragment 'name' obj %}...{% endfragment %} (main.templatetags.fragments)
+caches the rendered block under a key made of the fragment name, obj's id
+and a digest of its version: the auto_now timestamp plus whatever else the
+block shows that is updated without a save (like counts, rating aggregates,
+thumbnails, author names). A fragment's version includes the keys of the
+fragments nested in it, so changing a reply changes its comment's key too
+and the comment is re-rendered around the reply fragments still cached.
+Keys never go stale, they are replaced.
+
+Views call prefetch() with the objects of the page to load every fragment,
+nested ones included, in a single get_many; the template tag then only
+renders the misses.
+"""
+import hashlib
+
+from django.core.cache import cache
+
+KEY = 'fragment:{}:{}:{}:{}'
+TIMEOUT = 60 * 60 * 24
+
+def _url(image):
+    return getattr(image, 'url', None)
+
+def _author(profile):
+    return profile.user.username
+
+#fragment name: obj -> the parts of its version
+VERSIONS = {
+    'book': lambda book: (book.updated, book.rating_sum, book.rating_count,
+                          _url(getattr(book, 'thumbnail', None))),
+    'book_review': lambda review: (review.created, review.get_likes(),
+                                   _author(review.reviewer), review.reviewer.avatar.name),
+    'review': lambda review: (review.created, review.get_likes(),
+                              _url(getattr(review, 'thumbnail', None))),
+    'comment': lambda comment: (comment.created, _author(comment.commentor),
+                                comment.more_replies_cursor,
+                                [key('reply', reply) for reply in comment.first_replies]),
+    'reply': lambda reply: (reply.created, _author(reply.replier)),
+}
+#fragment name: (nested fragment name, obj -> nested objs)
+NESTED = {
+    'comment': ('reply', lambda comment: comment.first_replies),
+}
+
+def key(name, obj):
+    digest = hashlib.md5(repr(VERSIONS[name](obj)).encode()).hexdigest()
+    return KEY.format(name, obj._meta.label_lower, obj.pk, digest)
+
+def _keys(name, objs):
+    keys = []
+    for obj in objs:
+        keys.append(key(name, obj))
+        if name in NESTED:
+            nested, children = NESTED[name]
+            keys += _keys(nested, children(obj))
+    return keys
+
+def prefetch(*fragments):
+    """{key: html} of the cached fragments of [(name, objs)] and of their nested ones"""
+    keys = []
+    for name, objs in fragments:
+        keys += _keys(name, objs)
+    return cache.get_many(keys) if keys else {}
+
+def get(key):
+    return cache.get(key)
+
+def store(key, html):
+    cache.set(key, html, TIMEOUT)
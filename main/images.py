@@ -0,0 +1,199 @@
+"""
+Upload-time image processing for Book covers, Profile avatars & BookClub logos.
+
+A new upload is saved as is and handed to the process_image task on commit.
+The task validates the image, applies its EXIF orientation and re-encodes it
+without metadata under a content-hashed name, then writes every rendition
+the templates use. The hash and original dimensions are stored on the model
+so rendition urls and sizes are derived without touching the files; the
+names never change for a given content, so they can be cached forever.
+"""
+import hashlib
+import logging
+import os
+from io import BytesIO
+
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from main import pagecache
+
+logger = logging.getLogger(__name__)
+
+#{(app_label.model_name): {image field: rendition geometries}}
+RENDITIONS = {
+    'main.book': {'cover': ('150x75', '152x131')},
+    'main.profile': {'avatar': ('80x80',)},
+    'main.bookclub': {'logo': ('150x75',)},
+}
+FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+#accepted formats stored as another, MPO being how many phones' JPEGs open
+ENCODE_AS = {'GIF': 'PNG', 'MPO': 'JPEG'}
+MAX_PIXELS = 40 * 1000 * 1000
+JPEG_QUALITY = 85
+
+class Rendition:
+    """Stand-in for a sorl ImageFile: url, width & height of a stored rendition"""
+
+    def __init__(self, name, width, height):
+        self.name = name
+        self.width = self.x = width
+        self.height = self.y = height
+
+    @property
+    def url(self):
+        return default_storage.url(self.name)
+
+def image_fields(instance):
+    return RENDITIONS.get(instance._meta.label_lower, {})
+
+def parse_geometry(geometry):
+    width, height = geometry.split('x')
+    return int(width), int(height)
+
+def fit(size, geometry):
+    """Size of an image of size scaled to fit in geometry, never upscaled"""
+    width, height = size
+    box_width, box_height = parse_geometry(geometry)
+    ratio = min(box_width / width, box_height / height, 1)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+def rendition_name(content_hash, geometry, ext):
+    return 'renditions/{}/{}/{}.{}'.format(content_hash[:2], content_hash, geometry, ext)
+
+def rendition(instance, field, geometry):
+    """The Rendition of instance.<field> at geometry or None when not processed yet"""
+    if not processed(instance, field):
+        return None
+    content_hash = getattr(instance, field + '_hash')
+    size = fit((getattr(instance, field + '_width'),
+                getattr(instance, field + '_height')), geometry)
+    ext = os.path.splitext(getattr(instance, field).name)[1].lstrip('.')
+    return Rendition(rendition_name(content_hash, geometry, ext), *size)
+
+def processed(instance, field):
+    """True when instance.<field> is the output of the pipeline"""
+    content_hash = getattr(instance, field + '_hash')
+    name = getattr(instance, field).name
+    #processed files are named after their content hash
+    return bool(content_hash and name and
+                os.path.basename(name).startswith(content_hash + '.'))
+
+#post_init & post_save receiver
+def remember_files(sender, instance, **kwargs):
+    """Note the file of every loaded image field, see untouched"""
+    instance._image_files = {field: getattr(instance, field)
+                             for field in image_fields(instance)
+                             if field in instance.__dict__}
+
+def untouched(instance):
+    """
+    The image fields of instance not assigned since it was loaded or saved,
+    and their processing fields. The pipeline may have replaced them since,
+    so saves must not write them back. Assigning a field, uploads included,
+    replaces its file object even when the new name is the old one.
+    """
+    files = getattr(instance, '_image_files', {})
+    fields = set()
+    for field in image_fields(instance):
+        if field in files and instance.__dict__.get(field) is files[field]:
+            fields.update((field, field + '_hash', field + '_width', field + '_height'))
+    return fields
+
+#pre_save / post_save receivers
+def reset_processed(sender, instance, **kwargs):
+    """A new upload invalidates the stored hash & dimensions"""
+    for field in image_fields(instance):
+        if field in instance.__dict__ and not processed(instance, field):
+            setattr(instance, field + '_hash', '')
+            setattr(instance, field + '_width', None)
+            setattr(instance, field + '_height', None)
+
+def queue_processing(sender, instance, **kwargs):
+    from main.tasks import process_image
+
+    unchanged = untouched(instance) if not kwargs.get('created') else ()
+    for field in image_fields(instance):
+        if field in instance.__dict__ and getattr(instance, field) and \
+                field not in unchanged and not processed(instance, field):
+            transaction.on_commit(
+                lambda field=field: process_image.delay(
+                    instance._meta.label_lower, str(instance.pk), field))
+
+#the pipeline, run by the process_image task
+def _encode(image, fmt):
+    if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif fmt in ('PNG', 'WEBP') and image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')
+    buf = BytesIO()
+    options = {'quality': JPEG_QUALITY, 'optimize': True} if fmt == 'JPEG' else {}
+    #re-encoding without exif/pnginfo/icc arguments drops all metadata
+    image.save(buf, fmt, **options)
+    return buf.getvalue()
+
+def _open(file_):
+    """Validated, upright PIL image of file_ and its output format"""
+    with file_.open('rb') as f:
+        image = Image.open(f)
+        image.verify()
+    with file_.open('rb') as f:
+        image = Image.open(f)
+        fmt = ENCODE_AS.get(image.format, image.format)
+        if fmt not in FORMATS:
+            raise ValueError('Unsupported image format {}'.format(image.format))
+        if image.width * image.height > MAX_PIXELS:
+            raise ValueError('Image too large')
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    return image, fmt
+
+def process(label, pk, field):
+    """Validate, strip & render instance.<field>, returns False when rejected"""
+    model = apps.get_model(label)
+    instance = model.objects.filter(pk=pk).first()
+    file_ = getattr(instance, field, None)
+    if not file_:
+        return False
+    original_name = file_.name
+    try:
+        image, fmt = _open(file_)
+    except Exception as e:
+        #the original stays in storage, only the field is cleared
+        logger.warning('Rejected %s %s of %s %s: %s', field, original_name, label, pk, e)
+        model.objects.filter(pk=pk, **{field: original_name})\
+            .update(**{field: '', field + '_hash': ''})
+        return False
+
+    data = _encode(image, fmt)
+    content_hash = hashlib.sha256(data).hexdigest()[:32]
+    ext = FORMATS[fmt]
+    directory = os.path.dirname(original_name)
+    name = os.path.join(directory, '{}.{}'.format(content_hash, ext))
+    storage = file_.storage
+    if not storage.exists(name):
+        name = storage.save(name, ContentFile(data))
+    for geometry in RENDITIONS[label][field]:
+        rendition = rendition_name(content_hash, geometry, ext)
+        if not storage.exists(rendition):
+            storage.save(rendition, ContentFile(
+                _encode(image.resize(fit(image.size, geometry), Image.LANCZOS), fmt)))
+
+    #skip the update if another upload replaced the file meanwhile
+    updated = model.objects.filter(pk=pk, **{field: original_name}).update(**{
+        field: name,
+        field + '_hash': content_hash,
+        field + '_width': image.width,
+        field + '_height': image.height,
+    })
+    if updated and name != original_name:
+        storage.delete(original_name)
+    if updated:
+        if label == 'main.profile':
+            #the memoized club leaders hold the old avatar
+            apps.get_model('main.BookClub').invalidate_leaders(profile=pk)
+        pagecache.invalidate(*pagecache.tags_for(instance))
+    return bool(updated)
@@ -0,0 +1,67 @@
+"""
+Append-only event journals in CACHES['default'].
+
+A writer appends an entry by incrementing the journal's counter, which
+gives it a slot number, then setting that slot. One consumer at a time,
+under its own lock, reads the slots in batches and remembers the last one
+it consumed. A slot may be numbered but not set yet, its writer being
+between the two calls, so reading stops before a missing slot until it has
+been missing for MISSING_GRACE seconds: its writer is then gone and the
+slot lost. Consumed slots are deleted, lost ones expire after SLOT_TIMEOUT.
+"""
+import time
+
+from django.core.cache import cache
+
+SLOT_TIMEOUT = 60 * 60 * 24
+MISSING_GRACE = 60
+
+class Journal:
+
+    def __init__(self, prefix):
+        self.key = prefix + ':journal'
+        self.slot_key = prefix + ':journal:{}'
+        self.flushed_key = prefix + ':flushed'
+        #(last slot, time) when a slot was first found missing
+        self.stalled_key = prefix + ':stalled'
+
+    def append(self, entry):
+        cache.add(self.key, 0, timeout=None)
+        slot = cache.incr(self.key)
+        cache.set(self.slot_key.format(slot), entry, timeout=SLOT_TIMEOUT)
+        return slot
+
+    def _settled(self, numbers, found, now):
+        """The leading slot numbers that can be consumed"""
+        settled = []
+        for number in numbers:
+            if self.slot_key.format(number) not in found:
+                stalled = cache.get(self.stalled_key)
+                if stalled is None or number > stalled[0]:
+                    cache.set(self.stalled_key, (cache.get(self.key) or 0, now), timeout=None)
+                    break
+                if now - stalled[1] < MISSING_GRACE:
+                    break
+            settled.append(number)
+        return settled
+
+    def batches(self, batch_size, now=None):
+        """
+        Yield the unconsumed entries, up to batch_size slots at a time. A
+        batch is consumed once the next one is asked for, so one the caller
+        fails to apply is read again next time.
+        """
+        now = now or time.time()
+        last = cache.get(self.key) or 0
+        first = (cache.get(self.flushed_key) or 0) + 1
+        for start in range(first, last + 1, batch_size):
+            numbers = range(start, min(start + batch_size, last + 1))
+            found = cache.get_many([self.slot_key.format(number) for number in numbers])
+            slots = [self.slot_key.format(number)
+                     for number in self._settled(numbers, found, now)]
+            if slots:
+                yield [found[slot] for slot in slots if slot in found]
+                cache.delete_many(slots)
+                cache.set(self.flushed_key, start + len(slots) - 1, timeout=None)
+            if len(slots) < len(numbers):
+                return
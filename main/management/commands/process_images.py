@@ -0,0 +1,20 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from main import images
+from main.tasks import process_image
+
+class Command(BaseCommand):
+    help = 'Queues the uploaded images that have not been processed yet'
+
+    def handle(self, *args, **options):
+        total = 0
+        for label, fields in images.RENDITIONS.items():
+            model = apps.get_model(label)
+            for field in fields:
+                pks = model.objects.exclude(**{field: ''}).exclude(**{field: None})\
+                    .filter(**{field + '_hash': ''}).values_list('pk', flat=True)
+                for pk in pks.iterator():
+                    process_image.delay(label, str(pk), field)
+                    total += 1
+        self.stdout.write(self.style.SUCCESS('Queued {} images'.format(total)))
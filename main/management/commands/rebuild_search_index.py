@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from main import search
+
+class Command(BaseCommand):
+    help = 'Drops and rebuilds the full-text search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of objects indexed per transaction')
+
+    def handle(self, *args, **options):
+        total = search.rebuild(options['batch_size'], stdout=self.stdout)
+        self.stdout.write(
+            self.style.SUCCESS('Indexed {} search documents'.format(total)))
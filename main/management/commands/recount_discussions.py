@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from main.models import Book, BookDiscussion, BookDiscussionComment
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored discussion_count & last_discussed of every book'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of books updated per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        discussions = BookDiscussion.objects.filter(book=OuterRef('pk')).order_by()\
+                        .values('book')
+        discussion_count = discussions.annotate(total=Count('pk')).values('total')
+        discussed = discussions.annotate(last=Max('created')).values('last')
+        commented = BookDiscussionComment.objects\
+                        .filter(discussion__book=OuterRef('pk')).order_by()\
+                        .values('discussion__book').annotate(last=Max('created'))\
+                        .values('last')
+        discussed, commented = Subquery(discussed), Subquery(commented)
+
+        book_ids = list(Book.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(book_ids), batch_size):
+            with transaction.atomic():
+                Book.objects.filter(pk__in=book_ids[start:start + batch_size])\
+                    .update(
+                        discussion_count=Coalesce(
+                            Subquery(discussion_count, output_field=IntegerField()), 0),
+                        #Greatest is NULL on some databases when any argument is NULL
+                        last_discussed=Greatest(Coalesce(discussed, commented),
+                                                Coalesce(commented, discussed)),
+                    )
+        self.stdout.write(
+            self.style.SUCCESS('Recounted discussions for {} books'.format(len(book_ids))))
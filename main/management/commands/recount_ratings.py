@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from main.models import Book, Rating
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored rating_sum & rating_count of every book'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of books updated per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ratings = Rating.objects.filter(book=OuterRef('pk')).order_by()\
+                    .values('book')
+        rating_sum = ratings.annotate(total=Sum('rating')).values('total')
+        rating_count = ratings.annotate(total=Count('pk')).values('total')
+
+        book_ids = list(Book.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(book_ids), batch_size):
+            with transaction.atomic():
+                Book.objects.filter(pk__in=book_ids[start:start + batch_size])\
+                    .update(
+                        rating_sum=Coalesce(
+                            Subquery(rating_sum, output_field=IntegerField()), 0),
+                        rating_count=Coalesce(
+                            Subquery(rating_count, output_field=IntegerField()), 0),
+                    )
+        self.stdout.write(
+            self.style.SUCCESS('Recounted ratings for {} books'.format(len(book_ids))))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from main import reads
+
+class Command(BaseCommand):
+    help = 'Closes expired book club reads and starts the next queued ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fill-ends', action='store_true',
+                            help='first store the end of reads saved without one')
+        parser.add_argument('--batch-size', type=int, default=reads.BATCH_SIZE,
+                            help='number of clubs rotated per transaction')
+
+    def handle(self, *args, **options):
+        if options['fill_ends']:
+            self.stdout.write('Filled the end of {} reads'.format(reads.fill_ends()))
+        closed = reads.rotate(batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS('Closed {} expired reads'.format(closed)))
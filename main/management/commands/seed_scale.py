@@ -0,0 +1,440 @@
+import bisect
+import datetime
+import itertools
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from main import models, search
+
+@contextmanager
+def auto_now_disabled():
+    """Let bulk_create keep the generated created/updated timestamps"""
+    fields = [field for model in apps.get_app_config('main').get_models()
+              for field in model._meta.fields
+              if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+class Skewed:
+    """Zipf-like sampler over range(n): a handful of indices get most picks"""
+
+    def __init__(self, n, skew, rng):
+        self.n = n
+        self.rng = rng
+        self.ranks = list(range(n))
+        rng.shuffle(self.ranks)
+        self.cum_weights = list(itertools.accumulate(
+            1 / (rank ** skew) for rank in range(1, n + 1)))
+
+    def pick(self):
+        x = self.rng.random() * self.cum_weights[-1]
+        return self.ranks[bisect.bisect_left(self.cum_weights, x)]
+
+    def sample(self, k):
+        k = min(k, self.n)
+        picked = set()
+        #fall back to uniform picks when the skew keeps hitting the same items
+        for _ in range(k * 4):
+            if len(picked) == k:
+                break
+            picked.add(self.pick())
+        while len(picked) < k:
+            picked.add(self.rng.randrange(self.n))
+        return picked
+
+class Command(BaseCommand):
+    help = 'Bulk generates a synthetic dataset of the main models for load & scale testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=1,
+                            help='random seed, the same seed generates the same dataset')
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help='multiplier applied to --books, --profiles & --clubs')
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='zipf exponent, higher values make hot books & clubs hotter')
+        parser.add_argument('--days', type=int, default=365,
+                            help='timestamps are spread over this many past days')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--books', type=int, default=1000)
+        parser.add_argument('--profiles', type=int, default=1000)
+        parser.add_argument('--clubs', type=int, default=50)
+        parser.add_argument('--ratings-per-profile', type=int, default=20)
+        parser.add_argument('--reviews-per-profile', type=int, default=3)
+        parser.add_argument('--likes-per-profile', type=int, default=10)
+        parser.add_argument('--review-comments-per-profile', type=int, default=2)
+        parser.add_argument('--clubs-per-profile', type=int, default=2)
+        parser.add_argument('--reads-per-club', type=int, default=6)
+        parser.add_argument('--threads-per-club', type=int, default=3)
+        parser.add_argument('--discussions-per-thread', type=int, default=3)
+        parser.add_argument('--book-discussions', type=int, default=500)
+        parser.add_argument('--comments-per-discussion', type=int, default=8,
+                            help='mean number of comments per book & thread discussion')
+        parser.add_argument('--replies-per-comment', type=int, default=2,
+                            help='mean number of replies per comment')
+        parser.add_argument('--skip-search-index', action='store_true',
+                            help='do not rebuild the search index afterwards')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.seed = options['seed']
+        self.rng = random.Random(self.seed)
+        self.batch_size = options['batch_size']
+        self.now = timezone.now()
+        self.window = datetime.timedelta(days=options['days']).total_seconds()
+        scale = options['scale']
+        n_books = max(1, int(options['books'] * scale))
+        n_profiles = max(1, int(options['profiles'] * scale))
+        n_clubs = max(1, int(options['clubs'] * scale))
+
+        started = time.monotonic()
+        self.roles = {role: models.Role.objects.get_or_create(role=role)[0]
+                      for role, _ in models.Role.ROLES}
+        with auto_now_disabled():
+            books = self.create_books(n_books)
+            profiles = self.create_profiles(n_profiles)
+            self.book_picker = Skewed(len(books), options['skew'], self.rng)
+            self.profile_picker = Skewed(len(profiles), options['skew'], self.rng)
+            self.create_ratings(books, profiles)
+            reviews = self.create_reviews(books, profiles)
+            self.create_likes(reviews, profiles)
+            self.create_review_comments(reviews, profiles)
+            self.create_book_discussions(books, profiles)
+            clubs = self.create_clubs(n_clubs)
+            members = self.create_members(clubs, profiles)
+            self.create_reads(clubs, books)
+            self.create_threads(clubs, members)
+        self.recount()
+        self.stdout.write(self.style.SUCCESS(
+            'Seeded dataset {} in {:.1f}s'.format(self.seed, time.monotonic() - started)))
+
+    #helpers
+    def uuid(self):
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+    def timestamp(self, after=None):
+        """A random past datetime, later than after when given"""
+        start = self.now - datetime.timedelta(seconds=self.window)
+        if after is not None and after > start:
+            start = after
+        span = (self.now - start).total_seconds()
+        return start + datetime.timedelta(seconds=self.rng.random() * span)
+
+    def around(self, mean):
+        return self.rng.randint(0, 2 * mean) if mean else 0
+
+    def bulk_create(self, model, objs):
+        """Insert objs in batches, objs may be any iterable"""
+        started = time.monotonic()
+        count = 0
+        objs = iter(objs)
+        while True:
+            batch = list(itertools.islice(objs, self.batch_size))
+            if not batch:
+                break
+            model.objects.bulk_create(batch)
+            count += len(batch)
+        self.stdout.write('{:>10} {} ({:.1f}s)'.format(
+            count, model._meta.object_name, time.monotonic() - started))
+        return count
+
+    def tag(self, name, i):
+        return 'Seed {} {} {}'.format(self.seed, name, i)
+
+    #generators
+    def create_books(self, n):
+        books = []
+
+        def generate():
+            for i in range(n):
+                created = self.timestamp()
+                book = models.Book(
+                    id=self.uuid(),
+                    isbn='{:04d}{:09d}'.format(self.seed % 10000, i),
+                    title=self.tag('Book', i),
+                    author='Author {}'.format(self.rng.randrange(max(1, n // 5))),
+                    description='Synthetic book {} of dataset {}'.format(i, self.seed),
+                    created=created,
+                    updated=created,
+                )
+                books.append((book.id, book.created))
+                yield book
+        self.bulk_create(models.Book, generate())
+        return books
+
+    def create_profiles(self, n):
+        User = get_user_model()
+        prefix = 'seed{}-'.format(self.seed)
+        profiles = []
+        for start in range(0, n, self.batch_size):
+            names = ['{}{}'.format(prefix, i)
+                     for i in range(start, min(n, start + self.batch_size))]
+            User.objects.bulk_create(
+                [User(username=name, email='{}@example.com'.format(name),
+                      password='!seed') for name in names])
+            user_ids = dict(User.objects.filter(username__in=names)
+                            .values_list('username', 'id'))
+            #in names order, so a seed always gives a user the same profile
+            batch = [models.Profile(id=self.uuid(), user_id=user_ids[name])
+                     for name in names]
+            models.Profile.objects.bulk_create(batch)
+            profiles.extend(profile.id for profile in batch)
+        self.stdout.write('{:>10} Profile'.format(len(profiles)))
+        return profiles
+
+    def create_ratings(self, books, profiles):
+        values = (1, 2, 3, 4, 5)
+        weights = (1, 2, 4, 6, 4)
+
+        def generate():
+            for profile in profiles:
+                for book in self.book_picker.sample(
+                        self.around(self.options['ratings_per_profile'])):
+                    yield models.Rating(
+                        id=self.uuid(),
+                        book_id=books[book][0],
+                        rater_id=profile,
+                        rating=self.rng.choices(values, weights)[0],
+                    )
+        self.bulk_create(models.Rating, generate())
+
+    def create_reviews(self, books, profiles):
+        reviews = []
+
+        def generate():
+            for profile in profiles:
+                for book in self.book_picker.sample(
+                        self.around(self.options['reviews_per_profile'])):
+                    book_id, book_created = books[book]
+                    review = models.Review(
+                        id=self.uuid(),
+                        book_id=book_id,
+                        reviewer_id=profile,
+                        body='Synthetic review of {} '.format(book_id) * 4,
+                        created=self.timestamp(after=book_created),
+                    )
+                    reviews.append(review.id)
+                    yield review
+        self.bulk_create(models.Review, generate())
+        return reviews
+
+    def create_likes(self, reviews, profiles):
+        if not reviews:
+            return
+        review_picker = Skewed(len(reviews), self.options['skew'], self.rng)
+
+        def generate():
+            for profile in profiles:
+                for review in review_picker.sample(
+                        self.around(self.options['likes_per_profile'])):
+                    yield models.Like(
+                        id=self.uuid(),
+                        review_id=reviews[review],
+                        liker_id=profile,
+                        created=self.timestamp(),
+                    )
+        self.bulk_create(models.Like, generate())
+
+    def create_review_comments(self, reviews, profiles):
+        if not reviews:
+            return
+
+        def generate():
+            for profile in profiles:
+                for review in self.rng.sample(
+                        range(len(reviews)),
+                        min(len(reviews), self.around(
+                            self.options['review_comments_per_profile']))):
+                    yield models.ReviewComment(
+                        id=self.uuid(),
+                        review_id=reviews[review],
+                        commentor_id=profile,
+                        body='Synthetic review comment',
+                        created=self.timestamp(),
+                    )
+        self.bulk_create(models.ReviewComment, generate())
+
+    def create_comment_tree(self, discussions, comment_model, reply_model):
+        """Comments & replies for [(discussion id, created, [commentor ids])]"""
+        comments = []
+
+        def generate_comments():
+            for discussion, created, commentors in discussions:
+                for _ in range(self.around(self.options['comments_per_discussion'])):
+                    comment = comment_model(
+                        id=self.uuid(),
+                        discussion_id=discussion,
+                        commentor_id=self.rng.choice(commentors),
+                        body='Synthetic comment',
+                        created=self.timestamp(after=created),
+                    )
+                    comments.append((comment.id, comment.created, commentors))
+                    yield comment
+
+        def generate_replies():
+            for comment, created, commentors in comments:
+                for _ in range(self.around(self.options['replies_per_comment'])):
+                    yield reply_model(
+                        id=self.uuid(),
+                        comment_id=comment,
+                        replier_id=self.rng.choice(commentors),
+                        body='Synthetic reply',
+                        created=self.timestamp(after=created),
+                    )
+        self.bulk_create(comment_model, generate_comments())
+        self.bulk_create(reply_model, generate_replies())
+
+    def create_book_discussions(self, books, profiles):
+        discussions = []
+
+        def generate():
+            for i in range(self.options['book_discussions']):
+                book_id, book_created = books[self.book_picker.pick()]
+                discussion = models.BookDiscussion(
+                    id=self.uuid(),
+                    question=self.tag('Book discussion', i),
+                    book_id=book_id,
+                    starter_id=profiles[self.profile_picker.pick()],
+                    created=self.timestamp(after=book_created),
+                )
+                discussions.append((discussion.id, discussion.created, profiles))
+                yield discussion
+        self.bulk_create(models.BookDiscussion, generate())
+        self.create_comment_tree(
+            discussions, models.BookDiscussionComment, models.BookCommentReply)
+
+    def create_clubs(self, n):
+        clubs = []
+
+        def generate():
+            for i in range(n):
+                created = self.timestamp()
+                club = models.BookClub(
+                    id=self.uuid(),
+                    name=self.tag('Book club', i),
+                    location='Location {}'.format(self.rng.randrange(max(1, n // 10))),
+                    description='Synthetic book club {} of dataset {}'.format(i, self.seed),
+                    created=created,
+                    updated=created,
+                )
+                clubs.append((club.id, club.created))
+                yield club
+        self.bulk_create(models.BookClub, generate())
+        return clubs
+
+    def create_members(self, clubs, profiles):
+        """Returns {club index: [(member id, profile id)]}, founders first"""
+        members = {club: [] for club in range(len(clubs))}
+        club_picker = Skewed(len(clubs), self.options['skew'], self.rng)
+
+        def member(club, profile, role):
+            obj = models.BookClubMember(
+                id=self.uuid(),
+                role=self.roles[role],
+                book_club_id=clubs[club][0],
+                profile_id=profile,
+                created=self.timestamp(after=clubs[club][1]),
+            )
+            members[club].append((obj.id, profile))
+            return obj
+
+        def generate():
+            founders = {}
+            for club in range(len(clubs)):
+                founders[club] = profiles[self.rng.randrange(len(profiles))]
+                yield member(club, founders[club], models.Role.FOUNDER)
+            for profile in profiles:
+                for club in club_picker.sample(
+                        self.around(self.options['clubs_per_profile'])):
+                    if founders[club] == profile:
+                        continue
+                    role = models.Role.ADMIN if self.rng.random() < 0.05\
+                        else models.Role.REGULAR
+                    yield member(club, profile, role)
+        self.bulk_create(models.BookClubMember, generate())
+        return members
+
+    def create_reads(self, clubs, books):
+        def generate():
+            for club_id, club_created in clubs:
+                picked = list(self.book_picker.sample(
+                    self.around(self.options['reads_per_club'])))
+                start = club_created
+                for i, book in enumerate(picked):
+                    start = self.timestamp(after=start)
+                    duration = self.rng.choice((7, 14, 21, 30))
+                    yield models.BookClubRead(
+                        id=self.uuid(),
+                        book_id=books[book][0],
+                        book_club_id=club_id,
+                        current_read=(i == len(picked) - 1),
+                        start_date=start,
+                        read_duration=duration,
+                        end=start + datetime.timedelta(days=duration),
+                    )
+        self.bulk_create(models.BookClubRead, generate())
+
+    def create_threads(self, clubs, members):
+        threads = []
+        discussions = []
+
+        def generate_threads():
+            for club, (club_id, club_created) in enumerate(clubs):
+                for i in range(self.options['threads_per_club']):
+                    thread = models.BookClubThread(
+                        id=self.uuid(),
+                        book_club_id=club_id,
+                        title='General' if i == 0 else 'Thread {}'.format(i),
+                        created=self.timestamp(after=club_created),
+                    )
+                    threads.append((thread.id, thread.created, members[club]))
+                    yield thread
+
+        def generate_discussions():
+            count = itertools.count()
+            for thread, created, club_members in threads:
+                for _ in range(self.options['discussions_per_thread']):
+                    starter, _ = self.rng.choice(club_members)
+                    discussion = models.ThreadDiscussion(
+                        id=self.uuid(),
+                        thread_id=thread,
+                        question=self.tag('Thread discussion', next(count)),
+                        starter_id=starter,
+                        created=self.timestamp(after=created),
+                    )
+                    discussions.append((
+                        discussion.id, discussion.created,
+                        [profile for _, profile in club_members]))
+                    yield discussion
+        self.bulk_create(models.BookClubThread, generate_threads())
+        self.bulk_create(models.ThreadDiscussion, generate_discussions())
+        self.create_comment_tree(
+            discussions, models.ThreadDiscussionComment, models.ThreadCommentReply)
+
+    def recount(self):
+        """bulk_create skips the model hooks maintaining the stored counters"""
+        call_command('recount_ratings', batch_size=self.batch_size,
+                     stdout=self.stdout)
+        call_command('recount_discussions', batch_size=self.batch_size,
+                     stdout=self.stdout)
+        likes = models.Like.objects.filter(review=OuterRef('pk')).order_by()\
+                    .values('review').annotate(total=Count('pk')).values('total')
+        models.Review.objects.update(like_count=Coalesce(
+            Subquery(likes, output_field=IntegerField()), 0))
+        if not self.options['skip_search_index']:
+            search.rebuild(self.batch_size)
@@ -0,0 +1,145 @@
+"""
+Stampede-safe caching of expensive computations.
+
+get_or_compute() keeps a value in CACHES['default'] with the time it took
+to compute. Readers refresh it a little before it expires, with a
+probability growing as expiry nears and with the computation's cost
+(probabilistic early expiration, tuned by beta), so a hot key is usually
+recomputed by a single reader before it lapses. A cache lock lets only one
+process recompute a key at a time: the others keep serving the previous
+value for up to `stale` seconds past its expiry, or wait briefly for the
+new one when there is none. With background=True the lock holder queues the
+refresh_memoized task instead of recomputing in the request.
+
+@memoize(timeout) applies this to functions and model methods, keyed on
+their arguments (model instances by pk).
+"""
+import functools
+import hashlib
+import json
+import logging
+import math
+import random
+import time
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import models
+
+logger = logging.getLogger(__name__)
+
+KEY = 'memo:{}'
+LOCK_KEY = 'memo:{}:lock'
+LOCK_TIMEOUT = 60
+#how long a reader without any value waits for the lock holder's
+WAIT = 5.0
+POLL_INTERVAL = 0.05
+
+#memoized functions by name, for the refresh_memoized task
+registry = {}
+
+def _store(key, value, delta, timeout, stale):
+    cache.set(KEY.format(key), {
+        'value': value,
+        'delta': delta,
+        'expires': time.time() + timeout,
+    }, timeout + stale)
+
+def _compute(key, compute, timeout, stale):
+    started = time.perf_counter()
+    value = compute()
+    _store(key, value, time.perf_counter() - started, timeout, stale)
+    return value
+
+def _fresh(entry, beta, now):
+    #refresh early with a probability growing as expiry nears
+    return now - entry['delta'] * beta * math.log(1 - random.random()) < entry['expires']
+
+def get_or_compute(key, compute, timeout, stale=0, beta=1.0, refresh=None):
+    """
+    The cached value of key, calling compute() when it needs refreshing.
+    refresh, when given, is called instead to refresh it in the background.
+    """
+    entry = cache.get(KEY.format(key))
+    if entry is not None and _fresh(entry, beta, time.time()):
+        return entry['value']
+
+    lock = LOCK_KEY.format(key)
+    if cache.add(lock, 1, LOCK_TIMEOUT):
+        if entry is not None and refresh is not None:
+            try:
+                #released by the task
+                refresh()
+                return entry['value']
+            except Exception:
+                #an unreachable broker, refresh in the request instead
+                logger.exception('Could not queue the refresh of %s', key)
+        try:
+            return _compute(key, compute, timeout, stale)
+        finally:
+            cache.delete(lock)
+
+    #another process is refreshing it
+    if entry is not None:
+        return entry['value']
+    deadline = time.monotonic() + WAIT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(KEY.format(key))
+        if entry is not None:
+            return entry['value']
+    return compute()
+
+def _encode(arg):
+    if isinstance(arg, models.Model):
+        return {'model': arg._meta.label_lower, 'pk': str(arg.pk)}
+    return arg
+
+def _decode(arg):
+    if isinstance(arg, dict) and set(arg) == {'model', 'pk'}:
+        return apps.get_model(arg['model']).objects.get(pk=arg['pk'])
+    return arg
+
+def memoize(timeout, stale=0, beta=1.0, background=False):
+    """
+    Cache the results of a function or model method for timeout seconds.
+    Arguments must be JSON serializable or model instances. The function
+    gets key(*args), invalidate(*args) & refresh(*args).
+    """
+    def decorator(func):
+        name = '{}.{}'.format(func.__module__, func.__qualname__)
+
+        def key(*args):
+            encoded = json.dumps([_encode(arg) for arg in args], sort_keys=True)
+            return '{}:{}'.format(name, hashlib.md5(encoded.encode()).hexdigest())
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            refresh = None
+            if background:
+                def refresh():
+                    from main.tasks import refresh_memoized
+                    refresh_memoized.delay(name, [_encode(arg) for arg in args])
+            return get_or_compute(key(*args), lambda: func(*args), timeout, stale, beta,
+                                  refresh)
+
+        def invalidate(*args):
+            cache.delete(KEY.format(key(*args)))
+
+        def recompute(*args):
+            """Compute & store now, releasing the refresh lock"""
+            try:
+                return _compute(key(*args), lambda: func(*args), timeout, stale)
+            finally:
+                cache.delete(LOCK_KEY.format(key(*args)))
+
+        wrapper.key = key
+        wrapper.invalidate = invalidate
+        wrapper.refresh = recompute
+        registry[name] = wrapper
+        return wrapper
+    return decorator
+
+def refresh(name, args):
+    """Recompute a memoized value, args as encoded by its wrapper"""
+    return registry[name].refresh(*[_decode(arg) for arg in args])
@@ -0,0 +1,151 @@
+"""
+Prometheus metrics, exposed at /metrics.
+
+Web workers count requests and their latency per view, cache hits & misses
+of CACHES['default'] and their open database connections; Celery workers
+count tasks, their run time and the emails sent. Updating a metric is an
+in-memory increment, nothing is sent anywhere on the request path.
+
+Several processes serve the site and run tasks, so set
+PROMETHEUS_MULTIPROC_DIR to a directory shared by all of them (emptied
+before they start, and call mark_process_dead(pid) from the process
+manager's child exit hook): every process then writes its values to mmaped
+files there and the endpoint aggregates them. Celery queue depths are read
+from the broker when scraped.
+"""
+import os
+import time
+
+from celery.signals import task_failure, task_postrun, task_prerun, task_success
+from django.db import connections
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge,
+                               Histogram, REGISTRY, generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+
+from main import cachestats, tieredcache
+
+REQUESTS = Counter(
+    'treehouse_http_requests_total', 'HTTP requests by view, method & status',
+    ['view', 'method', 'status'])
+REQUEST_LATENCY = Histogram(
+    'treehouse_http_request_duration_seconds', 'HTTP request latency by view', ['view'])
+DB_CONNECTIONS = Gauge(
+    'treehouse_db_connections_open', 'Open database connections',
+    multiprocess_mode='livesum')
+CACHE_REQUESTS = Counter(
+    'treehouse_cache_requests_total', "Lookups in CACHES['default'] by result", ['result'])
+TASKS = Counter(
+    'treehouse_celery_tasks_total', 'Finished Celery tasks by name & state',
+    ['task', 'state'])
+TASK_LATENCY = Histogram(
+    'treehouse_celery_task_duration_seconds', 'Celery task run time by name', ['task'])
+EMAILS_SENT = Counter('treehouse_emails_sent_total', 'Emails handed to the mail server')
+LOCAL_CACHE_REQUESTS = Counter(
+    'treehouse_local_cache_requests_total', 'Lookups in the in-process cache tier by result',
+    ['result'])
+
+def _count_cache(hits, misses):
+    if hits:
+        CACHE_REQUESTS.labels('hit').inc(hits)
+    if misses:
+        CACHE_REQUESTS.labels('miss').inc(misses)
+
+cachestats.listeners.append(_count_cache)
+
+def _count_local_cache(hits, misses):
+    if hits:
+        LOCAL_CACHE_REQUESTS.labels('hit').inc(hits)
+    if misses:
+        LOCAL_CACHE_REQUESTS.labels('miss').inc(misses)
+
+tieredcache.listeners.append(_count_local_cache)
+
+class MetricsMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        cachestats.install()
+        started = time.perf_counter()
+        response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name if match else None) or '<unresolved>'
+        REQUESTS.labels(view, request.method, response.status_code).inc()
+        REQUEST_LATENCY.labels(view).observe(elapsed)
+        DB_CONNECTIONS.set(sum(1 for connection in connections.all()
+                               if connection.connection is not None))
+        return response
+
+#Celery workers
+_task_started = {}
+
+@task_prerun.connect
+def _task_prerun(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def _task_postrun(task_id=None, task=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_LATENCY.labels(task.name).observe(time.perf_counter() - started)
+
+@task_success.connect
+def _task_success(sender=None, **kwargs):
+    TASKS.labels(sender.name, 'success').inc()
+
+@task_failure.connect
+def _task_failure(sender=None, **kwargs):
+    TASKS.labels(sender.name, 'failure').inc()
+
+#scrape time
+class CeleryQueueCollector:
+    """Messages waiting in every task queue, asked from the broker"""
+
+    def collect(self):
+        from treehouse.celery import app
+
+        depth = GaugeMetricFamily(
+            'treehouse_celery_queue_depth', 'Messages waiting per Celery queue',
+            labels=['queue'])
+        #there is no broker to ask when tasks run in process
+        if not app.conf.task_always_eager:
+            queues = [queue.name for queue in app.amqp.queues.values()] or \
+                     [app.conf.task_default_queue]
+            #an unreachable broker or missing queue must not fail the scrape
+            try:
+                with app.connection_for_read() as connection:
+                    channel = connection.default_channel
+                    for queue in queues:
+                        try:
+                            size = channel.queue_declare(queue, passive=True).message_count
+                        except Exception:
+                            continue
+                        depth.add_metric([queue], size)
+            except Exception:
+                pass
+        yield depth
+
+class _Forward:
+    """Collects another registry's metrics into a scrape registry"""
+
+    def __init__(self, source):
+        self.source = source
+
+    def collect(self):
+        return self.source.collect()
+
+def registry():
+    registry = CollectorRegistry()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(_Forward(REGISTRY))
+    registry.register(CeleryQueueCollector())
+    return registry
+
+def exposition():
+    """(body, content type) of a scrape"""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
@@ -1,13 +1,39 @@
-from django.db import models
+from django.db import models, transaction
 from django.db.models.aggregates import Sum
 from django.core.validators import RegexValidator, MaxValueValidator
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchVectorField
 from django.db.models.constraints import UniqueConstraint, CheckConstraint
-from django.db.models import Q
+from django.db.models import Q, F, Prefetch
+from django.urls import reverse
+from django.utils import timezone
 import datetime
 import uuid
 import os
 
+from main import counters, roles
+from main.memoize import memoize
+
+def save_without(instance, fields, args, kwargs):
+    """
+    Arguments of a Model.save of instance leaving fields alone: columns kept
+    up to date with F() updates, which a full save would overwrite with the
+    values loaded earlier. Image fields the instance did not change are left
+    alone too, the upload pipeline (main.images) updates them.
+    """
+    from main import images
+
+    if args or instance._state.adding or kwargs.get('force_insert') or \
+            kwargs.get('update_fields') is not None:
+        return kwargs
+    fields = set(fields) | images.untouched(instance)
+    deferred = instance.get_deferred_fields()
+    kwargs['update_fields'] = [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in fields and
+        field.attname not in deferred]
+    return kwargs
+
 class Book(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     isbn = models.CharField(unique=True, max_length=13, validators=[
@@ -16,45 +42,119 @@ class Book(models.Model):
     author = models.CharField(max_length=200)
     description = models.TextField()
     created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    #running rating aggregates, maintained by Rating.save/the post_delete signal
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    #discussion ranking, maintained by BookDiscussion.save/main.signals
+    discussion_count = models.PositiveIntegerField(default=0, editable=False)
+    last_discussed = models.DateTimeField(blank=True, null=True, editable=False)
+    #log of the time-grown activity score, see main.trending
+    trending_score = models.FloatField(blank=True, null=True, editable=False)
 
     class Meta:
         ordering = ['-created']
+        indexes = (
+            #keyset pagination (main.pagination)
+            models.Index(fields=['created', 'id'], name='book_created_id_idx'),
+            #most discussed books (views.BookDiscussionList)
+            models.Index(fields=['-discussion_count', '-last_discussed'],
+                         name='book_discussion_rank_idx'),
+            models.Index(fields=['-trending_score'], name='book_trending_idx'),
+        )
 
     def cover_upload_path(instance, filename):
         _, ext = os.path.splitext(filename)
         return 'book-covers/{}{}'.format(instance.title, ext)
 
     cover = models.ImageField(blank=True, null=True, upload_to=cover_upload_path)
+    #set by the image pipeline (main.images) once the upload is processed
+    cover_hash = models.CharField(max_length=64, blank=True, editable=False)
+    cover_width = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    cover_height = models.PositiveIntegerField(blank=True, null=True, editable=False)
     
+    #maintained with F() updates, see save_without
+    COUNTERS = ('rating_sum', 'rating_count', 'discussion_count', 'last_discussed',
+                'trending_score')
+
     def __str__(self):
         return '{} - {}'.format(
             self.title,
             self.author,
         )
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **save_without(self, self.COUNTERS, args, kwargs))
+
     def get_book_rating(self):
-        ratings = [rating.rating for rating in self.ratings.all()]
         try:
-            rating = sum(ratings) / len(ratings)
-            return rating
+            return self.rating_sum / self.rating_count
         except ZeroDivisionError:
             return 0
 
+    @staticmethod
+    def adjust_rating(book_id, rating_delta, count_delta):
+        """Apply a change to the stored rating aggregates of a book in the db"""
+        Book.objects.filter(pk=book_id).update(
+            rating_sum=F('rating_sum') + rating_delta,
+            rating_count=F('rating_count') + count_delta,
+        )
+
+    @staticmethod
+    def adjust_discussions(book_id, count_delta, activity=None):
+        """Apply a change to the stored discussion count & last activity of a book"""
+        changes = {'discussion_count': F('discussion_count') + count_delta}
+        if activity is not None:
+            changes['last_discussed'] = activity
+        Book.objects.filter(pk=book_id).update(**changes)
+
+    @staticmethod
+    @memoize(60, stale=60 * 10, background=True)
+    def most_discussed(limit):
+        """The limit most discussed books with their discussions & starters"""
+        discussions = BookDiscussion.objects.select_related('starter__user')
+        return list(Book.objects
+                    .filter(discussion_count__gt=0)
+                    .order_by('-discussion_count', '-last_discussed')
+                    .prefetch_related(Prefetch('discussions', queryset=discussions))[:limit])
+
 class Review(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='reviews')
     reviewer = models.ForeignKey('Profile', on_delete=models.CASCADE, related_name='reviews')
     body = models.TextField()
     created = models.DateTimeField(auto_now=True)
+    #flushed like count, pending likes are buffered in the cache (main.counters)
+    like_count = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ['-created']
+        indexes = (
+            models.Index(fields=['created', 'id'], name='review_created_id_idx'),
+        )
     
+    #maintained with F() updates, see save_without
+    COUNTERS = ('like_count',)
+
     def __str__(self):
         return self.body[:20] + '...'
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **save_without(self, self.COUNTERS, args, kwargs))
     
     def get_likes(self):
-        return self.likes.count()
+        if not hasattr(self, '_pending_likes'):
+            Review.attach_pending_likes([self])
+        return self.like_count + self._pending_likes
+
+    @staticmethod
+    def attach_pending_likes(reviews):
+        """Fetch the buffered likes of several reviews in one cache lookup"""
+        reviews = list(reviews)
+        pending = counters.pending_likes([review.pk for review in reviews])
+        for review in reviews:
+            review._pending_likes = pending[review.pk]
+        return reviews
     
 class ReviewComment(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -91,6 +191,35 @@ class Rating(models.Model):
             self.book.title,
             self.rating
         )
+
+    def save(self, *args, **kwargs):
+        #keep Book.rating_sum/rating_count in step with this row
+        with transaction.atomic():
+            previous = None
+            if not self._state.adding:
+                previous = Rating.objects.select_for_update()\
+                            .filter(pk=self.pk)\
+                            .values_list('book_id', 'rating').first()
+            super().save(*args, **kwargs)
+            if previous is None:
+                Book.adjust_rating(self.book_id, self.rating, 1)
+            elif previous[0] != self.book_id:
+                Book.adjust_rating(previous[0], -previous[1], -1)
+                Book.adjust_rating(self.book_id, self.rating, 1)
+            elif previous[1] != self.rating:
+                Book.adjust_rating(self.book_id, self.rating - previous[1], 0)
+            else:
+                return
+        self.refresh_book_rating()
+
+    def refresh_book_rating(self):
+        """Reload the aggregates on an already fetched book instance"""
+        if Rating.book.is_cached(self):
+            try:
+                self.book.refresh_from_db(fields=['rating_sum', 'rating_count'])
+            except Book.DoesNotExist:
+                #the book itself is being deleted
+                pass
         
 class Profile(models.Model):
     
@@ -98,15 +227,22 @@ class Profile(models.Model):
         name, ext = os.path.splitext(filename)
         return '{}/{}'.format(
             instance.user.username,
-            uuid.uuid4 + ext,
+            uuid.uuid4().hex + ext,
         )
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE)
     avatar = models.ImageField(upload_to=avatar_upload_path, blank=True, null=True)
+    #set by the image pipeline (main.images) once the upload is processed
+    avatar_hash = models.CharField(max_length=64, blank=True, editable=False)
+    avatar_width = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    avatar_height = models.PositiveIntegerField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return self.user.username
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **save_without(self, (), args, kwargs))
     
 class Role(models.Model):
 
@@ -140,10 +276,19 @@ class BookClub(models.Model):
     location = models.CharField(max_length=200)
     description = models.TextField()
     logo = models.ImageField(blank=True, null=True, upload_to=logo_upload_path)
+    #set by the image pipeline (main.images) once the upload is processed
+    logo_hash = models.CharField(max_length=64, blank=True, editable=False)
+    logo_width = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    logo_height = models.PositiveIntegerField(blank=True, null=True, editable=False)
     members = models.ManyToManyField(Profile, through='BookClubMember', related_name='book_clubs')
     reads = models.ManyToManyField(Book, through='BookClubRead', related_name='book_clubs')
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = (
+            models.Index(fields=['created', 'id'], name='book_club_created_id_idx'),
+        )
     
     def __str__(self):
         return '{} - {}'.format(
@@ -152,20 +297,73 @@ class BookClub(models.Model):
         )
     
     def current_read(self):
-        read = BookClubRead.objects.get(book_club=self,current_read=True)
-        return read.book
+        """The book currently read by the club or None, looked up once per instance"""
+        if not hasattr(self, '_current_read'):
+            read = BookClubRead.objects.select_related('book')\
+                    .filter(book_club=self, current_read=True).first()
+            self._current_read = read.book if read else None
+        return self._current_read
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **save_without(self, (), args, kwargs))
+
+    @staticmethod
+    def invalidate_leaders(**members):
+        """
+        Drop the memoized leaders of the clubs led by the members matching
+        the filter, e.g. profile=pk, when their profile or user changes
+        """
+        clubs = [BookClub(pk=pk) for pk in BookClubMember.objects
+                 .filter(role__role__in=[Role.FOUNDER, Role.ADMIN], **members)
+                 .values_list('book_club_id', flat=True).distinct()]
+        for club in clubs:
+            BookClub.leaders.invalidate(club)
+        return clubs
+
+    #holds the leaders' profiles & users, see invalidate_leaders
+    @memoize(60 * 5, stale=60)
+    def leaders(self):
+        """{Role.FOUNDER: [profiles], Role.ADMIN: [profiles]} of the club, in one query"""
+        founder, admin = roles.get(Role.FOUNDER), roles.get(Role.ADMIN)
+        members = BookClubMember.objects\
+                    .filter(book_club=self, role__in=[
+                        role for role in (founder, admin) if role is not None])\
+                    .select_related('profile__user')\
+                    .order_by('created')
+        by_role = {Role.FOUNDER: [], Role.ADMIN: []}
+        for member in members:
+            #None for a role deleted meanwhile
+            role = roles.get_by_id(member.role_id)
+            if role is not None:
+                by_role[role.role].append(member.profile)
+        return by_role
     
+    def get_role(self, profile):
+        """The Role of profile in this club or None, memoized per instance"""
+        memo = self.__dict__.setdefault('_member_roles', {})
+        if profile.pk not in memo:
+            role_ids = BookClubMember.objects\
+                        .filter(book_club=self, profile=profile)\
+                        .values_list('role_id', flat=True)
+            member_roles = [roles.get_by_id(role_id) for role_id in role_ids]
+            #the most privileged role wins, Role.FOUNDER being the lowest value
+            memo[profile.pk] = min(
+                (role for role in member_roles if role is not None),
+                key=lambda role: role.role, default=None)
+        return memo[profile.pk]
+
+    def has_role(self, profile, value):
+        role = self.get_role(profile)
+        return role is not None and role.role == value
+
     def is_founder(self, profile):
-        role = Role.objects.get(role=Role.FOUNDER)
-        return BookClubMember.objects.filter(profile=profile, role=role).exists()
+        return self.has_role(profile, Role.FOUNDER)
     
     def is_admin(self, profile):
-        role = Role.objects.get(role=Role.ADMIN)
-        return BookClubMember.objects.filter(profile=profile, role=role).exists()
+        return self.has_role(profile, Role.ADMIN)
     
     def is_regular(self, profile):
-        role = Role.objects.get(role=Role.REGULAR)
-        return BookClubMember.objects.filter(profile=profile, role=role).exists()
+        return self.has_role(profile, Role.REGULAR)
         
 class BookClubMember(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -174,6 +372,12 @@ class BookClubMember(models.Model):
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='book_club_members')
     created = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = (
+            #BookClub.get_role
+            models.Index(fields=['book_club', 'profile'], name='book_club_member_idx'),
+        )
+
     def __str__(self):
         return '{}: {}'.format(self.profile, self.book_club)
     
@@ -182,9 +386,14 @@ class BookClubRead(models.Model):
     book = models.ForeignKey(Book, related_name='book_club_reads', on_delete=models.CASCADE)
     book_club = models.ForeignKey(BookClub, related_name='book_club_reads', on_delete=models.CASCADE)
     current_read = models.BooleanField(default=True)
-    start_date = models.DateTimeField(auto_now_add=True)
+    #set when a queued read starts, see main.reads
+    start_date = models.DateTimeField(default=timezone.now, editable=False)
     #stipulated time for the read (in days)
     read_duration = models.PositiveIntegerField()
+    #start_date + read_duration, stored for the expiry scan; None while queued
+    end = models.DateTimeField(blank=True, null=True, editable=False)
+    #reads waiting to start, lowest first
+    queue_position = models.PositiveIntegerField(blank=True, null=True)
     
     class Meta:
         constraints = (
@@ -193,7 +402,19 @@ class BookClubRead(models.Model):
                              condition=Q(current_read=True)),
         )
         ordering = ['-start_date']
+        indexes = (
+            models.Index(fields=['current_read', 'end'], name='book_club_read_expiry_idx'),
+            models.Index(fields=['book_club', 'queue_position'],
+                         name='book_club_read_queue_idx'),
+        )
     
+    def save(self, *args, **kwargs):
+        if self.queue_position is not None:
+            #waiting reads are never current, whatever the default
+            self.current_read = False
+        self.end = None if self.queue_position is not None else self.end_date()
+        super().save(*args, **kwargs)
+
     def end_date(self):
         duration = datetime.timedelta(days=self.read_duration)
         return self.start_date + duration
@@ -214,6 +435,21 @@ class BookDiscussion(models.Model):
         return '{} : {}'.format(
             self.book,
             self.question)
+
+    def save(self, *args, **kwargs):
+        #keep Book.discussion_count/last_discussed in step with this row
+        with transaction.atomic():
+            previous = None
+            if not self._state.adding:
+                previous = BookDiscussion.objects.select_for_update()\
+                            .filter(pk=self.pk)\
+                            .values_list('book_id', flat=True).first()
+            super().save(*args, **kwargs)
+            if previous is None:
+                Book.adjust_discussions(self.book_id, 1, self.created)
+            elif previous != self.book_id:
+                Book.adjust_discussions(previous, -1)
+                Book.adjust_discussions(self.book_id, 1, self.created)
     
 class BookDiscussionComment(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -224,6 +460,12 @@ class BookDiscussionComment(models.Model):
     body = models.TextField()
     created = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = (
+            #comment tree pages (main.comments)
+            models.Index(fields=['discussion', 'created', 'id'], name='book_comment_tree_idx'),
+        )
+
     def __str__(self):
         return self.body[:60] + '...'
         
@@ -235,6 +477,12 @@ class BookCommentReply(models.Model):
     replier = models.ForeignKey(Profile, on_delete=models.PROTECT, 
                                 related_name='book_comments_replies')
     created = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = (
+            #comment tree pages (main.comments)
+            models.Index(fields=['comment', 'created', 'id'], name='book_reply_tree_idx'),
+        )
     
 ####thread discussion
 class BookClubThread(models.Model):
@@ -246,6 +494,11 @@ class BookClubThread(models.Model):
 
     class Meta:
         ordering = ['-created']
+        indexes = (
+            #a club's thread pages (main.pagination)
+            models.Index(fields=['book_club', 'created', 'id'],
+                         name='thread_club_created_id_idx'),
+        )
 
     def __str__(self):
         return '{} - {}'.format(
@@ -275,6 +528,12 @@ class ThreadDiscussionComment(models.Model):
                                   related_name='thread_discussions_comments')
     body = models.TextField()
     created = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = (
+            #comment tree pages (main.comments)
+            models.Index(fields=['discussion', 'created', 'id'], name='thread_comment_tree_idx'),
+        )
     
 class ThreadCommentReply(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -283,4 +542,80 @@ class ThreadCommentReply(models.Model):
     body = models.TextField()
     replier = models.ForeignKey(Profile, on_delete=models.PROTECT, 
                                 related_name='thread_comments_replies')
-    created = models.DateTimeField(auto_now=True)
\ No newline at end of file
+    created = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = (
+            #comment tree pages (main.comments)
+            models.Index(fields=['comment', 'created', 'id'], name='thread_reply_tree_idx'),
+        )
+
+####recommendations (see main.recommendations)
+class BookRecommendation(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['rank']
+        unique_together = ['book', 'rank']
+
+    def __str__(self):
+        return '{} -> {}'.format(self.book_id, self.recommended_id)
+
+####search (see main.search)
+class SearchDocument(models.Model):
+    KINDS = (
+        ('book', 'Book'),
+        ('review', 'Review'),
+        ('book_discussion', 'Book discussion'),
+        ('thread_discussion', 'Thread discussion'),
+    )
+    URL_NAMES = {
+        'book': 'book_detail',
+        'review': 'review_detail',
+        'book_discussion': 'book_discussion_detail',
+        'thread_discussion': 'thread_discussion_detail',
+    }
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=20, choices=KINDS)
+    object_id = models.UUIDField()
+    title = models.CharField(max_length=200)
+    body = models.TextField()
+
+    class Meta:
+        unique_together = ['kind', 'object_id']
+
+    def __str__(self):
+        return '{}: {}'.format(self.get_kind_display(), self.title)
+
+    def get_absolute_url(self):
+        return reverse(self.URL_NAMES[self.kind], kwargs={'pk': self.object_id})
+
+class SearchVector(models.Model):
+    """
+    tsvector of a SearchDocument, PostgreSQL only: the table and its GIN index
+    are created by main.search.create_native_index, rows are deleted with
+    their document by the database
+    """
+    document = models.OneToOneField(SearchDocument, primary_key=True,
+                                    on_delete=models.DO_NOTHING, related_name='native')
+    vector = SearchVectorField()
+
+    class Meta:
+        managed = False
+
+class SearchPosting(models.Model):
+    """Inverted index entry, used when the database has no full-text search"""
+    document = models.ForeignKey(SearchDocument, on_delete=models.CASCADE,
+                                 related_name='postings')
+    term = models.CharField(max_length=64)
+    weight = models.FloatField()
+
+    class Meta:
+        indexes = (
+            models.Index(fields=['term', 'document'], name='search_posting_term_idx'),
+        )
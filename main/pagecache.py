@@ -0,0 +1,149 @@
+"""
+Full-page cache for anonymous visitors.
+
+Views opt in with CachedPageMixin and declare the tags their pages depend
+on, e.g. 'book:{pk}'. A cached page is stored with the version of each of
+its tags at the time it was rendered and is only served while they are all
+unchanged, so a page is looked up with one get_many and invalidating a tag
+is a single set, whatever the number of pages depending on it. Tags are
+bumped by the model signals (main.signals, through tags_for) and by the code
+updating rows in bulk.
+"""
+import hashlib
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+
+from main import models
+
+PAGE_KEY = 'pagecache:page:{}'
+TAG_KEY = 'pagecache:tag:{}'
+#request headers the pages may vary on
+VARY_HEADERS = ('HTTP_ACCEPT_LANGUAGE',)
+#response headers kept with a cached page
+HEADERS = ('Content-Type', 'Content-Language', 'Vary')
+
+BOOKS = 'books'
+REVIEWS = 'reviews'
+PROFILES = 'profiles'
+RECOMMENDATIONS = 'recommendations'
+#formatted with pk=
+BOOK = 'book:{pk}'
+BOOK_CLUB = 'book_club:{pk}'
+
+#the page being rendered by this thread
+_current = threading.local()
+
+def invalidate(*tags):
+    cache.set_many({TAG_KEY.format(tag): uuid.uuid4().hex for tag in tags}, timeout=None)
+
+def incomplete():
+    """Keep the page being rendered out of the cache, e.g. it has placeholders"""
+    _current.incomplete = True
+
+def tags_for(instance, update_fields=None):
+    """Tags of the pages showing instance"""
+    if isinstance(instance, models.Book):
+        clubs = models.BookClubRead.objects\
+            .filter(book=instance.pk, current_read=True)\
+            .values_list('book_club_id', flat=True)
+        return [BOOKS, REVIEWS, BOOK.format(pk=instance.pk)] + \
+               [BOOK_CLUB.format(pk=club_id) for club_id in clubs]
+    if isinstance(instance, models.Review):
+        return [REVIEWS, BOOK.format(pk=instance.book_id)]
+    if isinstance(instance, models.Rating):
+        return [BOOKS, BOOK.format(pk=instance.book_id)]
+    if isinstance(instance, models.Like):
+        books = models.Review.objects.filter(pk=instance.review_id)\
+            .values_list('book_id', flat=True)
+        return [REVIEWS] + [BOOK.format(pk=book_id) for book_id in books]
+    if isinstance(instance, models.BookClub):
+        return [BOOK_CLUB.format(pk=instance.pk)]
+    if isinstance(instance, (models.BookClubMember, models.BookClubRead)):
+        return [BOOK_CLUB.format(pk=instance.book_club_id)]
+    if isinstance(instance, models.Profile):
+        return [PROFILES]
+    if isinstance(instance, get_user_model()):
+        #logging in only saves last_login
+        if update_fields and set(update_fields) <= {'last_login'}:
+            return []
+        return [PROFILES]
+    return []
+
+#post_save & post_delete receiver
+def invalidate_instance(sender, instance, update_fields=None, **kwargs):
+    tags = tags_for(instance, update_fields)
+    if tags:
+        invalidate(*tags)
+        #again once committed, pages rendered from the old rows meanwhile
+        #were stored with the new versions
+        transaction.on_commit(lambda: invalidate(*tags))
+
+def _cacheable(request):
+    return request.method in ('GET', 'HEAD') and \
+        not request.user.is_authenticated and \
+        CookieStorage.cookie_name not in request.COOKIES
+
+def page_key(request):
+    variant = '\n'.join([request.build_absolute_uri()] +
+                        [request.META.get(header, '') for header in VARY_HEADERS])
+    return PAGE_KEY.format(hashlib.sha1(variant.encode()).hexdigest())
+
+def _versions(tags, found):
+    """{tag: version}, creating the versions of new tags"""
+    versions = {}
+    for tag in tags:
+        key = TAG_KEY.format(tag)
+        version = found.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(key)
+        versions[tag] = version
+    return versions
+
+class CachedPageMixin:
+    """Serve the view's pages to anonymous visitors from the cache"""
+    #tags of the pages, formatted with the url kwargs
+    page_tags = ()
+
+    def dispatch(self, request, *args, **kwargs):
+        if not settings.PAGE_CACHE_TIMEOUT or not _cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        tags = [tag.format(**kwargs) for tag in self.page_tags]
+        key = page_key(request)
+        found = cache.get_many([key] + [TAG_KEY.format(tag) for tag in tags])
+        page = found.get(key)
+        versions = _versions(tags, found)
+        if page is not None and page['versions'] == versions:
+            response = HttpResponse(page['content'], status=page['status'])
+            for header, value in page['headers'].items():
+                response[header] = value
+            return response
+
+        _current.incomplete = False
+        response = super().dispatch(request, *args, **kwargs)
+
+        def store(response):
+            if response.status_code == 200 and not response.cookies and \
+                    not getattr(_current, 'incomplete', False):
+                cache.set(key, {
+                    'versions': versions,
+                    'status': response.status_code,
+                    'content': response.content,
+                    'headers': {header: response[header] for header in HEADERS
+                                if response.has_header(header)},
+                }, settings.PAGE_CACHE_TIMEOUT)
+            _current.incomplete = False
+
+        if getattr(response, 'is_rendered', True):
+            store(response)
+        else:
+            response.add_post_render_callback(store)
+        return response
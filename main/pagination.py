@@ -0,0 +1,106 @@
+"""
+Keyset (cursor) pagination on (created, id).
+
+Pages are fetched with a range condition on the composite (created, id)
+index instead of an OFFSET, so any page costs the same as the first one.
+Cursors are opaque url-safe tokens of the boundary row's key.
+"""
+import base64
+import uuid
+
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+def encode_cursor(obj, direction):
+    raw = '{}|{}|{}'.format(direction, obj.created.isoformat(), obj.pk)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Return (direction, created, id) or raise ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        direction, created, pk = raw.split('|')
+        created = parse_datetime(created)
+        pk = uuid.UUID(pk)
+    except (TypeError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+    if direction not in (NEXT, PREVIOUS) or created is None:
+        raise ValueError('Invalid cursor')
+    return direction, created, pk
+
+class KeysetPage:
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        if self.has_next():
+            return encode_cursor(self.object_list[-1], NEXT)
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous():
+            return encode_cursor(self.object_list[0], PREVIOUS)
+
+def paginate(queryset, page_size, cursor=None, ascending=False):
+    """
+    Return the KeysetPage of queryset following cursor, newest first unless
+    ascending
+    """
+    if ascending:
+        queryset = queryset.order_by('created', 'id')
+    else:
+        queryset = queryset.order_by('-created', '-id')
+    if not cursor:
+        rows = list(queryset[:page_size + 1])
+        return KeysetPage(rows[:page_size], len(rows) > page_size, False)
+
+    direction, created, pk = decode_cursor(cursor)
+    #the OR alone is no range bound on the (created, id) index, the first term is
+    older = Q(created__lte=created) & (Q(created__lt=created) | Q(id__lt=pk))
+    newer = Q(created__gte=created) & (Q(created__gt=created) | Q(id__gt=pk))
+    following, preceding = (newer, older) if ascending else (older, newer)
+    if direction == NEXT:
+        rows = list(queryset.filter(following)[:page_size + 1])
+        return KeysetPage(rows[:page_size], len(rows) > page_size, True)
+
+    rows = list(queryset.filter(preceding).reverse()[:page_size + 1])
+    has_previous = len(rows) > page_size
+    return KeysetPage(rows[:page_size][::-1], True, has_previous)
+
+class KeysetPaginationMixin:
+    """ListView mixin replacing page numbers with ?cursor= tokens"""
+    paginate_by = 20
+    cursor_kwarg = 'cursor'
+    ascending = False
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        try:
+            page = paginate(queryset, page_size, cursor, self.ascending)
+        except ValueError:
+            raise Http404('Invalid cursor')
+        return (None, page, page.object_list, page.has_other_pages())
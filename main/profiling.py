@@ -0,0 +1,236 @@
+"""
+Request profiling.
+
+ProfilingMiddleware measures a sample of the requests (PROFILING_SAMPLE_RATE,
+0 to turn it off): SQL query count and time, template render time, cache
+hits and misses of CACHES['default'] and the total time. The measurements are
+sent back in a Server-Timing header and recorded per url name into rolling
+log-bucketed histograms, kept in process and published to the cache every
+PUBLISH_INTERVAL seconds so stats() can merge every worker's.
+"""
+import bisect
+import math
+import os
+import random
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from main import cachestats
+
+#histogram bucket upper bounds, 25% apart from 0.1 to ~100000
+BUCKETS = [0.1 * 1.25 ** i for i in range(63)]
+METRICS = ('total_ms', 'db_ms', 'render_ms', 'queries')
+PERCENTILES = (50, 95, 99)
+#the rolling window is SLICES slices of WINDOW / SLICES seconds
+WINDOW = 60 * 10
+SLICES = 10
+PUBLISH_INTERVAL = 10
+PROCESSES_KEY = 'profiling:processes'
+PROCESS_KEY = 'profiling:process:{}'
+
+class Histogram:
+
+    def __init__(self, counts=None):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile"""
+        rank = math.ceil(self.total * q / 100)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else math.inf
+        return None
+
+class Recorder:
+    """Per url name rolling histograms of the current process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #{slice number: {url name: {metric: Histogram, 'cache_hits': n, ...}}}
+        self.slices = {}
+        self.published = 0
+
+    def record(self, name, sample, now=None):
+        now = now or time.time()
+        current = int(now // (WINDOW / SLICES))
+        with self.lock:
+            if current not in self.slices:
+                for stale in [n for n in self.slices if n <= current - SLICES]:
+                    del self.slices[stale]
+                self.slices[current] = {}
+            stats = self.slices[current].setdefault(name, _empty())
+            for metric in METRICS:
+                stats[metric].record(sample[metric])
+            stats['cache_hits'] += sample['cache_hits']
+            stats['cache_misses'] += sample['cache_misses']
+            publish = now - self.published >= PUBLISH_INTERVAL
+            if publish:
+                self.published = now
+        if publish:
+            self.publish()
+
+    def snapshot(self):
+        """{slice number: {url name: stats}} with the histogram counts as lists"""
+        with self.lock:
+            return {
+                number: {name: {key: list(value.counts) if isinstance(value, Histogram) else value
+                                for key, value in stats.items()}
+                         for name, stats in names.items()}
+                for number, names in self.slices.items()}
+
+    def publish(self):
+        cache = caches['default']
+        key = PROCESS_KEY.format(os.getpid())
+        cache.set(key, self.snapshot(), WINDOW)
+        processes = cache.get(PROCESSES_KEY) or []
+        if key not in processes:
+            cache.set(PROCESSES_KEY, processes[-99:] + [key], None)
+
+    def reset(self):
+        with self.lock:
+            self.slices = {}
+            self.published = 0
+
+recorder = Recorder()
+
+def _empty():
+    stats = {metric: Histogram() for metric in METRICS}
+    stats['cache_hits'] = stats['cache_misses'] = 0
+    return stats
+
+def stats(now=None):
+    """
+    {url name: {'requests': n, metric: {'p50': ..., 'p95': ...}, 'cache_hits': n,
+    'cache_misses': n}} over the window, merged from every published process
+    """
+    now = now or time.time()
+    oldest = int(now // (WINDOW / SLICES)) - SLICES + 1
+    cache = caches['default']
+    own = PROCESS_KEY.format(os.getpid())
+    #the current process' data may be newer than its published copy
+    snapshots = [snapshot for key, snapshot in
+                 cache.get_many(cache.get(PROCESSES_KEY) or []).items() if key != own]
+    snapshots.append(recorder.snapshot())
+
+    merged = {}
+    for snapshot in snapshots:
+        for number, names in snapshot.items():
+            if number < oldest:
+                continue
+            for name, sample in names.items():
+                stats = merged.setdefault(name, _empty())
+                for metric in METRICS:
+                    stats[metric].merge(Histogram(sample[metric]))
+                stats['cache_hits'] += sample['cache_hits']
+                stats['cache_misses'] += sample['cache_misses']
+
+    return {name: dict(
+                {metric: {'p{}'.format(q): stats[metric].percentile(q) for q in PERCENTILES}
+                 for metric in METRICS},
+                requests=stats['total_ms'].total,
+                cache_hits=stats['cache_hits'],
+                cache_misses=stats['cache_misses'])
+            for name, stats in sorted(merged.items())}
+
+class _Sample:
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.render = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += time.perf_counter() - started
+            self.queries += 1
+
+    def count_cache(self, hits, misses):
+        self.cache_hits += hits
+        self.cache_misses += misses
+
+#the sample of the request being handled by this thread
+_current = threading.local()
+
+def _count_cache(hits, misses):
+    sample = getattr(_current, 'sample', None)
+    if sample is not None:
+        sample.count_cache(hits, misses)
+
+cachestats.listeners.append(_count_cache)
+
+def server_timing(sample):
+    return ', '.join((
+        'db;desc="{} queries";dur={:.1f}'.format(sample['queries'], sample['db_ms']),
+        'render;dur={:.1f}'.format(sample['render_ms']),
+        'cache;desc="{} hits, {} misses"'.format(sample['cache_hits'], sample['cache_misses']),
+        'total;dur={:.1f}'.format(sample['total_ms']),
+    ))
+
+class ProfilingMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        rate = settings.PROFILING_SAMPLE_RATE
+        if not rate or random.random() >= rate:
+            return self.get_response(request)
+
+        sample = request._profiling_sample = _current.sample = _Sample()
+        cachestats.install()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(sample.execute))
+                response = self.get_response(request)
+        finally:
+            _current.sample = None
+        total = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        name = (match.view_name if match else None) or '<unresolved>'
+        measured = {
+            'total_ms': total * 1000,
+            'db_ms': sample.db * 1000,
+            'render_ms': sample.render * 1000,
+            'queries': sample.queries,
+            'cache_hits': sample.cache_hits,
+            'cache_misses': sample.cache_misses,
+        }
+        response['Server-Timing'] = server_timing(measured)
+        recorder.record(name, measured)
+        return response
+
+    def process_template_response(self, request, response):
+        sample = getattr(request, '_profiling_sample', None)
+        if sample is not None:
+            #TemplateResponses are rendered right after this hook
+            started = time.perf_counter()
+
+            def rendered(response):
+                sample.render += time.perf_counter() - started
+            response.add_post_render_callback(rendered)
+        return response
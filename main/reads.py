@@ -0,0 +1,71 @@
+"""
+Rotation of expired book club reads.
+
+BookClubRead.end is stored and indexed with current_read, so the expired
+current reads are found with one range scan. rotate() closes them and starts
+each club's next queued read (lowest queue_position) in set-based UPDATEs, a
+handful of queries per batch of clubs: old reads are closed before new ones
+are started, so single_active_book_club_read holds throughout.
+"""
+import datetime
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from main import models, pagecache
+
+BATCH_SIZE = 1000
+
+def _start(reads, now):
+    """Make the queued reads [(pk, read_duration)] current from now"""
+    by_duration = {}
+    for pk, duration in reads:
+        by_duration.setdefault(duration, []).append(pk)
+    #end depends on the duration, one UPDATE per distinct duration
+    for duration, pks in sorted(by_duration.items()):
+        models.BookClubRead.objects.filter(pk__in=pks)\
+            .update(current_read=True, queue_position=None, start_date=now,
+                    end=now + datetime.timedelta(days=duration))
+
+def rotate(now=None, batch_size=BATCH_SIZE):
+    """Close expired reads & start the next queued ones, returns reads closed"""
+    now = now or timezone.now()
+    closed = 0
+    while True:
+        with transaction.atomic():
+            expired = list(models.BookClubRead.objects
+                           .select_for_update()
+                           .filter(current_read=True, end__lte=now)
+                           .order_by('end')
+                           .values_list('pk', 'book_club_id')[:batch_size])
+            if not expired:
+                return closed
+            clubs = [club_id for _, club_id in expired]
+            models.BookClubRead.objects\
+                .filter(pk__in=[pk for pk, _ in expired])\
+                .update(current_read=False)
+            following = models.BookClubRead.objects\
+                .filter(book_club=OuterRef('book_club'), queue_position__isnull=False)\
+                .order_by('queue_position', 'id')\
+                .values('pk')[:1]
+            next_reads = list(models.BookClubRead.objects
+                              .filter(book_club__in=clubs, pk__in=Subquery(following))
+                              .order_by()
+                              .values_list('pk', 'read_duration'))
+            if next_reads:
+                _start(next_reads, now)
+        pagecache.invalidate(*{pagecache.BOOK_CLUB.format(pk=club_id) for club_id in clubs})
+        closed += len(expired)
+        if len(expired) < batch_size:
+            return closed
+
+def fill_ends():
+    """Store the end of started reads saved without one, returns reads updated"""
+    updated = 0
+    missing = models.BookClubRead.objects.filter(end__isnull=True,
+                                                 queue_position__isnull=True)
+    for duration in sorted(set(missing.values_list('read_duration', flat=True))):
+        updated += missing.filter(read_duration=duration)\
+            .update(end=F('start_date') + datetime.timedelta(days=duration))
+    return updated
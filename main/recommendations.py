@@ -0,0 +1,122 @@
+"""
+Item-item book recommendations from club co-reads and member ratings.
+
+Books are rows of a sparse matrix whose columns are book clubs (a club read
+counts CLUB_READ_WEIGHT) and profiles (a rating counts rating / 5). With the
+rows L2-normalized, the cosine similarity of every pair of books is a
+sparse matrix product; it is computed BLOCK_SIZE rows at a time so memory
+stays bounded, and the TOP_K most similar books of each book are stored as
+BookRecommendation rows. The compute_recommendations task runs
+it periodically, pages only read the stored rows.
+"""
+import numpy as np
+from scipy import sparse
+
+from django.db import transaction
+
+from main import models, pagecache
+
+TOP_K = 10
+CLUB_READ_WEIGHT = 1.0
+MAX_RATING = 5.0
+BLOCK_SIZE = 2000
+#similarities computed from fewer shared columns are damped towards 0
+SHRINKAGE = 2.0
+
+def _matrix(book_index):
+    """
+    Sparse books x (clubs + profiles) interaction matrix, reads & ratings of
+    books added since book_index was listed wait for the next run
+    """
+    rows, cols, values = [], [], []
+    columns = {}
+
+    def column(key):
+        return columns.setdefault(key, len(columns))
+
+    for book_id, club_id in models.BookClubRead.objects\
+            .values_list('book_id', 'book_club_id').iterator():
+        if book_id not in book_index:
+            continue
+        rows.append(book_index[book_id])
+        cols.append(column(('club', club_id)))
+        values.append(CLUB_READ_WEIGHT)
+    for book_id, rater_id, rating in models.Rating.objects\
+            .values_list('book_id', 'rater_id', 'rating').iterator():
+        if book_id not in book_index:
+            continue
+        rows.append(book_index[book_id])
+        cols.append(column(('profile', rater_id)))
+        values.append(rating / MAX_RATING)
+
+    matrix = sparse.csr_matrix(
+        (np.array(values, dtype=np.float64), (rows, cols)),
+        shape=(len(book_index), max(len(columns), 1)))
+    #a club reading a book twice still counts once
+    matrix.data = np.minimum(matrix.data, CLUB_READ_WEIGHT)
+    return matrix
+
+def _normalize(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+def _shrink(similarities, support):
+    """Damp similarities by shared / (shared + SHRINKAGE), in place"""
+    #both products of non-negative matrices share one sparsity pattern
+    similarities.sort_indices()
+    support.sort_indices()
+    similarities.data *= support.data / (support.data + SHRINKAGE)
+    return similarities
+
+def _top_k(similarities, offset, k):
+    """[(row, [(column, score)])] of the k best columns of each block row"""
+    results = []
+    for i in range(similarities.shape[0]):
+        start, end = similarities.indptr[i], similarities.indptr[i + 1]
+        columns = similarities.indices[start:end]
+        scores = similarities.data[start:end]
+        keep = (columns != offset + i) & (scores > 0)
+        columns, scores = columns[keep], scores[keep]
+        if len(scores) > k:
+            best = np.argpartition(-scores, k)[:k]
+            columns, scores = columns[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        results.append((offset + i, list(zip(columns[order], scores[order]))))
+    return results
+
+def compute(top_k=TOP_K, block_size=BLOCK_SIZE):
+    """Rebuild every book's stored recommendations, returns rows written"""
+    book_ids = list(models.Book.objects.order_by('pk').values_list('pk', flat=True))
+    if not book_ids:
+        return 0
+    book_index = {book_id: i for i, book_id in enumerate(book_ids)}
+    matrix = _matrix(book_index)
+    normalized = _normalize(matrix).tocsr()
+    transposed = normalized.T.tocsc()
+    #number of clubs/raters two books share, for the shrinkage
+    binary = (matrix > 0).astype(np.float64).tocsr()
+    binary_transposed = binary.T.tocsc()
+
+    written = 0
+    for offset in range(0, len(book_ids), block_size):
+        block = book_ids[offset:offset + block_size]
+        rows = slice(offset, offset + len(block))
+        similarities = _shrink((normalized[rows] @ transposed).tocsr(),
+                               (binary[rows] @ binary_transposed).tocsr())
+        recommendations = [
+            models.BookRecommendation(
+                book_id=book_ids[row],
+                recommended_id=book_ids[column],
+                score=float(score),
+                rank=rank)
+            for row, neighbours in _top_k(similarities, offset, top_k)
+            for rank, (column, score) in enumerate(neighbours, 1)]
+        with transaction.atomic():
+            #book_ids is in db order, the block is a pk range
+            models.BookRecommendation.objects\
+                .filter(book__gte=block[0], book__lte=block[-1]).delete()
+            models.BookRecommendation.objects.bulk_create(recommendations)
+        written += len(recommendations)
+    pagecache.invalidate(pagecache.RECOMMENDATIONS)
+    return written
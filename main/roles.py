@@ -0,0 +1,47 @@
+"""
+Process-local registry of the Role rows.
+
+Role is a fixed table of three rows (see the insert_roles command), so it is
+loaded once per process, on its first lookup, instead of being queried on
+every lookup. It is cleared whenever a Role is saved or deleted and after
+migrate/flush, and reloads lazily on the next lookup. A lookup of a missing
+role reloads it at most once every RELOAD_INTERVAL seconds, for roles
+inserted by another process.
+"""
+import time
+
+RELOAD_INTERVAL = 60
+
+_registry = None
+
+def _load():
+    global _registry
+    from main.models import Role
+
+    roles = list(Role.objects.all())
+    _registry = {
+        'value': {role.role: role for role in roles},
+        'id': {role.pk: role for role in roles},
+        'loaded': time.monotonic(),
+    }
+    return _registry
+
+def _get(kind, key):
+    registry = _registry or _load()
+    if key not in registry[kind] and \
+            time.monotonic() - registry['loaded'] >= RELOAD_INTERVAL:
+        #maybe a role inserted by another process
+        registry = _load()
+    return registry[kind].get(key)
+
+def get(value):
+    """Return the Role with role=value (e.g. Role.FOUNDER) or None"""
+    return _get('value', value)
+
+def get_by_id(pk):
+    """Return the Role with primary key pk or None"""
+    return _get('id', pk)
+
+def clear(**kwargs):
+    global _registry
+    _registry = None
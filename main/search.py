@@ -0,0 +1,238 @@
+"""
+Full-text search over books, reviews and discussions.
+
+Every searchable object is denormalized into a SearchDocument (a title and a
+body, discussions including their comments and replies). On PostgreSQL the
+documents are matched with the native tsvector/tsquery machinery, over the
+GIN indexed SearchVector table created on PostgreSQL only; on other databases
+a built-in inverted index of SearchPosting rows is maintained instead.
+
+Model saves & deletes queue the touched documents per transaction and hand
+them to the update_search_index task in one batch on commit, see
+main.signals.
+"""
+import math
+import re
+import threading
+import weakref
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, FloatField, Sum, Value, When
+
+from main import models
+
+BOOK = 'book'
+REVIEW = 'review'
+BOOK_DISCUSSION = 'book_discussion'
+THREAD_DISCUSSION = 'thread_discussion'
+
+TITLE_WEIGHT = 3.0
+BODY_WEIGHT = 1.0
+MAX_TERM_LENGTH = 64
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'he',
+    'in', 'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the', 'to', 'was',
+    'were', 'will', 'with',
+))
+TOKEN_RE = re.compile(r'\w+')
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower())
+            if token not in STOPWORDS and len(token) <= MAX_TERM_LENGTH]
+
+def native():
+    """True when the database provides full-text search"""
+    return connection.vendor == 'postgresql'
+
+#document builders, {kind: (model, queryset hook, (title, body) builder)}
+def _discussion_body(discussion):
+    parts = []
+    for comment in discussion.comments.all():
+        parts.append(comment.body)
+        parts.extend(reply.body for reply in comment.replies.all())
+    return '\n'.join(parts)
+
+SOURCES = {
+    BOOK: (
+        models.Book,
+        lambda qs: qs,
+        lambda book: (book.title, '{}\n{}'.format(book.author, book.description)),
+    ),
+    REVIEW: (
+        models.Review,
+        lambda qs: qs.select_related('book'),
+        lambda review: (review.book.title, review.body),
+    ),
+    BOOK_DISCUSSION: (
+        models.BookDiscussion,
+        lambda qs: qs.prefetch_related('comments__replies'),
+        lambda discussion: (discussion.question, _discussion_body(discussion)),
+    ),
+    THREAD_DISCUSSION: (
+        models.ThreadDiscussion,
+        lambda qs: qs.prefetch_related('comments__replies'),
+        lambda discussion: (discussion.question, _discussion_body(discussion)),
+    ),
+}
+
+def index(kind, pks):
+    """(Re)index the objects of kind with the given pks, dropping deleted ones"""
+    model, prepare, build = SOURCES[kind]
+    pks = set(str(pk) for pk in pks)
+    objs = prepare(model.objects.filter(pk__in=pks))
+    with transaction.atomic():
+        models.SearchDocument.objects.filter(kind=kind, object_id__in=pks).delete()
+        documents = []
+        for obj in objs:
+            title, body = build(obj)
+            documents.append(models.SearchDocument(
+                kind=kind, object_id=obj.pk, title=title[:200], body=body))
+        models.SearchDocument.objects.bulk_create(documents)
+        if native():
+            _index_native(documents)
+        else:
+            _index_postings(documents)
+    return len(documents)
+
+def _index_native(documents):
+    if not documents:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {vectors} (document_id, vector) "
+            "SELECT id, setweight(to_tsvector(title), 'A') || "
+            "setweight(to_tsvector(body), 'B') FROM {documents} WHERE id IN ({ids})".format(
+                vectors=models.SearchVector._meta.db_table,
+                documents=models.SearchDocument._meta.db_table,
+                ids=', '.join(['%s'] * len(documents))),
+            [document.pk for document in documents])
+
+def _index_postings(documents):
+    postings = []
+    for document in documents:
+        weights = Counter()
+        for term in tokenize(document.title):
+            weights[term] += TITLE_WEIGHT
+        for term in tokenize(document.body):
+            weights[term] += BODY_WEIGHT
+        #dampen long documents
+        norm = math.sqrt(sum(weights.values())) or 1
+        postings.extend(
+            models.SearchPosting(document=document, term=term, weight=weight / norm)
+            for term, weight in weights.items())
+    models.SearchPosting.objects.bulk_create(postings)
+
+def search(query, limit=50):
+    """Return up to limit SearchDocuments matching every term of query, best first"""
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return []
+    if native():
+        return _search_native(query, limit)
+    return _search_postings(terms, limit)
+
+def _search_native(query, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank
+
+    query = SearchQuery(query)
+    return list(models.SearchDocument.objects
+                .filter(native__vector=query)
+                .annotate(rank=SearchRank(F('native__vector'), query))
+                .order_by('-rank')[:limit])
+
+def _search_postings(terms, limit):
+    frequencies = dict(models.SearchPosting.objects
+                       .filter(term__in=terms)
+                       .values('term')
+                       .annotate(n=Count('document'))
+                       .values_list('term', 'n'))
+    if len(frequencies) < len(terms):
+        return []
+    total = models.SearchDocument.objects.count()
+    #tf-idf: rarer terms weigh more
+    score = Sum(Case(
+        *[When(term=term, then=F('weight') * Value(math.log(1 + total / n)))
+          for term, n in frequencies.items()],
+        output_field=FloatField()))
+    ranked = list(models.SearchPosting.objects
+                  .filter(term__in=terms)
+                  .values('document')
+                  .annotate(matched=Count('term'), rank=score)
+                  .filter(matched=len(terms))
+                  .order_by('-rank')
+                  .values_list('document', 'rank')[:limit])
+    documents = models.SearchDocument.objects.in_bulk([pk for pk, _ in ranked])
+    results = []
+    for pk, rank in ranked:
+        document = documents[pk]
+        document.rank = rank
+        results.append(document)
+    return results
+
+def create_native_index(**kwargs):
+    """post_migrate: the SearchVector table and its GIN index on PostgreSQL"""
+    if not native():
+        return
+    vectors = models.SearchVector._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS {} ('
+            'document_id uuid PRIMARY KEY REFERENCES {} (id) ON DELETE CASCADE, '
+            'vector tsvector NOT NULL)'.format(vectors, models.SearchDocument._meta.db_table))
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS {0}_vector_idx ON {0} USING gin (vector)'.format(vectors))
+
+#per-transaction batching of index updates
+_pending = threading.local()
+
+def _document_key(sender, instance):
+    if sender is models.BookDiscussionComment:
+        return BOOK_DISCUSSION, instance.discussion_id
+    if sender is models.ThreadDiscussionComment:
+        return THREAD_DISCUSSION, instance.discussion_id
+    if sender is models.BookCommentReply:
+        return BOOK_DISCUSSION, models.BookDiscussionComment.objects\
+            .filter(pk=instance.comment_id)\
+            .values_list('discussion_id', flat=True).first()
+    if sender is models.ThreadCommentReply:
+        return THREAD_DISCUSSION, models.ThreadDiscussionComment.objects\
+            .filter(pk=instance.comment_id)\
+            .values_list('discussion_id', flat=True).first()
+    for kind, (model, _, _) in SOURCES.items():
+        if sender is model:
+            return kind, instance.pk
+
+def queue(sender, instance, **kwargs):
+    """post_save/post_delete receiver, batches the change until commit"""
+    kind, pk = _document_key(sender, instance)
+    if pk is None:
+        return
+    batch = _pending.batch() if getattr(_pending, 'batch', None) else None
+    if batch is not None:
+        batch.add((kind, str(pk)))
+        return
+    batch = {(kind, str(pk))}
+    #only the callback holds the batch: a rollback drops both, and the next
+    #change starts a new batch. Outside transactions the callback runs now.
+    _pending.batch = weakref.ref(batch)
+    transaction.on_commit(lambda: _flush(batch))
+
+def _flush(batch):
+    from main.tasks import update_search_index
+
+    _pending.batch = None
+    update_search_index.delay(sorted(batch))
+
+def rebuild(batch_size=1000, stdout=None):
+    """Drop and rebuild the whole index"""
+    models.SearchPosting.objects.all().delete()
+    models.SearchDocument.objects.all().delete()
+    total = 0
+    for kind, (model, _, _) in SOURCES.items():
+        pks = list(model.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(pks), batch_size):
+            total += index(kind, pks[start:start + batch_size])
+        if stdout:
+            stdout.write('Indexed {} {}'.format(len(pks), model._meta.verbose_name_plural))
+    return total
@@ -0,0 +1,87 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_migrate, post_save, pre_save
+from django.dispatch import receiver
+
+from main import counters, images, models, pagecache, roles, search, trending
+
+@receiver(post_delete, sender=models.Rating)
+def remove_rating_from_book(sender, instance, **kwargs):
+    #sent inside the deletion's transaction, queryset deletes included
+    models.Book.adjust_rating(instance.book_id, -instance.rating, -1)
+    instance.refresh_book_rating()
+
+@receiver(post_save, sender=models.Like)
+def buffer_like(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(
+            lambda: counters.record_like(instance.review_id))
+
+@receiver(post_delete, sender=models.Like)
+def buffer_unlike(sender, instance, **kwargs):
+    transaction.on_commit(
+        lambda: counters.record_like(instance.review_id, liked=False))
+
+@receiver(post_delete, sender=models.BookDiscussion)
+def remove_discussion_from_book(sender, instance, **kwargs):
+    models.Book.adjust_discussions(instance.book_id, -1)
+
+@receiver(post_save, sender=models.BookDiscussionComment)
+def touch_discussed_book(sender, instance, created, **kwargs):
+    if created:
+        models.Book.objects.filter(discussions=instance.discussion_id)\
+            .update(last_discussed=instance.created)
+
+@receiver(post_save, sender=models.BookClubMember)
+@receiver(post_delete, sender=models.BookClubMember)
+def refresh_club_leaders(sender, instance, **kwargs):
+    club = models.BookClub(pk=instance.book_club_id)
+    models.BookClub.leaders.invalidate(club)
+    #again once committed, in case it was recomputed from the old rows meanwhile
+    transaction.on_commit(lambda: models.BookClub.leaders.invalidate(club))
+
+@receiver(post_save, sender=models.Profile)
+@receiver(post_save, sender=get_user_model())
+def refresh_led_clubs(sender, instance, update_fields=None, **kwargs):
+    if sender is models.Profile:
+        members = {'profile': instance.pk}
+    elif update_fields and set(update_fields) <= {'last_login'}:
+        #logging in changes nothing shown
+        return
+    else:
+        members = {'profile__user': instance.pk}
+    clubs = models.BookClub.invalidate_leaders(**members)
+
+    def invalidate():
+        #again once committed, like refresh_club_leaders
+        for club in clubs:
+            models.BookClub.leaders.invalidate(club)
+    if clubs:
+        transaction.on_commit(invalidate)
+
+post_save.connect(roles.clear, sender=models.Role)
+post_delete.connect(roles.clear, sender=models.Role)
+#test databases and flush replace every Role row
+post_migrate.connect(roles.clear)
+
+for model in (models.Book, models.Review, models.BookDiscussion,
+              models.BookDiscussionComment, models.BookCommentReply,
+              models.ThreadDiscussion, models.ThreadDiscussionComment,
+              models.ThreadCommentReply):
+    post_save.connect(search.queue, sender=model)
+    post_delete.connect(search.queue, sender=model)
+post_migrate.connect(search.create_native_index)
+
+for model in (models.Book, models.Profile, models.BookClub):
+    pre_save.connect(images.reset_processed, sender=model)
+    post_save.connect(images.queue_processing, sender=model)
+    post_init.connect(images.remember_files, sender=model)
+    post_save.connect(images.remember_files, sender=model)
+
+for model in trending.WEIGHTS:
+    post_save.connect(trending.record_activity, sender=model)
+
+for model in (models.Book, models.Review, models.Rating, models.Like, models.BookClub,
+              models.BookClubMember, models.BookClubRead, models.Profile, get_user_model()):
+    post_save.connect(pagecache.invalidate_instance, sender=model)
+    post_delete.connect(pagecache.invalidate_instance, sender=model)
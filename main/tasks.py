@@ -0,0 +1,57 @@
+from celery import task
+from celery.utils.log import get_task_logger
+
+from main import (counters, dbrouter, images, memoize, reads, recommendations, search,
+                  thumbnails, trending)
+#connects the task metrics' signal receivers in workers
+from main import metrics  # noqa: F401
+
+logger = get_task_logger(__name__)
+
+@task(name='flush_review_likes', ignore_result=True)
+def flush_review_likes():
+    updated = counters.flush_likes()
+    logger.info('Flushed buffered likes of {} reviews'.format(updated))
+    return updated
+
+@task(name='update_search_index', ignore_result=True)
+def update_search_index(keys):
+    """keys: [(document kind, object pk)] batched by main.search.queue"""
+    by_kind = {}
+    for kind, pk in keys:
+        by_kind.setdefault(kind, set()).add(pk)
+    for kind, pks in by_kind.items():
+        search.index(kind, pks)
+    logger.info('Reindexed {} search documents'.format(len(keys)))
+
+@task(name='generate_thumbnails', ignore_result=True)
+def generate_thumbnails(names, geometry_string, options):
+    thumbnails.generate(names, geometry_string, options)
+    logger.info('Generated {} {} thumbnails'.format(len(names), geometry_string))
+
+@task(name='process_image', ignore_result=True)
+def process_image(label, pk, field):
+    if images.process(label, pk, field):
+        logger.info('Processed {} of {} {}'.format(field, label, pk))
+
+@task(name='rebalance_trending', ignore_result=True)
+def rebalance_trending():
+    updated = trending.rebalance()
+    logger.info('Applied trending activity of {} books'.format(updated))
+
+@task(name='compute_recommendations', ignore_result=True)
+def compute_recommendations():
+    #reads every rating & read before writing, lag of the replicas is harmless
+    dbrouter.unpin()
+    written = recommendations.compute()
+    logger.info('Stored {} book recommendations'.format(written))
+
+@task(name='rotate_book_club_reads', ignore_result=True)
+def rotate_book_club_reads():
+    closed = reads.rotate()
+    logger.info('Closed {} expired book club reads'.format(closed))
+
+@task(name='refresh_memoized', ignore_result=True)
+def refresh_memoized(name, args):
+    memoize.refresh(name, args)
+    logger.info('Refreshed memoized {}'.format(name))
@@ -0,0 +1,35 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from main import fragments
+
+register = template.Library()
+
+class FragmentNode(template.Node):
+
+    def __init__(self, name, obj, nodelist):
+        self.name = name
+        self.obj = obj
+        self.nodelist = nodelist
+
+    def render(self, context):
+        key = fragments.key(self.name.resolve(context), self.obj.resolve(context))
+        #loaded by the view with fragments.prefetch
+        prefetched = context.get('fragments')
+        html = prefetched.get(key) if prefetched is not None else fragments.get(key)
+        if html is None:
+            html = self.nodelist.render(context)
+            fragments.store(key, str(html))
+        return mark_safe(html)
+
+@register.tag
+def fragment(parser, token):
+    """{% fragment 'name' obj %}...{% endfragment %}, see main.fragments"""
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError(
+            "'{}' takes a fragment name and an object".format(bits[0]))
+    nodelist = parser.parse(('endfragment',))
+    parser.delete_first_token()
+    return FragmentNode(parser.compile_filter(bits[1]), parser.compile_filter(bits[2]),
+                        nodelist)
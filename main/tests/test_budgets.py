@@ -0,0 +1,151 @@
+"""
+Query-count & latency budgets for every named route in main/urls.py.
+
+Each route is requested against a seeded dataset at several sizes. A route
+fails when it exceeds its declared budget, or when its query count grows
+with the dataset while it is declared constant. Set VIEW_BUDGET_REPORT to a
+file path to get the measurements as JSON.
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count
+from django.template.backends.django import Template
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from io import StringIO
+from unittest import mock
+import json
+import os
+import time
+
+from main import models, roles
+from main.urls import urlpatterns
+
+SIZES = (
+    ('small', dict(seed=11, books=20, profiles=20, clubs=2, book_discussions=10)),
+    ('large', dict(seed=12, books=120, profiles=120, clubs=6, book_discussions=60)),
+)
+
+class Budget:
+
+    def __init__(self, queries, ms=1000, constant=True, target=None, query=None,
+                 staff=False):
+        self.queries = queries
+        self.ms = ms
+        #False for views whose query count is known to grow with the data
+        self.constant = constant
+        #returns the url kwargs, picking the busiest object for detail routes
+        self.target = target or (lambda: {})
+        self.query = query or {}
+        #staff-only routes are requested logged in as a staff user
+        self.staff = staff
+
+def busiest(model, related):
+    def target():
+        obj = model.objects.annotate(n=Count(related)).order_by('-n', 'pk').first()
+        return {'pk': obj.pk}
+    return target
+
+BUDGETS = {
+    'home': Budget(0),
+    'book_list': Budget(1),
+    'trending_books': Budget(1),
+    'book_detail': Budget(3, target=busiest(models.Book, 'reviews')),
+    'review_list': Budget(1),
+    'book_club_list': Budget(1),
+    'search': Budget(4, query={'q': 'synthetic book'}),
+    #session & user
+    'profiling_stats': Budget(2, staff=True),
+    'metrics': Budget(2, staff=True),
+    'book_club_detail': Budget(
+        3, target=busiest(models.BookClub, 'book_club_members')),
+    'book_discussion_list': Budget(2),
+    'book_club_threads': Budget(3, target=busiest(models.BookClub, 'threads')),
+    'book_discussion_detail': Budget(
+        3, target=busiest(models.BookDiscussion, 'comments')),
+    'book_comment_replies': Budget(
+        1, target=busiest(models.BookDiscussionComment, 'replies')),
+    'thread_discussion_detail': Budget(
+        3, target=busiest(models.ThreadDiscussion, 'comments')),
+    'thread_comment_replies': Budget(
+        1, target=busiest(models.ThreadDiscussionComment, 'replies')),
+    #known N+1 views, their query count still grows with the data
+    'review_detail': Budget(
+        30, constant=False, target=busiest(models.Review, 'comments')),
+    'book_club_members': Budget(
+        500, constant=False, target=busiest(models.BookClub, 'book_club_members')),
+    'book_club_reads': Budget(
+        40, constant=False, target=busiest(models.BookClub, 'book_club_reads')),
+}
+
+#budgets are for rendering pages, not serving them from main.pagecache
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class ViewBudgetTests(TestCase):
+
+    def measure(self, name):
+        render_time = [0.0]
+        render = Template.render
+
+        def timed_render(template, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return render(template, *args, **kwargs)
+            finally:
+                render_time[0] += time.perf_counter() - started
+
+        budget = BUDGETS[name]
+        url = reverse(name, kwargs=budget.target())
+        if budget.staff:
+            self.client.force_login(self.staff)
+        else:
+            self.client.logout()
+        #cold, without memoized values or fragments of the previous size
+        cache.clear()
+        with mock.patch.object(Template, 'render', timed_render),\
+                CaptureQueriesContext(connection) as ctx:
+            started = time.perf_counter()
+            resp = self.client.get(url, budget.query)
+            total = time.perf_counter() - started
+        self.assertEqual(resp.status_code, 200, url)
+        return {
+            'queries': len(ctx.captured_queries),
+            'db_ms': round(sum(float(q['time']) for q in ctx.captured_queries) * 1000, 3),
+            'render_ms': round(render_time[0] * 1000, 3),
+            'total_ms': round(total * 1000, 3),
+        }
+
+    def test_every_route_has_a_budget(self):
+        names = {pattern.name for pattern in urlpatterns if pattern.name}
+        self.assertEqual(names, set(BUDGETS))
+
+    def test_view_budgets(self):
+        self.staff = get_user_model().objects.create_user(
+            username='budget-staff', password='testpass123', is_staff=True)
+        report = {}
+        for size, options in SIZES:
+            call_command('seed_scale', stdout=StringIO(), **options)
+            #as in a running process, where the registry is loaded by earlier requests
+            roles.get(models.Role.FOUNDER)
+            report[size] = {name: self.measure(name) for name in sorted(BUDGETS)}
+
+        path = os.environ.get('VIEW_BUDGET_REPORT')
+        if path:
+            with open(path, 'w') as f:
+                json.dump({'sizes': dict(SIZES), 'routes': report}, f, indent=2,
+                          sort_keys=True)
+
+        first, last = SIZES[0][0], SIZES[-1][0]
+        for name, budget in BUDGETS.items():
+            for size in report:
+                stats = report[size][name]
+                with self.subTest(route=name, size=size):
+                    self.assertLessEqual(stats['queries'], budget.queries)
+                    self.assertLessEqual(stats['total_ms'], budget.ms)
+            if budget.constant:
+                with self.subTest(route=name, check='constant'):
+                    self.assertLessEqual(
+                        report[last][name]['queries'], report[first][name]['queries'],
+                        'query count grows with the dataset')
@@ -0,0 +1,33 @@
+from django.test import SimpleTestCase
+
+from accounts.tasks import send_queued_mail
+from main.tasks import compute_recommendations, update_search_index
+from treehouse.celery import app
+
+class QueueTests(SimpleTestCase):
+
+    def test_routes(self):
+        for task, queue in ((send_queued_mail, 'mail'),
+                            (compute_recommendations, 'bulk'),
+                            (update_search_index, 'default')):
+            self.assertEqual(app.amqp.router.route({}, task.name)['queue'].name, queue)
+
+    def test_tasks_are_published_to_their_lane(self):
+        #settings are namespaced, see treehouse.celery
+        eager = app.conf.task_always_eager
+        app.conf.update(CELERY_TASK_ALWAYS_EAGER=False)
+        try:
+            with app.connection_for_write('memory://') as connection:
+                channel = connection.default_channel
+                for queue in app.amqp.queues.values():
+                    queue(channel).declare()
+                    queue(channel).purge()
+                producer = app.amqp.Producer(connection)
+                send_queued_mail.apply_async(producer=producer)
+                compute_recommendations.apply_async(producer=producer)
+                compute_recommendations.apply_async(producer=producer)
+                depths = {queue: channel.queue_declare(queue, passive=True).message_count
+                          for queue in ('mail', 'default', 'bulk')}
+        finally:
+            app.conf.update(CELERY_TASK_ALWAYS_EAGER=eager)
+        self.assertEqual(depths, {'mail': 1, 'default': 0, 'bulk': 2})
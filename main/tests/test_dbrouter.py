@@ -0,0 +1,110 @@
+from celery.signals import task_prerun
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from unittest import mock
+import time
+
+from main import dbrouter, metrics, models
+
+@override_settings(REPLICA_CHECK_INTERVAL=10.0, REPLICA_MAX_LAG=30.0, REPLICA_PIN_SECONDS=5)
+class ReplicaRouterTests(TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        dbrouter.reset()
+        dbrouter._health.clear()
+        self.router = dbrouter.ReplicaRouter(['replica1', 'replica2'])
+        self.addCleanup(dbrouter.reset)
+        self.addCleanup(dbrouter._health.clear)
+
+    def reads(self):
+        return {self.router.db_for_read(models.Book) for _ in range(50)}
+
+    def test_reads_are_balanced_over_healthy_replicas(self):
+        with mock.patch('main.dbrouter._check', return_value=True):
+            self.assertEqual(self.reads(), {'replica1', 'replica2'})
+        self.assertEqual(self.router.db_for_write(models.Book), 'default')
+
+    def test_unhealthy_replicas_are_skipped(self):
+        with mock.patch('main.dbrouter._check', side_effect=lambda alias: alias == 'replica2'):
+            self.assertEqual(self.reads(), {'replica2'})
+        dbrouter._health.clear()
+        with mock.patch('main.dbrouter._check', return_value=False):
+            self.assertEqual(self.reads(), {'default'})
+
+    def test_replicas_are_checked_once_per_interval(self):
+        with mock.patch('main.dbrouter._check', return_value=True) as check:
+            self.assertTrue(dbrouter.healthy('replica1', now=100))
+            self.assertTrue(dbrouter.healthy('replica1', now=105))
+            self.assertEqual(check.call_count, 1)
+            dbrouter.healthy('replica1', now=111)
+            self.assertEqual(check.call_count, 2)
+
+    def test_health_check(self):
+        #answers, and is not replicating
+        self.assertTrue(dbrouter._check('default'))
+        with override_settings(REPLICA_MAX_LAG=1.0),\
+                mock.patch.dict(dbrouter.LAG_SQL, {'sqlite': 'SELECT 60'}):
+            self.assertFalse(dbrouter._check('default'))
+
+    def test_reads_stay_on_the_primary_after_a_write(self):
+        with mock.patch('main.dbrouter._check', return_value=True):
+            self.router.db_for_write(models.Book)
+            self.assertEqual(self.reads(), {'default'})
+            dbrouter.reset()
+            self.assertNotIn('default', self.reads())
+
+    def test_reads_in_transactions_stay_on_the_primary(self):
+        with mock.patch('main.dbrouter._check', return_value=True), transaction.atomic():
+            self.assertEqual(self.reads(), {'default'})
+
+    def test_tasks_read_from_the_primary(self):
+        with mock.patch('main.dbrouter._check', return_value=True):
+            task_prerun.send(sender=None, task_id='test', task=None)
+            self.addCleanup(metrics._task_started.pop, 'test', None)
+            #the rows written before the task was queued may not be replicated yet
+            self.assertEqual(self.reads(), {'default'})
+            #read-only batch jobs opt in
+            dbrouter.unpin()
+            self.assertNotIn('default', self.reads())
+
+    def test_migrations_only_run_on_the_primary(self):
+        self.assertTrue(self.router.allow_migrate('default', 'main'))
+        self.assertFalse(self.router.allow_migrate('replica1', 'main'))
+
+@override_settings(REPLICA_PIN_SECONDS=5)
+class PrimaryPinMiddlewareTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.router = dbrouter.ReplicaRouter(['replica1'])
+        self.addCleanup(dbrouter._health.clear)
+
+    def respond(self, request, write=False):
+        reads = []
+
+        def view(request):
+            if write:
+                self.router.db_for_write(models.Book)
+            reads.append(dbrouter._current.pinned)
+            return HttpResponse()
+        response = dbrouter.PrimaryPinMiddleware(view)(request)
+        return response, reads[0]
+
+    def test_clients_are_pinned_after_their_writes(self):
+        factory = RequestFactory()
+        response, _ = self.respond(factory.get('/'))
+        self.assertNotIn(dbrouter.PIN_COOKIE, response.cookies)
+
+        response, _ = self.respond(factory.post('/'), write=True)
+        cookie = response.cookies[dbrouter.PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], 5)
+
+        request = factory.get('/')
+        request.COOKIES[dbrouter.PIN_COOKIE] = cookie.value
+        self.assertTrue(self.respond(request)[1])
+        #the window is over
+        request.COOKIES[dbrouter.PIN_COOKIE] = str(int(time.time()) - 1)
+        self.assertFalse(self.respond(request)[1])
+        self.assertFalse(dbrouter._current.pinned)
@@ -0,0 +1,73 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from unittest import mock
+
+from main import fragments, models
+
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class FragmentCacheTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.profile = models.Profile.objects.create(
+                    user=get_user_model().objects.create_user(
+                    username='testuser',
+                    email='testuser@email.com',
+                    password='testpass123'))
+        self.book = models.Book.objects.create(
+            isbn='123456789',
+            title='Misery',
+            author='Stephen King',
+            description='test book description')
+
+    def rendered(self, url):
+        """Keys of the fragments rendered (not served from the cache) by a request"""
+        with mock.patch('main.fragments.store', wraps=fragments.store) as store:
+            resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return [args[0] for args, _ in store.call_args_list]
+
+    def test_warm_fragments_are_not_rendered(self):
+        models.Book.objects.create(
+            isbn='453456789',
+            title='Ultralearning',
+            author='Scott H.Young',
+            description='test book description')
+        url = reverse('book_list')
+        self.assertEqual(len(self.rendered(url)), 2)
+        with mock.patch('main.fragments.cache.get_many', wraps=cache.get_many) as get_many:
+            self.assertEqual(self.rendered(url), [])
+        #one round trip for every fragment of the page
+        self.assertEqual(len([args for args, _ in get_many.call_args_list
+                              if any(key.startswith('fragment:') for key in args[0])]), 1)
+
+        #rating aggregates are updated without saving the book
+        models.Rating.objects.create(book=self.book, rater=self.profile, rating=4)
+        rendered = self.rendered(url)
+        self.assertEqual(len(rendered), 1)
+        self.assertIn(str(self.book.pk), rendered[0])
+
+    def test_changing_a_reply_renders_its_comment_again(self):
+        discussion = models.BookDiscussion.objects.create(
+            question='Who is Annie?', book=self.book, starter=self.profile)
+        comments = [models.BookDiscussionComment.objects.create(
+            discussion=discussion, commentor=self.profile, body='Comment {}'.format(i))
+            for i in range(2)]
+        replies = [models.BookCommentReply.objects.create(
+            comment=comments[0], replier=self.profile, body='Reply {}'.format(i))
+            for i in range(2)]
+        url = reverse('book_discussion_detail', kwargs={'pk': discussion.pk})
+        self.assertEqual(len(self.rendered(url)), 4)
+
+        replies[1].body = 'Edited reply'
+        replies[1].save()
+        rendered = self.rendered(url)
+        self.assertEqual(len(rendered), 2)
+        self.assertTrue(any(str(comments[0].pk) in key for key in rendered))
+        self.assertTrue(any(str(replies[1].pk) in key for key in rendered))
+        resp = self.client.get(url)
+        self.assertContains(resp, 'Edited reply')
+        self.assertContains(resp, 'Reply 0')
@@ -0,0 +1,144 @@
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+from io import BytesIO
+from PIL import Image
+from unittest import mock
+import shutil
+import tempfile
+
+from main import images, models, thumbnails
+
+def jpeg(width=400, height=200, orientation=None):
+    buf = BytesIO()
+    image = Image.new('RGB', (width, height), 'red')
+    exif = image.getexif()
+    exif[0x010f] = 'Camera Maker'
+    if orientation:
+        exif[0x0112] = orientation
+    image.save(buf, 'JPEG', exif=exif.tobytes())
+    return ContentFile(buf.getvalue())
+
+class ImagePipelineTests(TestCase):
+
+    def queued(self, on_commit):
+        """Processing callbacks among the on_commit calls, other receivers use it too"""
+        return [args[0] for args, _ in on_commit.call_args_list
+                if args[0].__qualname__.startswith('queue_processing.')]
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.book = models.Book.objects.create(
+            isbn='1234567890',
+            title='Book',
+            author='Author',
+            description='test book description')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+        super().tearDown()
+
+    def test_upload_is_stripped_renamed_and_rendered(self):
+        with mock.patch('main.images.transaction.on_commit') as on_commit:
+            self.book.cover.save('cover.jpg', jpeg(orientation=6), save=True)
+        self.assertEqual(len(self.queued(on_commit)), 1)
+        raw_name = self.book.cover.name
+        self.assertEqual(self.book.cover_hash, '')
+        self.assertTrue(images.process('main.book', self.book.pk, 'cover'))
+
+        book = models.Book.objects.get(pk=self.book.pk)
+        self.assertNotEqual(book.cover.name, raw_name)
+        self.assertFalse(default_storage.exists(raw_name))
+        self.assertIn(book.cover_hash, book.cover.name)
+        #the EXIF orientation is applied before the metadata is dropped
+        self.assertEqual((book.cover_width, book.cover_height), (200, 400))
+        with default_storage.open(book.cover.name) as f:
+            self.assertEqual(len(Image.open(f).getexif()), 0)
+
+        for geometry in ('150x75', '152x131'):
+            rendition = images.rendition(book, 'cover', geometry)
+            with default_storage.open(rendition.name) as f:
+                self.assertEqual(Image.open(f).size, (rendition.width, rendition.height))
+        self.assertEqual((rendition.width, rendition.height), (66, 131))
+
+    def test_new_upload_resets_processed_state(self):
+        self.book.cover.save('cover.jpg', jpeg(), save=True)
+        images.process('main.book', self.book.pk, 'cover')
+        self.book.refresh_from_db()
+        self.assertTrue(self.book.cover_hash)
+
+        with mock.patch('main.images.transaction.on_commit') as on_commit:
+            self.book.cover.save('other.jpg', jpeg(100, 100), save=True)
+        self.assertEqual(self.book.cover_hash, '')
+        self.assertIsNone(self.book.cover_width)
+        self.assertEqual(len(self.queued(on_commit)), 1)
+        #saving other fields keeps the processed image
+        images.process('main.book', self.book.pk, 'cover')
+        self.book.refresh_from_db()
+        with mock.patch('main.images.transaction.on_commit') as on_commit:
+            self.book.save()
+        self.assertEqual(self.queued(on_commit), [])
+        self.assertEqual(self.book.cover_width, 100)
+
+    def test_stale_saves_keep_the_processed_image(self):
+        self.book.cover.save('cover.jpg', jpeg(), save=True)
+        stale = models.Book.objects.get(pk=self.book.pk)
+        images.process('main.book', self.book.pk, 'cover')
+        book = models.Book.objects.get(pk=self.book.pk)
+
+        stale.title = 'Renamed'
+        with mock.patch('main.images.transaction.on_commit') as on_commit:
+            stale.save()
+        self.assertEqual(self.queued(on_commit), [])
+        stale.refresh_from_db()
+        self.assertEqual(stale.title, 'Renamed')
+        self.assertEqual((stale.cover.name, stale.cover_hash), (book.cover.name, book.cover_hash))
+        #a new upload is still written
+        stale.cover = 'books/covers/other.jpg'
+        stale.save()
+        stale.refresh_from_db()
+        self.assertEqual((stale.cover.name, stale.cover_hash), ('books/covers/other.jpg', ''))
+
+    def test_invalid_upload_is_rejected(self):
+        self.book.cover.save('cover.jpg', ContentFile(b'not an image'), save=True)
+        name = self.book.cover.name
+        with self.assertLogs('main.images', 'WARNING'):
+            self.assertFalse(images.process('main.book', self.book.pk, 'cover'))
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.cover)
+        #unlinked only
+        self.assertTrue(default_storage.exists(name))
+
+    def test_mpo_upload_is_stored_as_jpeg(self):
+        buf = BytesIO()
+        Image.new('RGB', (400, 200), 'red').save(
+            buf, 'MPO', save_all=True, append_images=[Image.new('RGB', (400, 200), 'blue')])
+        self.book.cover.save('cover.jpg', ContentFile(buf.getvalue()), save=True)
+        self.assertTrue(images.process('main.book', self.book.pk, 'cover'))
+        book = models.Book.objects.get(pk=self.book.pk)
+        self.assertTrue(book.cover.name.endswith('.jpg'))
+        with default_storage.open(book.cover.name) as f:
+            self.assertEqual(Image.open(f).format, 'JPEG')
+
+    def test_processed_images_skip_the_thumbnail_store(self):
+        self.book.cover.save('cover.jpg', jpeg(), save=True)
+        images.process('main.book', self.book.pk, 'cover')
+        book = models.Book.objects.get(pk=self.book.pk)
+        with mock.patch('main.tasks.generate_thumbnails.delay') as delay,\
+                self.assertNumQueries(0):
+            thumbnails.attach([book], 'cover', '150x75')
+        delay.assert_not_called()
+        self.assertEqual((book.thumbnail.width, book.thumbnail.height), (150, 75))
+        self.assertTrue(book.thumbnail.url.endswith('/150x75.jpg'))
+
+    def test_avatar_upload_path(self):
+        user = get_user_model().objects.create_user(username='reader', password='x')
+        profile = models.Profile(user=user)
+        path = models.Profile.avatar_upload_path(profile, 'me.png')
+        self.assertTrue(path.startswith('reader/'))
+        self.assertTrue(path.endswith('.png'))
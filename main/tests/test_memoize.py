@@ -0,0 +1,139 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from unittest import mock
+import time
+
+from main import memoize, models
+
+calls = []
+
+@memoize.memoize(60, stale=60)
+def square(n):
+    calls.append(n)
+    return n * n
+
+@memoize.memoize(60, stale=60, background=True)
+def cube(n):
+    calls.append(n)
+    return n ** 3
+
+class MemoizeTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        calls.clear()
+
+    def age(self, func, n, delta=0.0, left=-1):
+        """Make the stored value of func(n) expire in left seconds"""
+        key = memoize.KEY.format(func.key(n))
+        entry = cache.get(key)
+        entry.update(delta=delta, expires=time.time() + left)
+        cache.set(key, entry)
+
+    def test_values_are_computed_once(self):
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(4), 16)
+        self.assertEqual(calls, [3, 4])
+        square.invalidate(3)
+        square(3)
+        self.assertEqual(calls, [3, 4, 3])
+
+    def test_expired_values_are_recomputed_once(self):
+        square(3)
+        self.age(square, 3)
+        self.assertEqual(square(3), 9)
+        square(3)
+        self.assertEqual(calls, [3, 3])
+
+    def test_stale_value_is_served_during_a_refresh(self):
+        square(3)
+        self.age(square, 3)
+        #another process is recomputing it
+        cache.add(memoize.LOCK_KEY.format(square.key(3)), 1)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(calls, [3])
+
+    def test_readers_without_a_value_wait_for_the_refresh(self):
+        cache.add(memoize.LOCK_KEY.format(square.key(5)), 1)
+
+        def sleep(seconds):
+            #the lock holder stores the value meanwhile
+            memoize._store(square.key(5), 25, 0.1, 60, 60)
+        with mock.patch('main.memoize.time.sleep', side_effect=sleep):
+            self.assertEqual(square(5), 25)
+        self.assertEqual(calls, [])
+
+    def test_costly_values_are_refreshed_early(self):
+        square(3)
+        #a minute to go, for a computation of an hour
+        self.age(square, 3, delta=60 * 60, left=60)
+        with mock.patch('main.memoize.random.random', return_value=0.5):
+            square(3)
+        self.assertEqual(calls, [3, 3])
+        #and cheap ones are not
+        self.age(square, 3, delta=0.01, left=60)
+        with mock.patch('main.memoize.random.random', return_value=0.5):
+            square(3)
+        self.assertEqual(calls, [3, 3])
+
+    def test_background_refresh(self):
+        cube(2)
+        self.age(cube, 2)
+        with mock.patch('main.tasks.refresh_memoized.delay') as delay:
+            self.assertEqual(cube(2), 8)
+            #queued once
+            cube(2)
+        delay.assert_called_once_with('main.tests.test_memoize.cube', [2])
+        self.assertEqual(calls, [2])
+        #as run by the worker
+        memoize.refresh(*delay.call_args[0])
+        self.assertEqual(calls, [2, 2])
+        self.assertIsNone(cache.get(memoize.LOCK_KEY.format(cube.key(2))))
+
+    def test_refresh_in_the_request_without_a_broker(self):
+        cube(2)
+        self.age(cube, 2)
+        with mock.patch('main.tasks.refresh_memoized.delay', side_effect=OSError),\
+                self.assertLogs('main.memoize', 'ERROR'):
+            self.assertEqual(cube(2), 8)
+        self.assertEqual(calls, [2, 2])
+        self.assertIsNone(cache.get(memoize.LOCK_KEY.format(cube.key(2))))
+
+    def test_model_instances_are_keyed_by_pk(self):
+        first = models.BookClub.objects.create(name='First', location='Here', description='')
+        second = models.BookClub.objects.create(name='Second', location='Here', description='')
+        leaders = models.BookClub.leaders
+        self.assertNotEqual(leaders.key(first), leaders.key(second))
+        self.assertEqual(leaders.key(first),
+                         leaders.key(models.BookClub.objects.get(pk=first.pk)))
+        self.assertEqual(memoize._decode(memoize._encode(first)), first)
+
+    def test_club_leaders_follow_members(self):
+        founder = models.Role.objects.create(role=models.Role.FOUNDER)
+        models.Role.objects.create(role=models.Role.ADMIN)
+        club = models.BookClub.objects.create(name='Club', location='Here', description='')
+        self.assertEqual(club.leaders()[models.Role.FOUNDER], [])
+        profile = models.Profile.objects.create(
+            user=get_user_model().objects.create_user(
+                username='testuser', email='testuser@email.com', password='testpass123'))
+        models.BookClubMember.objects.create(book_club=club, profile=profile, role=founder)
+        self.assertEqual(club.leaders()[models.Role.FOUNDER], [profile])
+
+    def test_club_leaders_follow_their_profiles(self):
+        founder = models.Role.objects.create(role=models.Role.FOUNDER)
+        club = models.BookClub.objects.create(name='Club', location='Here', description='')
+        profile = models.Profile.objects.create(
+            user=get_user_model().objects.create_user(
+                username='testuser', email='testuser@email.com', password='testpass123'))
+        models.BookClubMember.objects.create(book_club=club, profile=profile, role=founder)
+        self.assertEqual(club.leaders()[models.Role.FOUNDER][0].user.username, 'testuser')
+        profile.user.username = 'renamed'
+        profile.user.save()
+        self.assertEqual(club.leaders()[models.Role.FOUNDER][0].user.username, 'renamed')
+        #logging in keeps them
+        with mock.patch('main.memoize.cache.delete') as delete:
+            profile.user.save(update_fields=['last_login'])
+        delete.assert_not_called()
@@ -0,0 +1,83 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from prometheus_client import REGISTRY
+from unittest import mock
+
+from accounts import mail
+from main import metrics, models
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        models.Book.objects.create(
+            isbn='1234567890',
+            title='The Pearl',
+            author='John Steinbeck',
+            description='test description')
+
+    def test_requests_are_counted(self):
+        before = sample('treehouse_http_requests_total',
+                        view='book_list', method='GET', status='200')
+        observed = sample('treehouse_http_request_duration_seconds_count', view='book_list')
+        self.client.get(reverse('book_list'))
+        self.client.get(reverse('book_list'))
+        self.assertEqual(sample('treehouse_http_requests_total',
+                                view='book_list', method='GET', status='200'), before + 2)
+        self.assertEqual(sample('treehouse_http_request_duration_seconds_count',
+                                view='book_list'), observed + 2)
+
+    def test_cache_lookups_are_counted(self):
+        hits = sample('treehouse_cache_requests_total', result='hit')
+        misses = sample('treehouse_cache_requests_total', result='miss')
+        self.client.get(reverse('trending_books'))
+        self.client.get(reverse('trending_books'))
+        self.assertEqual(sample('treehouse_cache_requests_total', result='miss'), misses + 1)
+        self.assertEqual(sample('treehouse_cache_requests_total', result='hit'), hits + 1)
+
+    def test_tasks_are_counted(self):
+        before = sample('treehouse_celery_tasks_total',
+                        task='rebalance_trending', state='success')
+        from main.tasks import rebalance_trending
+        #in process, whatever CELERY_TASK_ALWAYS_EAGER says
+        rebalance_trending.apply()
+        self.assertEqual(sample('treehouse_celery_tasks_total',
+                                task='rebalance_trending', state='success'), before + 1)
+        self.assertGreater(sample('treehouse_celery_task_duration_seconds_count',
+                                  task='rebalance_trending'), 0)
+
+    def test_emails_are_counted(self):
+        from django.core.mail import EmailMessage
+        before = sample('treehouse_emails_sent_total')
+        with mock.patch('accounts.mail.cache.add', return_value=False):
+            mail.enqueue([EmailMessage('Hi', 'Body', 'a@example.com', ['b@example.com'])])
+        mail.drain()
+        self.assertEqual(sample('treehouse_emails_sent_total'), before + 1)
+
+    def test_endpoint(self):
+        self.client.get(reverse('book_list'))
+        #closed without a token
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        staff = get_user_model().objects.create_user(
+            username='staff', email='staff@email.com', password='testpass123', is_staff=True)
+        self.client.force_login(staff)
+        resp = self.client.get(reverse('metrics'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp['Content-Type'].startswith('text/plain'))
+        body = resp.content.decode()
+        self.assertIn('treehouse_http_requests_total{', body)
+        self.assertIn('treehouse_celery_queue_depth', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_endpoint_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer other')
+        self.assertEqual(resp.status_code, 403)
@@ -1,11 +1,17 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.core.cache import cache
 from django.core.validators import ValidationError
 from django.db import transaction
+from django.db.models import F
 from django.db.utils import IntegrityError
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from io import StringIO
+from unittest import mock
 import datetime
+import time
 
-from main import models
+from main import counters, journal, models, reads, roles, tasks
 
 class BookModelTests(TestCase):
     
@@ -34,6 +40,25 @@ class BookModelTests(TestCase):
                 description = 'test description'
             )
     
+    def test_saves_keep_concurrent_counter_updates(self):
+        book = models.Book.objects.get(pk=self.book1.pk)
+        review = models.Review.objects.create(
+            book=self.book1, reviewer=self.profile, body='very scrumptious')
+        #applied by other processes after the rows were loaded
+        models.Book.adjust_rating(book.pk, 4, 1)
+        models.Book.adjust_discussions(book.pk, 1)
+        models.Review.objects.filter(pk=review.pk).update(like_count=F('like_count') + 2)
+
+        book.title = 'The Pearl, revised'
+        book.save()
+        review.body = 'still scrumptious'
+        review.save()
+        book.refresh_from_db()
+        review.refresh_from_db()
+        self.assertEqual((book.title, book.rating_sum, book.rating_count,
+                          book.discussion_count), ('The Pearl, revised', 4, 1, 1))
+        self.assertEqual((review.body, review.like_count), ('still scrumptious', 2))
+
     def test_book_isbn_is_digits_and_correct_length(self):
         book = models.Book(
                 isbn='123456789a',
@@ -159,7 +184,150 @@ class BookModelTests(TestCase):
                 rater=self.profile1,
                 rating=3)
         self.assertEqual(self.book1.get_book_rating(), 3.5)   
+
+    def test_book_rating_aggregates_follow_rating_changes(self):
+        rating = models.Rating.objects.create(
+            book=self.book1,
+            rater=self.profile,
+            rating=4)
+        models.Rating.objects.create(
+            book=self.book1,
+            rater=self.profile1,
+            rating=2)
+        rating.rating = 5
+        rating.save()
+        book = models.Book.objects.get(pk=self.book1.pk)
+        self.assertEqual((book.rating_sum, book.rating_count), (7, 2))
+
+        rating.delete()
+        book.refresh_from_db()
+        self.assertEqual((book.rating_sum, book.rating_count), (2, 1))
+
+        models.Rating.objects.filter(book=book).delete()
+        book.refresh_from_db()
+        self.assertEqual((book.rating_sum, book.rating_count), (0, 0))
+        self.assertEqual(book.get_book_rating(), 0)
+
+    def test_recount_ratings_repairs_aggregates(self):
+        models.Rating.objects.create(
+            book=self.book1,
+            rater=self.profile,
+            rating=4)
+        models.Book.objects.update(rating_sum=100, rating_count=0)
+        call_command('recount_ratings', stdout=StringIO())
+        self.book1.refresh_from_db()
+        self.assertEqual(
+            (self.book1.rating_sum, self.book1.rating_count), (4, 1))
     
+class ReviewLikeCounterTests(TransactionTestCase):
+    #like deltas are buffered on transaction commit
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.profile = models.Profile.objects.create(
+            user=get_user_model().objects.create_user(
+                username='testuser', password='testpass123'))
+        self.profile1 = models.Profile.objects.create(
+            user=get_user_model().objects.create_user(
+                username='testuser1', password='testpass123'))
+        self.review = models.Review.objects.create(
+            book=models.Book.objects.create(
+                isbn='1234567890',
+                title='The Pearl',
+                author='John Steinbeck',
+                description = 'test description'),
+            reviewer=self.profile,
+            body='very scrumptious')
+
+    def test_likes_are_buffered_until_flushed(self):
+        like = models.Like.objects.create(review=self.review, liker=self.profile)
+        models.Like.objects.create(review=self.review, liker=self.profile1)
+        like.delete()
+        review = models.Review.objects.get(pk=self.review.pk)
+        self.assertEqual(review.like_count, 0)
+        self.assertEqual(review.get_likes(), 1)
+
+        self.assertEqual(tasks.flush_review_likes(), 1)
+        review = models.Review.objects.get(pk=self.review.pk)
+        self.assertEqual(review.like_count, 1)
+        self.assertEqual(review.get_likes(), 1)
+        #nothing left to flush
+        self.assertEqual(tasks.flush_review_likes(), 0)
+
+    def test_flush_waits_for_slots_being_written(self):
+        models.Like.objects.create(review=self.review, liker=self.profile)
+        #the next like incremented the journal but has not set its slot yet
+        slot = cache.incr(counters.journal.key)
+        self.assertEqual(counters.flush_likes(now=100), 1)
+        self.assertEqual(cache.get(counters.journal.flushed_key), slot - 1)
+        counters._incr(counters.LIKED_KEY.format(self.review.pk))
+        cache.set(counters.journal.slot_key.format(slot), str(self.review.pk))
+        self.assertEqual(counters.flush_likes(now=110), 1)
+        self.assertEqual(models.Review.objects.get(pk=self.review.pk).like_count, 2)
+
+        #a writer that died before setting its slot holds flushing up for a while
+        cache.incr(counters.journal.key)
+        models.Like.objects.create(review=self.review, liker=self.profile1)
+        self.assertEqual(counters.flush_likes(now=200), 0)
+        self.assertEqual(counters.flush_likes(now=200 + journal.MISSING_GRACE), 1)
+        self.assertEqual(models.Review.objects.get(pk=self.review.pk).like_count, 3)
+        self.assertEqual(cache.get(counters.journal.flushed_key),
+                         cache.get(counters.journal.key))
+
+    def test_attach_pending_likes(self):
+        models.Like.objects.create(review=self.review, liker=self.profile1)
+        reviews = models.Review.attach_pending_likes(models.Review.objects.all())
+        with self.assertNumQueries(0):
+            self.assertEqual(reviews[0].get_likes(), 1)
+
+class SeedScaleCommandTests(TestCase):
+
+    def seed(self, **options):
+        call_command('seed_scale', books=30, profiles=20, clubs=4,
+                     book_discussions=10, batch_size=7, stdout=StringIO(),
+                     **options)
+
+    def test_seed_scale_generates_consistent_graph(self):
+        self.seed(seed=3)
+        for model in (models.Book, models.Profile, models.Rating, models.Review,
+                      models.Like, models.BookClub, models.BookClubMember,
+                      models.BookClubRead, models.BookClubThread,
+                      models.ThreadDiscussion, models.BookDiscussion,
+                      models.BookDiscussionComment):
+            self.assertTrue(model.objects.exists(), model)
+        #every club has a founder and a single current read
+        self.assertEqual(
+            models.BookClubMember.objects.filter(role__role=models.Role.FOUNDER)
+            .values('book_club').distinct().count(), 4)
+        #stored counters match the generated rows
+        book = models.Book.objects.filter(rating_count__gt=0).first()
+        self.assertEqual(book.rating_count, book.ratings.count())
+        review = models.Review.objects.filter(like_count__gt=0).first()
+        self.assertEqual(review.like_count, review.likes.count())
+
+    def test_seed_scale_is_deterministic(self):
+        self.seed(seed=5)
+        first = list(models.Rating.objects.order_by('pk')
+                     .values_list('pk', 'rating'))
+        users = list(models.Profile.objects.order_by('pk')
+                     .values_list('pk', 'user__username'))
+        for model in (models.ThreadCommentReply, models.ThreadDiscussionComment,
+                      models.ThreadDiscussion, models.BookCommentReply,
+                      models.BookDiscussionComment, models.Rating):
+            model.objects.all().delete()
+        models.Book.objects.all().delete()
+        models.BookClub.objects.all().delete()
+        models.Profile.objects.all().delete()
+        get_user_model().objects.all().delete()
+        self.seed(seed=5)
+        self.assertEqual(
+            first, list(models.Rating.objects.order_by('pk')
+                        .values_list('pk', 'rating')))
+        self.assertEqual(
+            users, list(models.Profile.objects.order_by('pk')
+                        .values_list('pk', 'user__username')))
+
 class BookClubModelTests(TestCase):
     
     def setUp(self):
@@ -246,6 +414,57 @@ class BookClubModelTests(TestCase):
         self.assertEqual(
             self.book_club.current_read(), self.book1
         ) 
+
+    def test_expired_reads_rotate_to_the_next_queued_read(self):
+        self.assertEqual(self.read1.end, self.read1.end_date())
+        queued = [models.BookClubRead.objects.create(
+            book=models.Book.objects.create(
+                isbn='987654321{}'.format(i),
+                title='Queued {}'.format(i),
+                author='Author',
+                description='test description'),
+            book_club=self.book_club,
+            current_read=False,
+            read_duration=duration,
+            queue_position=position) for i, (duration, position) in enumerate(((7, 2), (14, 1)))]
+        self.assertIsNone(queued[0].end)
+        other_club = models.BookClub.objects.create(
+            name='Other Book Club', location='Nairobi', description='lorem')
+        unexpired = models.BookClubRead.objects.create(
+            book=self.book2, book_club=other_club, read_duration=30)
+
+        now = self.read1.end + datetime.timedelta(seconds=1)
+        #savepoint, select, close, select next, start, release
+        with self.assertNumQueries(6):
+            self.assertEqual(reads.rotate(now), 1)
+        self.read1.refresh_from_db()
+        self.assertFalse(self.read1.current_read)
+        started = models.BookClubRead.objects.get(book_club=self.book_club, current_read=True)
+        self.assertEqual(started.pk, queued[1].pk)
+        self.assertEqual((started.start_date, started.end, started.queue_position),
+                         (now, now + datetime.timedelta(days=14), None))
+        self.assertTrue(models.BookClubRead.objects.get(pk=unexpired.pk).current_read)
+        #nothing expired anymore
+        self.assertEqual(reads.rotate(now), 0)
+
+        #the last queued read starts in turn
+        self.assertEqual(reads.rotate(started.end), 1)
+        self.assertEqual(models.BookClubRead.objects
+                         .get(book_club=self.book_club, current_read=True).pk, queued[0].pk)
+
+    def test_queued_reads_are_not_current(self):
+        queued = models.BookClubRead.objects.create(
+            book=self.book2, book_club=self.book_club, read_duration=7, queue_position=1)
+        self.assertFalse(queued.current_read)
+        self.assertIsNone(queued.end)
+        self.assertEqual(models.BookClubRead.objects
+                         .get(book_club=self.book_club, current_read=True).pk, self.read1.pk)
+
+    def test_fill_ends(self):
+        models.BookClubRead.objects.update(end=None)
+        self.assertEqual(reads.fill_ends(), 1)
+        self.read1.refresh_from_db()
+        self.assertEqual(self.read1.end, self.read1.end_date())
         
     def test_book_club_regular_member(self):
         profile = models.Profile.objects.create(
@@ -298,6 +517,74 @@ class BookClubModelTests(TestCase):
         self.assertFalse(self.book_club.is_admin(profile))
         self.assertFalse(self.book_club.is_regular(profile))
         
+    def test_member_roles_are_scoped_to_the_club(self):
+        profile = models.Profile.objects.create(
+            user=get_user_model().objects.create_user(
+            username='testuser',
+            email='testuser@email.com',
+            password='testpass123'))
+        other_club = models.BookClub.objects.create(
+            name='Other Book Club',
+            location='Mombasa',
+            description='lorem ipsum dolor sit amet',
+        )
+        models.BookClubMember.objects.create(
+            role=roles.get(models.Role.FOUNDER),
+            book_club=other_club,
+            profile=profile,
+        )
+        self.assertIsNone(self.book_club.get_role(profile))
+        self.assertFalse(self.book_club.is_founder(profile))
+        self.assertTrue(other_club.is_founder(profile))
+
+    def test_member_role_lookup_is_memoized(self):
+        profile = models.Profile.objects.create(
+            user=get_user_model().objects.create_user(
+            username='testuser',
+            email='testuser@email.com',
+            password='testpass123'))
+        models.BookClubMember.objects.create(
+            role=roles.get(models.Role.ADMIN),
+            book_club=self.book_club,
+            profile=profile,
+        )
+        with self.assertNumQueries(1):
+            self.assertTrue(self.book_club.is_admin(profile))
+            self.assertFalse(self.book_club.is_founder(profile))
+            self.assertFalse(self.book_club.is_regular(profile))
+
+    def test_leaders_skip_roles_missing_from_the_registry(self):
+        cache.clear()
+        models.BookClubMember.objects.create(
+            role=roles.get(models.Role.FOUNDER),
+            book_club=self.book_club,
+            profile=models.Profile.objects.create(
+                user=get_user_model().objects.create_user(
+                username='testuser',
+                password='testpass123')))
+        with mock.patch('main.roles.get_by_id', return_value=None):
+            self.assertEqual(self.book_club.leaders(),
+                             {models.Role.FOUNDER: [], models.Role.ADMIN: []})
+
+    def test_role_registry_is_invalidated_on_save(self):
+        self.assertEqual(roles.get(models.Role.ADMIN).role, models.Role.ADMIN)
+        with self.assertNumQueries(0):
+            roles.get(models.Role.FOUNDER)
+        models.Role.objects.filter(role=models.Role.ADMIN).delete()
+        role = models.Role.objects.create(role=models.Role.ADMIN)
+        self.assertEqual(roles.get(models.Role.ADMIN).pk, role.pk)
+
+    def test_role_registry_reloads_missing_roles_once_per_interval(self):
+        roles.get(models.Role.ADMIN)
+        with self.assertNumQueries(0):
+            self.assertIsNone(roles.get('missing'))
+            self.assertIsNone(roles.get_by_id(-1))
+        later = time.monotonic() + roles.RELOAD_INTERVAL
+        with mock.patch('main.roles.time.monotonic', return_value=later),\
+                self.assertNumQueries(1):
+            roles.get('missing')
+            roles.get('missing')
+        
 class BookDiscussionTests(TestCase):
     
     def setUp(self):
@@ -375,6 +662,45 @@ class BookDiscussionTests(TestCase):
             self.profile.book_comments_replies.first().body,
             'i like your content'
         )
+
+    def test_book_discussion_stats_follow_writes(self):
+        book = self.book_discussion.book
+        book.refresh_from_db()
+        self.assertEqual(book.discussion_count, 1)
+        self.assertEqual(book.last_discussed, self.book_discussion.created)
+
+        comment = models.BookDiscussionComment.objects.create(
+            discussion=self.book_discussion,
+            commentor=self.profile,
+            body='lorem ipsum dolor sit amet.')
+        book.refresh_from_db()
+        self.assertEqual(book.last_discussed, comment.created)
+
+        other = models.Book.objects.create(
+            isbn='1234567891',
+            title='Of Mice and Men',
+            author='John Steinbeck',
+            description='test description')
+        self.book_discussion.book = other
+        self.book_discussion.save()
+        book.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((book.discussion_count, other.discussion_count), (0, 1))
+
+        self.book_discussion.delete()
+        other.refresh_from_db()
+        self.assertEqual(other.discussion_count, 0)
+
+    def test_recount_discussions_repairs_stats(self):
+        comment = models.BookDiscussionComment.objects.create(
+            discussion=self.book_discussion,
+            commentor=self.profile,
+            body='lorem ipsum dolor sit amet.')
+        models.Book.objects.update(discussion_count=7, last_discussed=None)
+        call_command('recount_discussions', stdout=StringIO())
+        book = models.Book.objects.get(isbn='1234567890')
+        self.assertEqual(book.discussion_count, 1)
+        self.assertEqual(book.last_discussed, comment.created)
         
 class ThreadDiscussionTests(TestCase):
     
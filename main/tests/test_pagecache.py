@@ -0,0 +1,100 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from unittest import mock
+
+from main import models
+
+class PageCacheTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.profile = models.Profile.objects.create(
+                    user=get_user_model().objects.create_user(
+                    username='testuser',
+                    email='testuser@email.com',
+                    password='testpass123'))
+        self.book = models.Book.objects.create(
+            isbn='123456789',
+            title='Misery',
+            author='Stephen King',
+            description='test book description')
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return resp, len(ctx.captured_queries)
+
+    def test_anonymous_pages_are_cached(self):
+        url = reverse('book_detail', kwargs={'pk': self.book.pk})
+        first, queries = self.get(url)
+        self.assertGreater(queries, 0)
+        second, queries = self.get(url)
+        self.assertEqual(queries, 0)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['Content-Type'], first['Content-Type'])
+
+    def test_logged_in_pages_are_not_cached(self):
+        self.client.login(username='testuser', password='testpass123')
+        url = reverse('book_list')
+        self.get(url)
+        _, queries = self.get(url)
+        self.assertGreater(queries, 0)
+
+    def test_saves_invalidate_dependent_pages(self):
+        detail = reverse('book_detail', kwargs={'pk': self.book.pk})
+        for url in (detail, reverse('review_list'), reverse('book_list')):
+            self.get(url)
+        models.Review.objects.create(
+            book=self.book, reviewer=self.profile, body='A chilling read')
+        self.assertContains(self.get(detail)[0], 'A chilling read')
+        self.assertContains(self.get(reverse('review_list'))[0], 'A chilling read')
+        #the book list does not show reviews
+        self.assertEqual(self.get(reverse('book_list'))[1], 0)
+
+        models.Rating.objects.create(book=self.book, rater=self.profile, rating=4)
+        self.assertGreater(self.get(reverse('book_list'))[1], 0)
+
+    def test_club_pages_follow_their_members_and_reads(self):
+        founder = models.Role.objects.create(role=models.Role.FOUNDER)
+        club = models.BookClub.objects.create(name='Club', location='Kilimani', description='')
+        url = reverse('book_club_detail', kwargs={'pk': club.pk})
+        self.assertContains(self.get(url)[0], '0 members')
+        models.BookClubMember.objects.create(
+            book_club=club, profile=self.profile, role=founder)
+        self.assertContains(self.get(url)[0], '1 members')
+        #the founder's name comes from the memoized club leaders
+        self.profile.user.username = 'renamed'
+        self.profile.user.save()
+        self.assertContains(self.get(url)[0], 'renamed')
+
+        models.BookClubRead.objects.create(
+            book_club=club, book=self.book, current_read=True, read_duration=7)
+        self.assertContains(self.get(url)[0], 'Misery')
+        self.book.title = 'Carrie'
+        self.book.save()
+        self.assertContains(self.get(url)[0], 'Carrie')
+
+    def test_logging_in_keeps_pages(self):
+        url = reverse('book_detail', kwargs={'pk': self.book.pk})
+        self.get(url)
+        self.client.login(username='testuser', password='testpass123')
+        self.client.logout()
+        self.assertEqual(self.get(url)[1], 0)
+        self.profile.user.username = 'renamed'
+        self.profile.user.save()
+        self.assertGreater(self.get(url)[1], 0)
+
+    def test_pages_with_placeholders_are_not_cached(self):
+        models.Book.objects.filter(pk=self.book.pk).update(cover='covers/cover.jpg')
+        url = reverse('book_list')
+        #the thumbnail is not generated yet
+        with mock.patch('main.thumbnails._queue'):
+            self.get(url)
+            _, queries = self.get(url)
+        self.assertGreater(queries, 0)
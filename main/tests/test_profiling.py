@@ -0,0 +1,68 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from main import models, profiling
+
+class HistogramTests(TestCase):
+
+    def test_percentiles(self):
+        histogram = profiling.Histogram()
+        for value in range(1, 101):
+            histogram.record(value)
+        self.assertEqual(histogram.total, 100)
+        for q, expected in ((50, 50), (95, 95), (99, 99)):
+            #buckets are 25% wide
+            self.assertLessEqual(expected, histogram.percentile(q))
+            self.assertLess(histogram.percentile(q), expected * 1.25)
+
+#pages served by main.pagecache would not run their queries
+@override_settings(PROFILING_SAMPLE_RATE=1.0, PAGE_CACHE_TIMEOUT=0)
+class ProfilingMiddlewareTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        profiling.recorder.reset()
+        models.Book.objects.create(
+            isbn='1234567890',
+            title='The Pearl',
+            author='John Steinbeck',
+            description='test description')
+
+    def test_server_timing_and_stats(self):
+        for _ in range(3):
+            resp = self.client.get(reverse('book_list'))
+        timing = resp['Server-Timing']
+        self.assertIn('db;desc="1 queries"', timing)
+        self.assertIn('render;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        stats = profiling.stats()
+        self.assertEqual(stats['book_list']['requests'], 3)
+        self.assertEqual(round(stats['book_list']['queries']['p99']), 1)
+        self.assertGreater(stats['book_list']['render_ms']['p50'], 0)
+
+    def test_cache_hits_and_misses_are_counted(self):
+        resp = self.client.get(reverse('trending_books'))
+        self.assertIn('cache;desc="0 hits, 1 misses"', resp['Server-Timing'])
+        resp = self.client.get(reverse('trending_books'))
+        self.assertIn('cache;desc="1 hits, 0 misses"', resp['Server-Timing'])
+
+    @override_settings(PROFILING_SAMPLE_RATE=0.0)
+    def test_unsampled_requests_are_not_measured(self):
+        resp = self.client.get(reverse('book_list'))
+        self.assertFalse(resp.has_header('Server-Timing'))
+        self.assertEqual(profiling.stats(), {})
+
+    def test_stats_endpoint_is_staff_only(self):
+        self.client.get(reverse('book_list'))
+        resp = self.client.get(reverse('profiling_stats'))
+        self.assertEqual(resp.status_code, 302)
+
+        self.client.force_login(get_user_model().objects.create_user(
+            username='staff', password='testpass123', is_staff=True))
+        resp = self.client.get(reverse('profiling_stats'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, 'book_list')
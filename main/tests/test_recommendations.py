@@ -0,0 +1,61 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+
+from main import models, recommendations
+
+class RecommendationTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.books = [models.Book.objects.create(
+            isbn='123456789{}'.format(i),
+            title='Book {}'.format(i),
+            author='Author',
+            description='test book description') for i in range(5)]
+        b0, b1, b2, b3, _ = self.books
+        for i, reads in enumerate(((b0, b1), (b0, b1, b2), (b2, b3))):
+            club = models.BookClub.objects.create(
+                name='Club {}'.format(i), location='Nairobi', description='nano')
+            for book in reads:
+                models.BookClubRead.objects.create(
+                    book=book, book_club=club, current_read=False, read_duration=7)
+        profile = models.Profile.objects.create(
+            user=get_user_model().objects.create_user(
+                username='reader', password='testpass123'))
+        models.Rating.objects.create(book=b0, rater=profile, rating=5)
+        models.Rating.objects.create(book=b1, rater=profile, rating=4)
+
+    def neighbours(self, book):
+        return [(r.recommended_id, r.rank) for r in book.recommendations.all()]
+
+    def test_co_read_books_are_recommended(self):
+        b0, b1, b2, b3, lonely = self.books
+        self.assertTrue(recommendations.compute())
+        self.assertEqual(self.neighbours(b0), [(b1.pk, 1), (b2.pk, 2)])
+        self.assertEqual(self.neighbours(b3), [(b2.pk, 1)])
+        self.assertEqual(self.neighbours(lonely), [])
+        scores = [r.score for r in b2.recommendations.all()]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_blocks_and_reruns_give_the_same_table(self):
+        recommendations.compute()
+        table = sorted(models.BookRecommendation.objects
+                       .values_list('book', 'recommended', 'rank'))
+        recommendations.compute(block_size=2)
+        self.assertEqual(sorted(models.BookRecommendation.objects
+                                .values_list('book', 'recommended', 'rank')), table)
+
+    def test_books_added_during_a_run_are_left_out(self):
+        #b3 & its reads were added after the books were listed
+        book_index = {book.pk: i for i, book in enumerate(self.books[:-2])}
+        matrix = recommendations._matrix(book_index)
+        self.assertEqual(matrix.shape[0], 3)
+
+    def test_book_detail_shows_recommendations(self):
+        recommendations.compute(top_k=1)
+        b0, b1 = self.books[:2]
+        with self.assertNumQueries(3):
+            resp = self.client.get(reverse('book_detail', args=[b0.pk]))
+        self.assertEqual(resp.context['also_read'], [b1])
+        self.assertContains(resp, 'Clubs that read this also read')
@@ -0,0 +1,132 @@
+from django.test import TestCase, TransactionTestCase
+from django.db import connection, transaction
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from io import StringIO
+from unittest import mock
+
+from main import models, search
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.profile = models.Profile.objects.create(
+                    user=get_user_model().objects.create_user(
+                    username='testuser',
+                    email='testuser@email.com',
+                    password='testpass123'))
+        self.pearl = models.Book.objects.create(
+            isbn='1234567890',
+            title='The Pearl',
+            author='John Steinbeck',
+            description='a fisherman finds a great pearl')
+        self.misery = models.Book.objects.create(
+            isbn='123456789',
+            title='Misery',
+            author='Stephen King',
+            description='a novelist is held captive by a fan')
+        self.discussion = models.BookDiscussion.objects.create(
+            question='Why did Kino throw the pearl back?',
+            book=self.pearl,
+            starter=self.profile)
+        comment = models.BookDiscussionComment.objects.create(
+            discussion=self.discussion,
+            commentor=self.profile,
+            body='greed destroyed his family')
+        models.BookCommentReply.objects.create(
+            comment=comment,
+            replier=self.profile,
+            body='the scorpion was an omen')
+        call_command('rebuild_search_index', stdout=StringIO())
+
+    def test_search_ranks_title_matches_first(self):
+        results = search.search('pearl')
+        self.assertEqual(
+            [(result.kind, result.object_id) for result in results],
+            [('book', self.pearl.pk), ('book_discussion', self.discussion.pk)])
+
+    def test_search_requires_every_term(self):
+        self.assertEqual(search.search('pearl king'), [])
+        self.assertEqual(
+            [result.object_id for result in search.search('stephen king')],
+            [self.misery.pk])
+
+    def test_search_matches_comments_and_replies(self):
+        for query in ('greed', 'scorpion omen'):
+            self.assertEqual(
+                [result.object_id for result in search.search(query)],
+                [self.discussion.pk])
+
+    def test_search_view(self):
+        resp = self.client.get(reverse('search'), {'q': 'captive fan'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, 'Misery')
+        self.assertContains(
+            resp, reverse('book_detail', kwargs={'pk': self.misery.pk}))
+        resp = self.client.get(reverse('search'))
+        self.assertEqual(resp.status_code, 200)
+
+class SearchIndexUpdateTests(TransactionTestCase):
+
+    def test_changes_are_batched_per_transaction(self):
+        with mock.patch('main.tasks.update_search_index.delay') as delay:
+            with transaction.atomic():
+                book = models.Book.objects.create(
+                    isbn='1234567890',
+                    title='The Pearl',
+                    author='John Steinbeck',
+                    description='a fisherman finds a great pearl')
+                book.description = 'a fisherman finds a pearl'
+                book.save()
+                profile = models.Profile.objects.create(
+                    user=get_user_model().objects.create_user(
+                    username='testuser',
+                    password='testpass123'))
+                review = models.Review.objects.create(
+                    book=book, reviewer=profile, body='moving')
+            delay.assert_called_once_with(
+                sorted([('book', str(book.pk)), ('review', str(review.pk))]))
+
+            #a rolled back transaction queues nothing and does not block the next one
+            with self.assertRaises(ZeroDivisionError):
+                with transaction.atomic():
+                    review.save()
+                    1 / 0
+            review_pk = review.pk
+            review.delete()
+            self.assertEqual(delay.call_count, 2)
+            delay.assert_called_with([('review', str(review_pk))])
+
+            with self.assertRaises(ZeroDivisionError):
+                with transaction.atomic():
+                    book.save()
+                    1 / 0
+            with transaction.atomic():
+                book.save()
+            self.assertEqual(delay.call_count, 3)
+            delay.assert_called_with([('book', str(book.pk))])
+
+    def test_native_tables_are_postgresql_only(self):
+        self.assertFalse(search.native())
+        call_command('migrate', verbosity=0)
+        self.assertNotIn(models.SearchVector._meta.db_table,
+                         connection.introspection.table_names())
+
+    def test_update_search_index_task(self):
+        from main.tasks import update_search_index
+
+        with mock.patch('main.tasks.update_search_index.delay') as delay:
+            book = models.Book.objects.create(
+                isbn='1234567890',
+                title='The Pearl',
+                author='John Steinbeck',
+                description='a fisherman finds a great pearl')
+        update_search_index(*delay.call_args[0])
+        self.assertEqual(
+            [result.object_id for result in search.search('fisherman')], [book.pk])
+        book_pk = book.pk
+        book.delete()
+        update_search_index([('book', str(book_pk))])
+        self.assertEqual(search.search('fisherman'), [])
@@ -0,0 +1,80 @@
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from io import BytesIO
+from PIL import Image
+from sorl.thumbnail.images import DummyImageFile
+from unittest import mock
+import shutil
+import tempfile
+
+from main import models, thumbnails
+
+def png(width=300, height=200):
+    buf = BytesIO()
+    Image.new('RGB', (width, height), 'green').save(buf, 'PNG')
+    return ContentFile(buf.getvalue())
+
+class ThumbnailResolverTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.books = []
+        for i in range(3):
+            book = models.Book.objects.create(
+                isbn='12345678{}'.format(i),
+                title='Book {}'.format(i),
+                author='Author',
+                description='test book description')
+            book.cover.save('cover{}.png'.format(i), png(), save=True)
+            self.books.append(book)
+        self.books.append(models.Book.objects.create(
+            isbn='123456789',
+            title='Coverless',
+            author='Author',
+            description='test book description'))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+        super().tearDown()
+
+    def test_missing_thumbnails_are_queued_not_generated(self):
+        with mock.patch('main.tasks.generate_thumbnails.delay') as delay:
+            books = thumbnails.attach(self.books, 'cover', '150x75')
+            #queued once only
+            thumbnails.attach(self.books, 'cover', '150x75')
+        self.assertEqual(delay.call_count, 1)
+        names, geometry, options = delay.call_args[0]
+        self.assertEqual(sorted(names), sorted(book.cover.name for book in self.books[:3]))
+        for book in books[:3]:
+            self.assertIsInstance(book.thumbnail, DummyImageFile)
+            self.assertEqual(book.thumbnail.width, 150)
+            #served by the site, not a third party
+            self.assertEqual(book.thumbnail.url, '/static/main/placeholder.svg')
+        self.assertIsNone(books[3].thumbnail)
+
+        #the background task fills the KV store, later pages read it in bulk
+        thumbnails.generate(names, geometry, options)
+        with mock.patch('main.tasks.generate_thumbnails.delay') as delay,\
+                self.assertNumQueries(0):
+            books = thumbnails.attach(self.books, 'cover', '150x75')
+        delay.assert_not_called()
+        for book in books[:3]:
+            self.assertNotIsInstance(book.thumbnail, DummyImageFile)
+            self.assertEqual(book.thumbnail.height, 75)
+            self.assertTrue(book.thumbnail.exists())
+
+    def test_book_list_never_renders_thumbnails_inline(self):
+        with mock.patch('main.tasks.generate_thumbnails.delay') as delay,\
+                mock.patch('sorl.thumbnail.base.ThumbnailBackend._create_thumbnail') as create:
+            resp = self.client.get(reverse('book_list'))
+        self.assertEqual(resp.status_code, 200)
+        create.assert_not_called()
+        delay.assert_called_once()
+        self.assertContains(resp, 'width="150"', count=3)
@@ -0,0 +1,61 @@
+from django.core.cache import caches
+from django.test import SimpleTestCase
+from unittest import mock
+
+from main.tieredcache import LocalCache, TieredCache
+
+def process(max_entries=100):
+    """A TieredCache with an LRU of its own, as in another process"""
+    cache = TieredCache('shared', {'OPTIONS': {
+        'LOCAL_PREFIXES': ['hot:'],
+        'LOCAL_MAX_ENTRIES': max_entries,
+        'SYNC_INTERVAL': 0,
+    }})
+    cache.local = LocalCache(max_entries)
+    return cache
+
+class TieredCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches['shared'].clear()
+
+    def test_local_keys_are_served_in_process(self):
+        cache = process()
+        cache.set('hot:a', 1)
+        cache.set('cold:b', 2)
+        self.assertEqual(cache.get_many(['hot:a', 'cold:b']), {'hot:a': 1, 'cold:b': 2})
+        with mock.patch.object(caches['shared'], 'get_many',
+                               wraps=caches['shared'].get_many) as get_many:
+            self.assertEqual(cache.get('hot:a'), 1)
+            self.assertEqual(cache.get('cold:b'), 2)
+        #only the cold key is fetched
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_writes_reach_other_processes(self):
+        first, second = process(), process()
+        first.set('hot:a', 1)
+        self.assertEqual(second.get('hot:a'), 1)
+        first.set('hot:a', 2)
+        self.assertEqual(second.get('hot:a'), 2)
+        first.delete('hot:a')
+        self.assertIsNone(second.get('hot:a'))
+        first.set_many({'hot:a': 3, 'hot:b': 4})
+        self.assertEqual(second.get_many(['hot:a', 'hot:b']), {'hot:a': 3, 'hot:b': 4})
+
+    def test_clearing_the_shared_cache_clears_every_process(self):
+        first, second = process(), process()
+        first.set('hot:a', 1)
+        self.assertEqual(second.get('hot:a'), 1)
+        first.clear()
+        caches['shared'].set('hot:a', 2)
+        self.assertEqual(second.get('hot:a'), 2)
+
+    def test_lru_is_bounded(self):
+        cache = process(max_entries=2)
+        cache.set_many({'hot:a': 1, 'hot:b': 2, 'hot:c': 3})
+        cache.get_many(['hot:a', 'hot:b', 'hot:c'])
+        self.assertEqual(cache.stats()['entries'], 2)
+        #the least recently used one was dropped
+        self.assertEqual(cache.local.get_many([('hot:a', 1)], 0), {})
@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+import datetime
+
+from main import journal, models, trending
+
+def book(i):
+    return models.Book.objects.create(
+        isbn='123456789{}'.format(i),
+        title='Book {}'.format(i),
+        author='Author',
+        description='test book description')
+
+class TrendingActivityTests(TransactionTestCase):
+    #activity is journaled on transaction commit
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.profile = models.Profile.objects.create(
+            user=get_user_model().objects.create_user(
+                username='testuser', password='testpass123'))
+        self.quiet, self.busy = book(0), book(1)
+
+    def test_activity_is_applied_on_rebalance(self):
+        review = models.Review.objects.create(
+            book=self.busy, reviewer=self.profile, body='very scrumptious')
+        models.Like.objects.create(review=review, liker=self.profile)
+        models.Rating.objects.create(book=self.quiet, rater=self.profile, rating=4)
+        self.assertEqual(trending.top(), [])
+
+        self.assertEqual(trending.rebalance(), 2)
+        busy, quiet = trending.top()
+        self.assertEqual((busy, quiet), (self.busy, self.quiet))
+        self.assertAlmostEqual(trending.decayed(busy.trending_score),
+                               trending.WEIGHTS[models.Review] +
+                               trending.WEIGHTS[models.Like], places=3)
+        #journal drained
+        self.assertEqual(trending.rebalance(), 0)
+
+    def test_flush_waits_for_slots_being_written(self):
+        review = models.Review.objects.create(
+            book=self.busy, reviewer=self.profile, body='very scrumptious')
+        #a writer took the next slot but has not set it yet
+        slot = cache.incr(trending.journal.key)
+        models.Rating.objects.create(book=self.quiet, rater=self.profile, rating=4)
+        self.assertEqual(trending.flush(now=100), 1)
+        self.assertEqual(cache.get(trending.journal.flushed_key), slot - 1)
+
+        like = trending.log_points(trending.WEIGHTS[models.Like])
+        cache.set(trending.journal.slot_key.format(slot), ('review', str(review.pk), like))
+        self.assertEqual(trending.flush(now=110), 2)
+        self.assertEqual(cache.get(trending.journal.flushed_key), slot + 1)
+
+    def test_lost_slots_are_skipped_after_a_while(self):
+        #taken by a writer that died before setting it
+        cache.add(trending.journal.key, 0, timeout=None)
+        slot = cache.incr(trending.journal.key)
+        models.Rating.objects.create(book=self.quiet, rater=self.profile, rating=4)
+        self.assertEqual(trending.flush(now=100), 0)
+        self.assertEqual(trending.flush(now=100 + journal.MISSING_GRACE - 1), 0)
+        self.assertEqual(trending.flush(now=100 + journal.MISSING_GRACE), 1)
+        self.assertEqual(cache.get(trending.journal.flushed_key), slot + 1)
+
+class TrendingScoreTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.books = [book(i) for i in range(3)]
+
+    def test_scores_decay_and_cold_books_are_pruned(self):
+        now = timezone.now()
+        half_life = datetime.timedelta(seconds=settings.TRENDING_HALF_LIFE)
+        old, recent, stale = self.books
+        trending._apply([
+            ('book', str(old.pk), trending.log_points(8, now - half_life)),
+            ('book', str(old.pk), trending.log_points(2, now - half_life)),
+            ('book', str(recent.pk), trending.log_points(6, now)),
+            ('book', str(stale.pk), trending.log_points(1, now - 10 * half_life)),
+        ])
+        old.refresh_from_db()
+        self.assertAlmostEqual(trending.decayed(old.trending_score, now), 5, places=6)
+        self.assertEqual(trending.prune(now), 1)
+
+        cache.clear()
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse('trending_books'))
+        self.assertEqual(resp.context['books'], [recent, old])
+        self.assertNotContains(resp, stale.title)
+        #served from the cached top list
+        with self.assertNumQueries(1):
+            self.assertEqual(trending.top(1), [recent])
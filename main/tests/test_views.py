@@ -1,9 +1,11 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 import datetime
 
-from main import models
+from main import comments, models, pagination, roles
 
 class MainTests(TestCase):
 
@@ -38,6 +40,58 @@ class MainTests(TestCase):
         self.assertContains(resp, 'Ultralearning')
         self.assertContains(resp, 'Scott H.Young')
 
+    def test_book_list_reads_stored_ratings(self):
+        for i in range(3):
+            models.Rating.objects.create(
+                book=self.book,
+                rater=models.Profile.objects.create(
+                    user=get_user_model().objects.create_user(
+                    username='rater{}'.format(i),
+                    password='testpass123')),
+                rating=i + 3)
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse('book_list'))
+        self.assertContains(resp, 'Rating: 4.0')
+
+    def test_book_list_cursor_pagination(self):
+        for i in range(45):
+            models.Book.objects.create(
+                isbn='1000000{:03d}'.format(i),
+                title='Book {}'.format(i),
+                author='Author',
+                description='test book description')
+        seen = []
+        resp = self.client.get(reverse('book_list'))
+        pages = [resp.context['page_obj']]
+        while pages[-1].has_next():
+            resp = self.client.get(reverse('book_list'),
+                                   {'cursor': pages[-1].next_cursor})
+            self.assertEqual(resp.status_code, 200)
+            pages.append(resp.context['page_obj'])
+        for page in pages:
+            seen.extend(book.pk for book in page)
+        self.assertEqual([len(page) for page in pages], [20, 20, 6])
+        self.assertEqual(
+            seen, list(models.Book.objects.order_by('-created', '-id')
+                       .values_list('pk', flat=True)))
+
+        #and back again
+        resp = self.client.get(reverse('book_list'),
+                               {'cursor': pages[-1].previous_cursor})
+        self.assertEqual(
+            [book.pk for book in resp.context['page_obj']],
+            [book.pk for book in pages[1]])
+
+    def test_book_list_cursor_bounds_the_index_scan(self):
+        cursor = pagination.encode_cursor(self.book, pagination.NEXT)
+        with CaptureQueriesContext(connection) as ctx:
+            pagination.paginate(models.Book.objects.all(), 20, cursor)
+        self.assertIn('"created" <= ', ctx.captured_queries[0]['sql'])
+
+    def test_book_list_invalid_cursor(self):
+        resp = self.client.get(reverse('book_list'), {'cursor': 'garbage'})
+        self.assertEqual(resp.status_code, 404)
+
     def test_book_detail(self):
         review = models.Review.objects.create(
             book=self.book,
@@ -89,8 +143,15 @@ class MainTests(TestCase):
             question='How many problems ya got?',
             book=self.book,
             starter=self.profile)
-        resp = self.client.get(reverse('book_discussion_list'))
+        models.Book.objects.create(
+            isbn='1234567891',
+            title='Undiscussed',
+            author='Author',
+            description='test book description')
+        with self.assertNumQueries(2):
+            resp = self.client.get(reverse('book_discussion_list'))
         self.assertEqual(resp.status_code, 200)
+        self.assertNotContains(resp, 'Undiscussed')
         self.assertContains(resp, self.book.title)
         self.assertContains(resp, 'How many problems ya got?')
         self.assertContains(resp, self.profile.user.username)
@@ -118,6 +179,45 @@ class MainTests(TestCase):
         self.assertContains(resp, 'A lot lol!')
         self.assertContains(resp, 'lmao')
 
+    def test_book_discussion_detail_pages_comment_tree(self):
+        discussion = models.BookDiscussion.objects.create(
+            question='How many problems ya got?',
+            book=self.book,
+            starter=self.profile)
+        for i in range(comments.PAGE_SIZE + 1):
+            comment = models.BookDiscussionComment.objects.create(
+                discussion=discussion,
+                commentor=self.profile,
+                body='comment {}'.format(i))
+        for i in range(comments.REPLIES_PER_COMMENT + 2):
+            models.BookCommentReply.objects.create(
+                comment=comment,
+                replier=self.profile,
+                body='reply {}'.format(i))
+        url = reverse('book_discussion_detail', kwargs={'pk' : discussion.pk})
+        with self.assertNumQueries(3):
+            resp = self.client.get(url)
+        self.assertEqual(len(resp.context['comments']), comments.PAGE_SIZE)
+        self.assertContains(resp, 'comment 0')
+        self.assertNotContains(resp, 'comment {}'.format(comments.PAGE_SIZE))
+
+        resp = self.client.get(url, {'cursor': resp.context['page_obj'].next_cursor})
+        self.assertContains(resp, 'comment {}'.format(comments.PAGE_SIZE))
+        last = resp.context['comments'][0]
+        self.assertEqual(last.reply_count, comments.REPLIES_PER_COMMENT + 2)
+        self.assertEqual([reply.body for reply in last.first_replies],
+                         ['reply {}'.format(i) for i in range(comments.REPLIES_PER_COMMENT)])
+        self.assertContains(resp, 'Load more replies')
+
+        with self.assertNumQueries(1):
+            resp = self.client.get(
+                reverse('book_comment_replies', kwargs={'pk': last.pk}),
+                {'cursor': last.more_replies_cursor})
+        self.assertEqual([reply.body for reply in resp.context['replies']],
+                         ['reply {}'.format(i) for i in range(
+                             comments.REPLIES_PER_COMMENT, comments.REPLIES_PER_COMMENT + 2)])
+        self.assertNotContains(resp, 'Load more replies')
+
 class BookClubTests(TestCase):
     
     def setUp(self):
@@ -159,6 +259,27 @@ class BookClubTests(TestCase):
         #current read displayed
         self.assertContains(resp, 'The cathedral and the bazaar')
 
+    def test_book_club_detail_roles_and_member_count(self):
+        founder = models.Role.objects.create(role=models.Role.FOUNDER)
+        admin = models.Role.objects.create(role=models.Role.ADMIN)
+        regular = models.Role.objects.create(role=models.Role.REGULAR)
+        for i, role in enumerate((founder, admin, regular, regular)):
+            models.BookClubMember.objects.create(
+                book_club=self.book_club,
+                role=role,
+                profile=models.Profile.objects.create(
+                    user=get_user_model().objects.create_user(
+                    username='member{}'.format(i),
+                    password='testpass123')))
+        roles.get(models.Role.FOUNDER)
+        with self.assertNumQueries(3):
+            resp = self.client.get(
+                reverse('book_club_detail', args=[self.book_club.id]))
+        self.assertEqual(resp.context['founders'][0].user.username, 'member0')
+        self.assertEqual(resp.context['admins'][0].user.username, 'member1')
+        self.assertContains(resp, '4 members')
+        self.assertContains(resp, 'no current read')
+
     def test_book_club_threads_discussions(self):
         thread = models.BookClubThread.objects.create(
             book_club=self.book_club,
@@ -170,10 +291,20 @@ class BookClubTests(TestCase):
                 book_club=self.book_club,
                 profile=self.profile,
                 role=models.Role.objects.create(role=models.Role.REGULAR)))
-        resp = self.client.get(reverse('book_club_threads', args=[self.book_club.id]))
+        models.ThreadDiscussionComment.objects.create(
+            discussion=discussion,
+            commentor=self.profile,
+            body='Hi all')
+        models.BookClubThread.objects.create(
+            book_club=self.book_club,
+            title='Off topic')
+        with self.assertNumQueries(3):
+            resp = self.client.get(reverse('book_club_threads', args=[self.book_club.id]))
         self.assertEqual(resp.status_code, 200)
         self.assertContains(resp, 'General')
         self.assertContains(resp, 'Introduced yourself yet?')
+        self.assertContains(resp, '1 comments')
+        self.assertContains(resp, 'Nothing here yet')
 
     def test_book_club_reads(self):
         read = models.BookClubRead.objects.create(
@@ -0,0 +1,126 @@
+"""
+Batch thumbnail resolution for list pages.
+
+{% thumbnail %} does one key-value store lookup per image and generates
+missing thumbnails inside the request. attach() instead resolves the
+thumbnails of a whole page with a single get_many against the sorl-thumbnail
+KV store cache. Thumbnails that do not exist yet are queued for the
+generate_thumbnails task and a placeholder of the right size, the static
+THUMBNAIL_DUMMY_SOURCE, is served meanwhile, so rendering a page never
+waits on PIL.
+
+Images already processed by the upload pipeline (main.images) are served
+from their stored renditions without any lookup.
+"""
+import operator
+
+from django.core.cache import cache
+from sorl.thumbnail import default
+from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.conf import settings, defaults as default_settings
+from sorl.thumbnail.images import DummyImageFile, ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+
+from main import images, pagecache
+
+QUEUED_KEY = 'thumbnails:queued:{}'
+QUEUED_TIMEOUT = 60 * 5
+
+class _Backend(ThumbnailBackend):
+
+    def thumbnail_file(self, file_, geometry_string, **options):
+        """
+        The ImageFile get_thumbnail would return, computed from the
+        file name alone (mirrors ThumbnailBackend.get_thumbnail)
+        """
+        source = ImageFile(file_)
+        if settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault('format', self._get_format(source))
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+        name = self._get_thumbnail_filename(source, geometry_string, options)
+        return ImageFile(name, default.storage)
+
+_backend = _Backend()
+
+def _get_many(thumbnails):
+    """{raw key: ImageFile} of the thumbnails found in the KV store"""
+    kvstore = default.kvstore
+    by_key = {add_prefix(thumbnail.key): thumbnail for thumbnail in thumbnails}
+    if hasattr(kvstore, 'cache'):
+        #cached_db_kvstore caches a sentinel class for misses
+        return {key: deserialize_image_file(value)
+                for key, value in kvstore.cache.get_many(list(by_key)).items()
+                if isinstance(value, str)}
+    found = {}
+    for key, thumbnail in by_key.items():
+        stored = kvstore.get(thumbnail)
+        if stored is not None:
+            found[key] = stored
+    return found
+
+def resolve(files, geometry_string, **options):
+    """
+    Return a list with the thumbnail (or placeholder) of every file, None
+    for empty files
+    """
+    thumbnails = [_backend.thumbnail_file(file_, geometry_string, **options)
+                  if file_ else None for file_ in files]
+    raw_keys = {add_prefix(thumbnail.key): i
+                for i, thumbnail in enumerate(thumbnails) if thumbnail}
+    found = _get_many([thumbnail for thumbnail in thumbnails if thumbnail])
+
+    resolved = [None] * len(thumbnails)
+    missing = []
+    for raw_key, i in raw_keys.items():
+        if raw_key in found:
+            resolved[i] = found[raw_key]
+        else:
+            resolved[i] = DummyImageFile(geometry_string)
+            missing.append((files[i].name, thumbnails[i].key))
+    if missing:
+        _queue(missing, geometry_string, options)
+        pagecache.incomplete()
+    return resolved
+
+def _queue(missing, geometry_string, options):
+    from main.tasks import generate_thumbnails
+
+    #queue each thumbnail once while it is being generated
+    names = [name for name, key in missing
+             if cache.add(QUEUED_KEY.format(key), 1, QUEUED_TIMEOUT)]
+    if names:
+        generate_thumbnails.delay(names, geometry_string, options)
+
+def attach(objs, field, geometry_string, attr='thumbnail', **options):
+    """
+    Set obj.<attr> to the thumbnail of obj.<field> for every obj, field may
+    be a dotted path like 'book.cover'. Returns objs as a list.
+    """
+    objs = list(objs)
+    path, _, name = field.rpartition('.')
+    get_owner = operator.attrgetter(path) if path else (lambda obj: obj)
+    pending = []
+    for obj in objs:
+        owner = get_owner(obj)
+        rendition = None
+        if not options and name in images.image_fields(owner):
+            rendition = images.rendition(owner, name, geometry_string)
+        if rendition:
+            setattr(obj, attr, rendition)
+        else:
+            pending.append((obj, getattr(owner, name)))
+    thumbnails = resolve([file_ for _, file_ in pending], geometry_string, **options)
+    for (obj, _), thumbnail in zip(pending, thumbnails):
+        setattr(obj, attr, thumbnail)
+    return objs
+
+def generate(names, geometry_string, options):
+    """Create the thumbnails of the named source files"""
+    for name in names:
+        thumbnail = default.backend.get_thumbnail(name, geometry_string, **options)
+        cache.delete(QUEUED_KEY.format(thumbnail.key))
@@ -0,0 +1,236 @@
+"""
+Two-tier cache backend: a bounded in-process LRU in front of another cache.
+
+CACHES['default'] wraps the cache named by its LOCATION (the network cache
+from CACHE_URL). Reads of keys starting with one of the LOCAL_PREFIXES are
+kept in a per-process LRU for at most LOCAL_TIMEOUT seconds, so hot keys
+cost no round-trip; every other key and every write goes straight to the
+shared cache.
+
+Writes to local keys are published to the other processes through an
+invalidation journal in the shared cache: a counter (VERSION_KEY) and one
+slot per write holding the key. Every process reads the counter at most
+every SYNC_INTERVAL seconds and evicts the keys written since it last
+looked, or its whole LRU when it fell too far behind or the shared cache
+was cleared.
+
+Local hits & misses are counted in stats and reported to the listeners,
+which main.metrics exports.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+VERSION_KEY = 'tiered:invalidations'
+SLOT_KEY = 'tiered:invalidation:{}'
+#slots outlive the sync interval of any live process
+SLOT_TIMEOUT = 60 * 5
+#past this many unseen writes the LRU is cleared instead of replayed
+MAX_REPLAY = 1000
+
+#callables(hits, misses) told about every local lookup
+listeners = []
+
+class LocalCache:
+    """Thread-safe LRU of (value, expiry) with the journal position it is synced to"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.seen = None
+        self.synced = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys, now):
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[1] <= now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                found[key] = entry[0]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, values, expiry):
+        with self.lock:
+            for key, value in values.items():
+                self.entries[key] = (value, expiry)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def evict(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+#one LRU per process & shared cache, cache instances are per thread
+_locals = {}
+_locals_lock = threading.Lock()
+
+class TieredCache(BaseCache):
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.shared_alias = location
+        self.local_prefixes = tuple(options.get('LOCAL_PREFIXES', ()))
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 60)
+        self.sync_interval = options.get('SYNC_INTERVAL', 1)
+        with _locals_lock:
+            if location not in _locals:
+                _locals[location] = LocalCache(options.get('LOCAL_MAX_ENTRIES', 10000))
+            self.local = _locals[location]
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias]
+
+    def is_local(self, key):
+        return key.startswith(self.local_prefixes)
+
+    def _local_key(self, key, version):
+        return (key, self.version if version is None else version)
+
+    #invalidation journal
+    def sync(self, force=False):
+        """Evict the local keys other processes wrote since the last sync"""
+        now = time.monotonic()
+        if not force and now - self.local.synced < self.sync_interval:
+            return
+        self.local.synced = now
+        shared = self.shared
+        current = shared.get(VERSION_KEY)
+        seen = self.local.seen
+        if current is None:
+            #first process to start, or the shared cache was cleared
+            shared.add(VERSION_KEY, 0, timeout=None)
+            current = shared.get(VERSION_KEY) or 0
+            if seen is not None:
+                self.local.clear()
+        elif seen is None:
+            pass
+        elif current < seen or current - seen > MAX_REPLAY:
+            self.local.clear()
+        elif current > seen:
+            slots = [SLOT_KEY.format(n) for n in range(seen + 1, current + 1)]
+            written = shared.get_many(slots)
+            if len(written) < len(slots):
+                #expired slots, the keys they held are unknown
+                self.local.clear()
+            else:
+                self.local.evict([tuple(key) for key in written.values()])
+        self.local.seen = current
+
+    def _publish(self, local_keys):
+        if not local_keys:
+            return
+        self.local.evict(local_keys)
+        shared = self.shared
+        shared.add(VERSION_KEY, 0, timeout=None)
+        last = shared.incr(VERSION_KEY, len(local_keys))
+        shared.set_many({SLOT_KEY.format(last - i): list(key)
+                         for i, key in enumerate(reversed(local_keys))},
+                        timeout=SLOT_TIMEOUT)
+
+    def _report(self, hits, misses):
+        for listener in listeners:
+            listener(hits, misses)
+
+    #reads, get & get_many may be instrumented (main.cachestats) so they share _get_many
+    def _get_many(self, keys, version=None):
+        keys = list(keys)
+        local = [key for key in keys if self.is_local(key)]
+        found = {}
+        if local:
+            self.sync()
+            now = time.monotonic()
+            hits = self.local.get_many([self._local_key(key, version) for key in local], now)
+            found = {key: hits[self._local_key(key, version)] for key in local
+                     if self._local_key(key, version) in hits}
+            self._report(len(found), len(local) - len(found))
+        missing = [key for key in keys if key not in found]
+        if missing:
+            fetched = self.shared.get_many(missing, version=version)
+            fresh = {self._local_key(key, version): value for key, value in fetched.items()
+                     if self.is_local(key)}
+            if fresh:
+                self.local.set_many(fresh, time.monotonic() + self.local_timeout)
+            found.update(fetched)
+        return found
+
+    def get_many(self, keys, version=None):
+        return self._get_many(keys, version=version)
+
+    def get(self, key, default=None, version=None):
+        found = self._get_many([key], version=version)
+        return found[key] if key in found else default
+
+    def has_key(self, key, version=None):
+        return key in self._get_many([key], version=version)
+
+    #writes
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        #only succeeds for an absent key, which no process holds
+        return self.shared.add(key, value, timeout=timeout, version=version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout=timeout, version=version)
+        if self.is_local(key):
+            self._publish([self._local_key(key, version)])
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout=timeout, version=version)
+        self._publish([self._local_key(key, version) for key in data if self.is_local(key)])
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        self.shared.delete(key, version=version)
+        if self.is_local(key):
+            self._publish([self._local_key(key, version)])
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self.shared.delete_many(keys, version=version)
+        self._publish([self._local_key(key, version) for key in keys if self.is_local(key)])
+
+    def incr(self, key, delta=1, version=None):
+        value = self.shared.incr(key, delta, version=version)
+        if self.is_local(key):
+            self._publish([self._local_key(key, version)])
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def clear(self):
+        #the journal goes too, other processes clear their LRU on their next sync
+        self.shared.clear()
+        self.local.clear()
+        self.local.seen = None
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
+
+    def stats(self):
+        """Local hits, misses & size of this process' LRU"""
+        return {'hits': self.local.hits, 'misses': self.local.misses,
+                'entries': len(self.local.entries)}
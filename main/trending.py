@@ -0,0 +1,134 @@
+"""
+Trending books, ranked by exponentially decaying activity.
+
+Every rating, review, like and book discussion adds its weight to the score
+of a book, and scores halve every TRENDING_HALF_LIFE seconds. Rather than
+decaying every score over time, an event at time t is stored grown by
+exp((t - EPOCH) / tau): all scores then decay by the same factor, so the
+ranking only changes when events arrive. Book.trending_score keeps the log
+of that sum so it never overflows, and is indexed for top-N reads.
+
+Events are journaled in CACHES['default'] (main.journal), like the review
+like counters, and applied by the rebalance_trending task, which also drops
+cold books from the ranking and refreshes the cached top list the trending
+page is served from.
+"""
+import math
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Abs, Exp, Greatest, Ln
+from django.utils import timezone
+
+from main import models
+from main.journal import Journal
+
+EPOCH = datetime(2020, 1, 1, tzinfo=dt_timezone.utc).timestamp()
+WEIGHTS = {
+    models.Rating: 3.0,
+    models.Review: 5.0,
+    models.Like: 1.0,
+    models.BookDiscussion: 4.0,
+}
+#books whose decayed score falls below this leave the ranking
+MIN_SCORE = 0.05
+TOP_SIZE = 100
+TOP_KEY = 'trending:top'
+TOP_TIMEOUT = 60 * 10
+LOCK_KEY = 'trending:lock'
+LOCK_TIMEOUT = 60 * 5
+BATCH_SIZE = 500
+#of (kind, pk, points) events
+journal = Journal('trending')
+
+def tau():
+    return settings.TRENDING_HALF_LIFE / math.log(2)
+
+def log_points(weight, when=None):
+    """Stored (log) value of weight points earned at when"""
+    when = (when or timezone.now()).timestamp()
+    return math.log(weight) + (when - EPOCH) / tau()
+
+def decayed(score, now=None):
+    """Current value of a stored trending_score"""
+    if score is None:
+        return 0.0
+    return math.exp(score - log_points(1, now))
+
+def _logsumexp(values):
+    top = max(values)
+    return top + math.log(sum(math.exp(value - top) for value in values))
+
+#post_save receiver
+def record_activity(sender, instance, created, **kwargs):
+    if not created:
+        return
+    if sender is models.Like:
+        target = ('review', str(instance.review_id))
+    else:
+        target = ('book', str(instance.book_id))
+    points = log_points(WEIGHTS[sender])
+    transaction.on_commit(lambda: journal.append(target + (points,)))
+
+def _apply(events):
+    """Fold [(kind, pk, points)] into Book.trending_score, returns books updated"""
+    review_ids = {pk for kind, pk, _ in events if kind == 'review'}
+    books_of_reviews = {str(pk): str(book_id) for pk, book_id in models.Review.objects
+                        .filter(pk__in=review_ids).values_list('pk', 'book_id')}
+    by_book = {}
+    for kind, pk, points in events:
+        book_id = books_of_reviews.get(pk) if kind == 'review' else pk
+        if book_id:
+            by_book.setdefault(book_id, []).append(points)
+
+    with transaction.atomic():
+        for book_id, points in sorted(by_book.items()):
+            points = Value(_logsumexp(points), output_field=FloatField())
+            #log(exp(score) + exp(points)) without leaving the log domain
+            models.Book.objects.filter(pk=book_id, trending_score__isnull=False)\
+                .update(trending_score=Greatest(F('trending_score'), points) +
+                        Ln(Value(1.0) + Exp(-Abs(F('trending_score') - points))))
+            models.Book.objects.filter(pk=book_id, trending_score__isnull=True)\
+                .update(trending_score=points)
+    return len(by_book)
+
+def flush(now=None):
+    """Apply the journaled events, returns the number of books updated"""
+    return sum(_apply(events) for events in journal.batches(BATCH_SIZE, now))
+
+def prune(now=None):
+    """Drop books whose decayed score is below MIN_SCORE from the ranking"""
+    return models.Book.objects\
+        .filter(trending_score__lt=log_points(MIN_SCORE, now))\
+        .update(trending_score=None)
+
+def _refresh_top():
+    books = list(models.Book.objects
+                 .filter(trending_score__isnull=False)
+                 .order_by('-trending_score')[:TOP_SIZE])
+    cache.set(TOP_KEY, [str(book.pk) for book in books], TOP_TIMEOUT)
+    return books
+
+def rebalance():
+    """Flush, prune & refresh the cached top list, returns books updated"""
+    if not cache.add(LOCK_KEY, 1, timeout=LOCK_TIMEOUT):
+        return 0
+    try:
+        updated = flush()
+        prune()
+        _refresh_top()
+        return updated
+    finally:
+        cache.delete(LOCK_KEY)
+
+def top(limit=20):
+    """The limit most trending books, best first, in one query"""
+    ids = cache.get(TOP_KEY)
+    if ids is None:
+        return _refresh_top()[:limit]
+    books = models.Book.objects.in_bulk(ids[:limit])
+    return [books[uuid.UUID(pk)] for pk in ids[:limit] if uuid.UUID(pk) in books]
@@ -6,15 +6,21 @@ from main import views
 urlpatterns = [
     path('', TemplateView.as_view(template_name='home.html'), name='home'),
     path('books/', views.BookListView.as_view(), name='book_list'),
+    path('books/trending/', views.TrendingBookList.as_view(), name='trending_books'),
     path('books/<uuid:pk>/', views.BookDetailView.as_view(), name='book_detail'),
     path('reviews/', views.ReviewList.as_view(), name='review_list'),
     path('reviews/<uuid:pk>/', views.ReviewDetail.as_view(), name='review_detail'),
     path('books/discussions/', views.BookDiscussionList.as_view(), name='book_discussion_list'),
     path('books/discussions/<uuid:pk>', views.BookDiscussionDetail.as_view(), name='book_discussion_detail'),
+    path('books/discussions/comments/<uuid:pk>/replies/', views.BookCommentReplyList.as_view(), name='book_comment_replies'),
     path('book-clubs/', views.BookClubList.as_view(), name='book_club_list'),
     path('book-clubs/<uuid:pk>/', views.BookClubDetail.as_view(), name='book_club_detail'),
     path('book-clubs/<uuid:pk>/members/', views.BookClubMemberList.as_view(), name='book_club_members'),
     path('book-clubs/<uuid:pk>/threads/', views.BookClubThreadList.as_view(), name='book_club_threads'),
     path('book-clubs/<uuid:pk>/reads/', views.BookClubReadsList.as_view(), name='book_club_reads'),
     path('thread-discussions/<uuid:pk>/', views.ThreadDiscussionDetail.as_view(), name='thread_discussion_detail'),
+    path('thread-discussions/comments/<uuid:pk>/replies/', views.ThreadCommentReplyList.as_view(), name='thread_comment_replies'),
+    path('search/', views.SearchView.as_view(), name='search'),
+    path('profiling/', views.ProfilingStatsView.as_view(), name='profiling_stats'),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
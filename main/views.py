@@ -1,22 +1,81 @@
-from django.views.generic import ListView, DetailView
-from django.db.models import Count
-
-from main import models
-
-class BookListView(ListView):
+import hmac
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.utils.decorators import method_decorator
+from django.views.generic import ListView, DetailView, TemplateView, View
+from django.db.models import Count, Prefetch
+from django.http import HttpResponse, HttpResponseForbidden
+from django.shortcuts import get_object_or_404
+
+from main import (comments, fragments, metrics, models, pagecache, profiling, search,
+                  thumbnails, trending)
+from main.comments import CommentTreeMixin
+from main.pagecache import CachedPageMixin
+from main.pagination import KeysetPaginationMixin
+
+#geometry of the covers shown on book, review & discussion pages
+COVER_THUMBNAIL = '150x75'
+
+class BookListView(CachedPageMixin, KeysetPaginationMixin, ListView):
     model = models.Book
+    page_tags = (pagecache.BOOKS,)
     template_name = 'main/books.html'
     context_object_name = 'books'
 
-class BookDetailView(DetailView):
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['books'] = thumbnails.attach(ctx['books'], 'cover', COVER_THUMBNAIL)
+        ctx['fragments'] = fragments.prefetch(('book', ctx['books']))
+        return ctx
+
+class TrendingBookList(ListView):
+    template_name = 'main/trending_books.html'
+    context_object_name = 'books'
+    limit = 20
+
+    def get_queryset(self):
+        return trending.top(self.limit)
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['books'] = thumbnails.attach(ctx['books'], 'cover', COVER_THUMBNAIL)
+        for book in ctx['books']:
+            book.trending = trending.decayed(book.trending_score)
+        return ctx
+
+class BookDetailView(CachedPageMixin, DetailView):
     model = models.Book
+    page_tags = (pagecache.BOOK, pagecache.PROFILES, pagecache.RECOMMENDATIONS)
     template_name = 'main/book.html'
 
-class ReviewList(ListView):
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['reviews'] = models.Review.attach_pending_likes(
+            self.object.reviews.select_related('reviewer__user'))
+        thumbnails.attach([self.object], 'cover', COVER_THUMBNAIL)
+        #precomputed by the compute_recommendations task
+        ctx['also_read'] = [recommendation.recommended for recommendation in
+                            self.object.recommendations.select_related('recommended')]
+        ctx['fragments'] = fragments.prefetch(('book_review', ctx['reviews']))
+        return ctx
+
+class ReviewList(CachedPageMixin, KeysetPaginationMixin, ListView):
     model = models.Review
+    page_tags = (pagecache.REVIEWS,)
     template_name = 'main/reviews.html'
     context_object_name = 'reviews'
 
+    def get_queryset(self):
+        return models.Review.objects.select_related('book')
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['reviews'] = models.Review.attach_pending_likes(ctx['reviews'])
+        thumbnails.attach(ctx['reviews'], 'book.cover', COVER_THUMBNAIL)
+        ctx['fragments'] = fragments.prefetch(('review', ctx['reviews']))
+        return ctx
+
 class ReviewDetail(DetailView):
     model = models.Review
     template_name = 'main/review.html'
@@ -24,43 +83,73 @@ class ReviewDetail(DetailView):
 class BookDiscussionList(ListView):
     template_name = 'main/book_discussions.html'
     context_object_name = 'books'
+    #number of most discussed books listed
+    limit = 20
 
     def get_queryset(self):
-        qs = models.Book.objects.annotate(discussion_count=Count('discussions'))
-        qs = qs.exclude(discussion_count=0)
-        qs = qs.order_by('-discussion_count')
-        return qs
+        return models.Book.most_discussed(self.limit)
 
-class BookDiscussionDetail(DetailView):
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['books'] = thumbnails.attach(ctx['books'], 'cover', COVER_THUMBNAIL)
+        return ctx
+
+class BookDiscussionDetail(CommentTreeMixin, DetailView):
     template_name = 'main/book_discussion.html'
     context_object_name = 'discussion'
+    replies_url = 'book_comment_replies'
     
     def get_queryset(self):
-        qs = models.BookDiscussion.objects.\
-             prefetch_related('comments', 'comments__replies')
-        return qs
+        return models.BookDiscussion.objects.select_related('book')
 
-class BookClubList(ListView):
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        thumbnails.attach([self.object.book], 'cover', COVER_THUMBNAIL)
+        return ctx
+
+class BookCommentReplyList(KeysetPaginationMixin, ListView):
+    """Replies of a comment past the ones shown on the discussion page"""
+    model = models.BookCommentReply
+    template_name = 'main/comment_replies.html'
+    context_object_name = 'replies'
+    paginate_by = comments.REPLIES_PAGE_SIZE
+    ascending = True
+    replies_url = 'book_comment_replies'
+
+    def get_queryset(self):
+        return self.model.objects\
+                .filter(comment=self.kwargs.get('pk'))\
+                .select_related('replier__user')
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['replies_url'] = self.replies_url
+        ctx['comment_id'] = self.kwargs.get('pk')
+        ctx['more_cursor'] = ctx['page_obj'].next_cursor
+        ctx['fragments'] = fragments.prefetch(('reply', ctx['replies']))
+        return ctx
+
+class BookClubList(KeysetPaginationMixin, ListView):
     model = models.BookClub
     template_name = 'main/book_clubs.html'
     context_object_name = 'book_clubs'
 
-class BookClubDetail(DetailView):
+class BookClubDetail(CachedPageMixin, DetailView):
     model = models.BookClub
+    page_tags = (pagecache.BOOK_CLUB, pagecache.PROFILES)
     template_name = 'main/book_club.html'
     context_object_name = 'book_club'
 
+    def get_queryset(self):
+        return models.BookClub.objects.annotate(
+            member_count=Count('book_club_members'))
+
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
-        founders = models.BookClubMember.objects\
-                    .filter(role__role=models.Role.FOUNDER,
-                            book_club=self.object)
-        admins = models.BookClubMember.objects\
-                    .filter(role__role=models.Role.ADMIN,
-                            book_club=self.object)
-        #obtain Profile instead of BookClubMember objects
-        ctx['founders'] = [founder.profile for founder in founders]
-        ctx['admins'] = [admin.profile for admin in admins]
+        by_role = self.object.leaders()
+        ctx['founders'] = by_role[models.Role.FOUNDER]
+        ctx['admins'] = by_role[models.Role.ADMIN]
+        ctx['current_read'] = self.object.current_read()
         return ctx
 
 class BookClubMemberList(ListView):
@@ -79,19 +168,21 @@ class BookClubMemberList(ListView):
         ctx['book_club'] = book_club
         return ctx
 
-class BookClubThreadList(ListView):
+class BookClubThreadList(KeysetPaginationMixin, ListView):
     template_name = 'main/book_club_threads.html'
     context_object_name = 'threads'
 
     def get_queryset(self):
-        book_club = models.BookClub.objects.get(id=self.kwargs.get('pk'))
-        qs = models.BookClubThread.objects.filter(book_club=book_club)
-        return qs
+        self.book_club = get_object_or_404(models.BookClub, pk=self.kwargs.get('pk'))
+        discussions = models.ThreadDiscussion.objects\
+                        .annotate(comment_count=Count('comments'))
+        return models.BookClubThread.objects\
+                .filter(book_club=self.book_club)\
+                .prefetch_related(Prefetch('discussions', queryset=discussions))
 
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
-        book_club = models.BookClub.objects.get(id=self.kwargs.get('pk'))
-        ctx['book_club'] = book_club
+        ctx['book_club'] = self.book_club
         return ctx
         
 class BookClubReadsList(ListView):
@@ -109,11 +200,49 @@ class BookClubReadsList(ListView):
         ctx['book_club'] = book_club
         return ctx
 
-class ThreadDiscussionDetail(DetailView):
+class ThreadDiscussionDetail(CommentTreeMixin, DetailView):
     template_name = 'main/thread_discussion.html'
     context_object_name = 'discussion'
+    replies_url = 'thread_comment_replies'
     
     def get_queryset(self):
-        qs = models.ThreadDiscussion.objects.\
-             prefetch_related('comments', 'comments__replies')
-        return qs
\ No newline at end of file
+        return models.ThreadDiscussion.objects.select_related('thread')
+
+class ThreadCommentReplyList(BookCommentReplyList):
+    model = models.ThreadCommentReply
+    replies_url = 'thread_comment_replies'
+
+class SearchView(ListView):
+    template_name = 'main/search.html'
+    context_object_name = 'results'
+
+    def get_queryset(self):
+        return search.search(self.request.GET.get('q', ''))
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['query'] = self.request.GET.get('q', '')
+        return ctx
+
+@method_decorator(staff_member_required, name='dispatch')
+class ProfilingStatsView(TemplateView):
+    template_name = 'main/profiling_stats.html'
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['stats'] = profiling.stats()
+        ctx['sample_rate'] = settings.PROFILING_SAMPLE_RATE
+        ctx['window'] = profiling.WINDOW // 60
+        return ctx
+
+class MetricsView(View):
+    """Prometheus scrape endpoint, for the METRICS_TOKEN bearer & staff only"""
+
+    def get(self, request, *args, **kwargs):
+        token = settings.METRICS_TOKEN
+        scraper = bool(token) and hmac.compare_digest(
+            request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token)
+        if not scraper and not request.user.is_staff:
+            return HttpResponseForbidden()
+        body, content_type = metrics.exposition()
+        return HttpResponse(body, content_type=content_type)